@@ -4,50 +4,216 @@ import logging
 import json
 
 import hug
-from falcon import HTTP_400, HTTP_500
+from hug.format import content_type
+from falcon import HTTP_202, HTTP_400, HTTP_403, HTTP_404, HTTP_409, HTTP_500, HTTP_503
 
-from klaxer.rules import Rules
-from klaxer.errors import AuthorizationError, NoRouteFoundError, ServiceNotDefinedError
-from klaxer.lib import classify, enrich, filtered, route, send, validate
+from klaxer import config
+from klaxer.clustering import TEMPLATES
+from klaxer.coalesce import Coalescer
+from klaxer.dedup import Deduplicator
+from klaxer.delivery import DeliveryQueue
+from klaxer.rules import ReloadingRules
+from klaxer.errors import AuthorizationError, DeliveryQueueFullError, MalformedAlertError, \
+    NoRouteFoundError, ServiceNotDefinedError, SpoolFullError, SpoolUnavailableError, \
+    TransformerNotDefinedError
+from klaxer.lib import NDJSONStream, read_lines, read_ndjson, send, validate
+from klaxer.metrics import METRICS, Trace, count_alert
 from klaxer.models import Alert
-from klaxer.users import create_user, add_message, bootstrap, api_key_authentication, is_existing_user
+from klaxer.profiler import PROFILER, parse_option
+from klaxer.snooze import SnoozeStore, parse_severity, parse_template, parse_ttl
+from klaxer.spool import Spool
+from klaxer.users import KEYS, create_user, add_message, bootstrap, api_key_authentication, \
+    is_existing_user, end_session, get_user
 
 
-CURRENT_FILTERS = []
+SNOOZES = SnoozeStore()
+
+CURRENT_FILTERS = [SNOOZES.is_snoozed]
+
+RULES = ReloadingRules()
+
+DEDUP = Deduplicator() if config.DEDUP_WINDOW else None
+
+# Returned by `accept` for an alert absorbed as a repeat
+DEDUPLICATED = object()
+
+DELIVERY = DeliveryQueue(send, spool=Spool() if config.SPOOL_PATH else None,
+                         coalescer=Coalescer() if config.COALESCE_WINDOW else None)
+
+METRICS.gauge('klaxer_delivery_queue_depth', 'Alerts and digests waiting to be delivered',
+              lambda: DELIVERY.depth)
+METRICS.gauge('klaxer_coalesce_buffer_depth', 'Alerts waiting to be coalesced into digests',
+              lambda: DELIVERY.coalescer.depth if DELIVERY.coalescer else 0)
+METRICS.counter('klaxer_dedup_checks_total', 'Dedup checks by result, where hits are absorbed repeats',
+                ('result',), lambda: _dedup_stats(('hits', 'misses')))
+METRICS.counter('klaxer_dedup_evictions_total', 'Fingerprints evicted from the dedup cache',
+                callback=lambda: _dedup_stats(('evictions',)).get(('evictions',), 0))
+METRICS.gauge('klaxer_dedup_entries', 'Fingerprints remembered by the deduplicator',
+              lambda: _dedup_stats(('entries',)).get(('entries',), 0))
+METRICS.gauge('klaxer_key_cache_entries', 'Verified API keys cached', lambda: len(KEYS))
+METRICS.gauge('klaxer_templates', 'Message templates learned', lambda: len(TEMPLATES.list()))
+METRICS.gauge('klaxer_snoozes', 'Active snoozes', lambda: len(SNOOZES.list()))
+
+def _dedup_stats(counters):
+    """Get some of the deduplicator's counters, keyed as metric samples"""
+    stats = DEDUP.stats() if DEDUP else {}
+    return {(counter,): stats[counter] for counter in counters if counter in stats}
+
+def accept(pipeline, service_name, data, debug=False):
+    """Run the payload of a single alert through a service's pipeline and hand it off for delivery.
+
+    :returns: the debug info of the alert, its delivery ID, DEDUPLICATED if it repeats a recently
+        delivered alert, or None if it was dropped
+    :raises MalformedAlertError: if the payload does not fit the service's transform
+    :raises TransformerNotDefinedError: if the service has no transformer
+    """
+    trace = Trace(service_name, explain=debug)
+    alert = Alert.from_service(service_name, data, pipeline.transform)
+    trace.lap('transform')
+    try:
+        # Exclude, mine the message template (which snoozes, rollups and optionally dedup key on), classify,
+        # check snoozes, enrich and route in one pass. Dropped alerts come back as None.
+        if pipeline.process(alert, CURRENT_FILTERS, trace, TEMPLATES) is None:
+            return {"status": "dropped", "trace": trace.to_dict()} if debug else None
+
+        # Present relevant debug info, with the stage timings and matched rules, without actually sending
+        # the Alert
+        if debug:
+            trace.outcome = 'debugged'
+            return dict(alert.to_dict(), trace=trace.to_dict())
+
+        # Absorb repeats of a recently delivered alert before they cost any Slack API calls
+        deduped = DEDUP and DEDUP.check(alert)
+        trace.lap('dedup')
+        if deduped:
+            trace.outcome = 'deduped'
+            return DEDUPLICATED
+
+        # Hand the alert off to the delivery workers. The target channel gets queried for the most recent
+        # message. If it's identical, perform rollup. Otherwise, post the alert.
+        delivery_id = DELIVERY.put(alert)
+        trace.lap('enqueue')
+        trace.outcome = 'accepted'
+        return delivery_id
+    finally:
+        trace.record(METRICS)
+        count_alert(alert, trace.outcome or 'failed')
+
+
+def deliver_repeats(alert):
+    """Deliver the repeats of an alert that the deduplicator absorbed, once their window closes"""
+    try:
+        DELIVERY.put(alert)
+    except (DeliveryQueueFullError, SpoolFullError, SpoolUnavailableError) as error:
+        logging.warning('Dropped %d repeats of an alert: %s', alert.count, error.message)
 
-RULES = Rules()
 
 @hug.post('/alert/{service_name}/{token}')
 def incoming(service_name: hug.types.text, token: hug.types.text, response, debug=False, body=None):
     """An incoming alert. The core API method"""
     try:
         validate(service_name, token)
-        alert = Alert.from_service(service_name, body)
-        alert = classify(alert, RULES.get_classification_rules(service_name))
-        # Filter based on rules (e.g. junk an alert if a string is in the body or if it came from a CI bot).
-        if filtered(alert, RULES.get_exclusion_rules(service_name)):
-            return
-        #Filtered based on user interactions (e.g. bail if we've snoozed the notification type snoozed).
-        if filtered(alert, CURRENT_FILTERS):
-            return
-        #Enriched based on custom rules (e.g. all alerts with 'keepalive' have '@deborah' appended to them so Deborah gets an extra level of notification priority.
-        alert = enrich(alert, RULES.get_enrichment_rules(service_name))
-        # Determine where the message goes
-        alert = route(alert, RULES.get_routing_rules(service_name))
-
-        # Present relevant debug info without actually sending the Alert
-        if debug:
-            return alert.to_dict()
-
-        #The target channel gets queried for the most recent message. If it's identical, perform rollup. Otherwise, post the alert.
-        send(alert)
-        return {"status": "ok"}
-    except (AuthorizationError, NoRouteFoundError, ServiceNotDefinedError) as error:
+        pipeline = RULES.get_pipeline(service_name)
+        result = accept(pipeline, service_name, body, debug)
+        if result is None or debug:
+            return result
+        if result is DEDUPLICATED:
+            return {"status": "deduplicated"}
+        response.status = HTTP_202
+        return {"status": "accepted", "id": result}
+    except (DeliveryQueueFullError, SpoolFullError, SpoolUnavailableError) as error:
+        logging.warning('Rejected an alert: %s', error.message)
+        response.status = HTTP_503
+        return {"status": error.message}
+    except MalformedAlertError as error:
+        response.status = HTTP_400
+        return {"status": error.message}
+    except (AuthorizationError, NoRouteFoundError, ServiceNotDefinedError,
+            TransformerNotDefinedError) as error:
         logging.exception('Failed to serve an alert response')
         response.status = HTTP_500
         return {"status": error.message}
 
 
+def accept_item(pipeline, service_name, data, debug=False):
+    """Accept one alert of a batch. Unlike `accept`, an alert that can't be accepted only fails itself.
+
+    :returns: the result for the alert
+    """
+    try:
+        result = accept(pipeline, service_name, data, debug)
+    except (DeliveryQueueFullError, MalformedAlertError, NoRouteFoundError, SpoolFullError,
+            SpoolUnavailableError, TransformerNotDefinedError) as error:
+        return {"status": error.message}
+    if result is None:
+        return {"status": "dropped"}
+    if result is DEDUPLICATED:
+        return {"status": "deduplicated"}
+    if debug:
+        return result
+    return {"status": "accepted", "id": result}
+
+
+@hug.post('/alerts/{service_name}/{token}')
+def incoming_batch(service_name: hug.types.text, token: hug.types.text, response, debug=False, body=None):
+    """A batch of incoming alerts for a service, as a JSON array or as newline-delimited JSON
+    (application/x-ndjson). Each alert is handled as by `incoming`, and gets its own result."""
+    try:
+        validate(service_name, token)
+        pipeline = RULES.get_pipeline(service_name)
+    except (AuthorizationError, ServiceNotDefinedError) as error:
+        logging.exception('Failed to serve an alert batch response')
+        response.status = HTTP_500
+        return {"status": error.message}
+
+    if body is None:
+        response.status = HTTP_400
+        return {"status": "No request body provided"}
+    try:
+        items = body if isinstance(body, list) else list(read_ndjson(body))
+    except ValueError:
+        response.status = HTTP_400
+        return {"status": "Request body must be a JSON array or newline-delimited JSON"}
+
+    return {"results": [accept_item(pipeline, service_name, data, debug) for data in items]}
+
+
+@content_type('application/x-ndjson')
+def ndjson(content, **kwargs):
+    """Pass `NDJSONStream`s through to be streamed as the response body"""
+    return content
+
+
+def stream_results(pipeline, service_name, lines, debug=False):
+    """Accept alerts one line at a time, yielding a result for each"""
+    for line in lines:
+        try:
+            data = json.loads(line)
+        except ValueError:
+            yield {"status": "Malformed alert"}
+            continue
+        yield accept_item(pipeline, service_name, data, debug)
+
+
+@hug.post('/alerts/{service_name}/{token}/stream', output=ndjson)
+def incoming_stream(service_name: hug.types.text, token: hug.types.text, request, response, debug=False):
+    """A stream of incoming alerts for a service, as newline-delimited JSON (application/x-ndjson).
+
+    The request body is never held in memory: alerts are decoded and accepted one at a time as the
+    newline-delimited JSON results are read back, so memory use does not grow with the upload, and a
+    client that stops reading results stops its upload from being consumed."""
+    try:
+        validate(service_name, token)
+        pipeline = RULES.get_pipeline(service_name)
+    except (AuthorizationError, ServiceNotDefinedError) as error:
+        logging.exception('Failed to serve an alert stream response')
+        response.status = HTTP_500
+        return NDJSONStream([{"status": error.message}])
+
+    body = request.bounded_stream if request.content_length else request.stream
+    return NDJSONStream(stream_results(pipeline, service_name, read_lines(body), debug))
+
+
 @hug.post('/user/register')
 def register(response, body=None):
     """Register for Klaxer and get a key in return."""
@@ -72,10 +238,140 @@ def register(response, body=None):
 @hug.get('/user/me', requires=api_key_authentication)
 def profile(user: hug.directives.user, response, body=None):
     """If authenticated, give the user back their profile information."""
-    return user.to_dict()
+    return get_user(user.id).to_dict()
+
+
+@content_type('text/plain; version=0.0.4; charset=utf-8')
+def prometheus(content, **kwargs):
+    """Encode metrics already rendered in the Prometheus text format"""
+    return content.encode('utf-8')
+
+
+@hug.get('/metrics', output=prometheus)
+def metrics():
+    """Get the metrics of Klaxer in the Prometheus text format, for scraping."""
+    return METRICS.expose()
+
+
+@hug.get('/dedup', requires=api_key_authentication)
+def dedup_stats():
+    """Get the counters of the deduplication of repeated alerts."""
+    return DEDUP.stats() if DEDUP else {}
+
+
+@hug.get('/templates', requires=api_key_authentication)
+def templates(service: hug.types.text=None):
+    """List the message templates learned from incoming alerts, or only those of a service."""
+    return [template.to_dict() for template in TEMPLATES.list(service)]
+
+
+@hug.post('/snooze', requires=api_key_authentication)
+def snooze(response, body=None):
+    """Snooze the alerts of a service, optionally only those matching a severity, title, message and/or
+    message template, and optionally for a limited time (ttl, in seconds)."""
+    if not isinstance(body, dict) or not body.get('service') or not isinstance(body['service'], str):
+        response.status = HTTP_400
+        return {"status": "Please provide the service to snooze."}
+    try:
+        severity = parse_severity(body.get('severity'))
+        ttl = parse_ttl(body.get('ttl'))
+        template = parse_template(body.get('template'))
+    except ValueError as error:
+        response.status = HTTP_400
+        return {"status": str(error)}
+    entry = SNOOZES.add(body['service'], severity=severity, title=body.get('title'),
+                        message=body.get('message'), template=template, ttl=ttl)
+    return entry.to_dict()
+
+
+@hug.get('/snooze', requires=api_key_authentication)
+def snoozes():
+    """List the active snoozes."""
+    return [entry.to_dict() for entry in SNOOZES.list()]
+
+
+@hug.delete('/snooze', requires=api_key_authentication)
+def clear_snoozes(service: hug.types.text=None):
+    """Clear every snooze, or only those of a service."""
+    SNOOZES.clear(service)
+    return {"status": "ok"}
+
+
+@hug.delete('/snooze/{snooze_id}', requires=api_key_authentication)
+def unsnooze(snooze_id: hug.types.number, response):
+    """Clear a snooze."""
+    if not SNOOZES.remove(snooze_id):
+        response.status = HTTP_404
+        return {"status": f"No snooze {snooze_id}"}
+    return {"status": "ok"}
+
+
+@hug.post('/profiler', requires=api_key_authentication)
+def start_profiler(user: hug.directives.user, response, body=None):
+    """Start sampling the stacks of the request path, for `seconds` seconds and/or `requests` requests, every
+    `interval` seconds (all optional). Approved users only."""
+    if not user.approved:
+        response.status = HTTP_403
+        return {"status": "Only approved users can profile Klaxer"}
+    body = body or {}
+    try:
+        seconds = parse_option('seconds', body.get('seconds'))
+        requests = parse_option('requests', body.get('requests'), int)
+        interval = parse_option('interval', body.get('interval'))
+    except ValueError as error:
+        response.status = HTTP_400
+        return {"status": str(error)}
+    try:
+        return PROFILER.start(duration=seconds, requests=requests, interval=interval)
+    except ValueError as error:
+        response.status = HTTP_409
+        return {"status": str(error)}
+
+
+@hug.get('/profiler', requires=api_key_authentication, output=hug.output_format.text)
+def profiler_stacks(user: hug.directives.user, response):
+    """Get the stacks sampled by the profiler so far, in the collapsed format read by flamegraph.pl and
+    speedscope. Approved users only."""
+    if not user.approved:
+        response.status = HTTP_403
+        return "Only approved users can profile Klaxer"
+    return PROFILER.collapsed()
+
+
+@hug.delete('/profiler', requires=api_key_authentication)
+def stop_profiler(user: hug.directives.user, response):
+    """Stop the profiler early. Approved users only."""
+    if not user.approved:
+        response.status = HTTP_403
+        return {"status": "Only approved users can profile Klaxer"}
+    return PROFILER.stop()
+
+
+@hug.request_middleware()
+def profile_request(request, response):
+    """Let the profiler sample the request, if it is running."""
+    PROFILER.enter()
+
+
+@hug.response_middleware()
+def unprofile_request(request, response, resource):
+    """Stop sampling the request."""
+    PROFILER.leave()
+
+
+@hug.response_middleware()
+def release_session(request, response, resource):
+    """Release the database session used by a request."""
+    end_session()
 
 
 @hug.startup()
 def startup(api):
-    """Bootstrap the database when the API starts."""
-    bootstrap()
\ No newline at end of file
+    """Bootstrap the database, watch the rules, start delivery and replay undelivered alerts when the API
+    starts."""
+    bootstrap()
+    RULES.start()
+    DELIVERY.start()
+    DELIVERY.replay()
+    if DEDUP:
+        DEDUP.start(deliver_repeats)
\ No newline at end of file
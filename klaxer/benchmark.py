@@ -0,0 +1,357 @@
+"""Benchmark the alert pipeline!
+
+Generates rule configs and Sensu alert corpora, runs them through each stage
+of the pipeline and the `incoming` handler (with Slack stubbed out), and
+compares the results to a stored baseline.
+
+Usage: python -m klaxer.benchmark [--keywords 10 1000 10000] [--save]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import yaml
+
+# klaxer.api loads the rules on import, so point it at the generated config
+# before anything reads the config
+CONFIG_PATH = os.path.join(tempfile.mkdtemp(prefix='klaxer-benchmark-'), 'klaxer.yml')
+os.environ['KLAXER_CONFIG'] = CONFIG_PATH
+
+# pylint: disable=wrong-import-position
+from klaxer import config
+from klaxer.dedup import Deduplicator
+from klaxer.delivery import DeliveryQueue
+from klaxer.errors import NoRouteFoundError
+from klaxer.models import Alert, Severity
+from klaxer.rules import Rules
+from klaxer.snooze import SnoozeStore
+
+STAGES = ['from_service', 'classify', 'excluded', 'filtered', 'enrich', 'route', 'incoming']
+
+SEVERITIES = ['warning', 'error', 'ok']
+
+CHECKS = ['disk-usage', 'memory', 'load', 'http', 'ntp', 'swap', 'inodes', 'process']
+
+# Maps Sensu payloads onto alerts, as `models.transform_sensu` does
+SENSU_TRANSFORM = {
+    'title': 'attachments[0].title',
+    'message': 'attachments[0].text',
+    'username': 'username',
+    'icon_emoji': {'path': 'icon_emoji', 'default': None},
+    'icon_url': {'path': 'icon_url', 'default': None},
+    'target': {'path': 'channel', 'strip': '#'},
+}
+
+
+def generate_words(count, rng):
+    """Generate distinct lowercase words"""
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 10))))
+    return sorted(words)
+
+
+def generate_rules(services, keywords, rng):
+    """Generate a rule config for each service.
+
+    Each service gets `keywords` keywords, shared out between classification
+    (40%), exclusion (5%), enrichment (25%) and routing (30%) rules.
+
+    :returns: a mapping of service names to the keywords of each rule category,
+        and the config, as it would be loaded from klaxer.yml
+    """
+    vocabulary, cfg = {}, {}
+    for index, service in enumerate(services):
+        words = generate_words(keywords, rng)
+        rng.shuffle(words)
+        cut = [int(len(words) * share) for share in (0.4, 0.45, 0.7)]
+        levels, excluded = words[:cut[0]], words[cut[0]:cut[1]]
+        enriched, routed = words[cut[1]:cut[2]], words[cut[2]:] or words[:1]
+        vocabulary[service] = SimpleNamespace(levels=levels, excluded=excluded, enriched=enriched,
+                                              routed=routed)
+        cfg[service] = {
+            'description': f'Generated service {index}',
+            'transform': SENSU_TRANSFORM,
+            'message': {
+                'classification': {
+                    'CRITICAL': levels[0::3] + ['error'],
+                    'WARNING': levels[1::3] + ['warning'],
+                    'OK': levels[2::3],
+                },
+                'exclude': excluded,
+                'enrichments': [{'IF': word, 'THEN': f'{{}} (runbook: https://wiki.example.com/{word})'}
+                                for word in enriched],
+                'routes': [{'IF': word, 'THEN': f'team-{position % 10}'}
+                           for position, word in enumerate(routed)],
+            },
+            'title': {
+                'classification': {'CRITICAL': ['error'], 'WARNING': ['warning']},
+                'enrichments': [{'IF': 'example', 'THEN': '[{}]'}],
+            },
+        }
+    return vocabulary, cfg
+
+
+def generate_payload(words, rng):
+    """Generate a Sensu payload like those of `klaxer.simulator`, mentioning
+    some of a service's keywords"""
+    severity = rng.choice(SEVERITIES)
+    host = f'host{rng.randint(1, 50)}.example.com'
+    check = rng.choice(CHECKS)
+    mentions = []
+    # Most alerts have a route, some don't
+    if rng.random() < 0.95:
+        mentions.append(rng.choice(words.routed))
+    if words.levels and rng.random() < 0.5:
+        mentions.append(rng.choice(words.levels))
+    if words.enriched and rng.random() < 0.1:
+        mentions.append(rng.choice(words.enriched))
+    if words.excluded and rng.random() < 0.02:
+        mentions.append(rng.choice(words.excluded))
+    text = (f'Service/{check}: Check{check.title()} {severity.upper()}: / {rng.uniform(0, 100):.2f}% '
+            f'bytes usage ({rng.randint(1, 64)} GiB/{rng.randint(64, 128)} GiB) {" ".join(mentions)}\n'
+            f' : {host} : sensu-clients,testing,client:Service')
+    if rng.random() < 0.05:
+        # The occasional check with a long output
+        text += '\n' + ' '.join(generate_words(rng.randint(50, 200), rng))
+    return {
+        'channel': '#alerts',
+        'username': 'sensu',
+        'icon_emoji': ':skull:',
+        'attachments': [{
+            'title': f'{host} - {severity}',
+            'text': text,
+            'color': 'red' if severity == 'error' else 'yellow',
+        }],
+    }
+
+
+def generate_corpus(vocabulary, size, duplicates, rng):
+    """Generate a corpus of (service, payload) pairs.
+
+    :param duplicates: the share of the corpus repeating an earlier payload
+    """
+    services = sorted(vocabulary)
+    corpus = []
+    for _ in range(size):
+        if corpus and rng.random() < duplicates:
+            corpus.append(rng.choice(corpus))
+            continue
+        service = rng.choice(services)
+        corpus.append((service, generate_payload(vocabulary[service], rng)))
+    return corpus
+
+
+def generate_snoozes(vocabulary, rng):
+    """Generate a snooze store with a few snoozes per service"""
+    snoozes = SnoozeStore()
+    for service in vocabulary:
+        snoozes.add(service, severity=Severity.OK)
+        snoozes.add(service, title=f'host{rng.randint(1, 50)}.example.com - warning')
+    return snoozes
+
+
+def measure(func, items):
+    """Time a function on each item
+
+    :returns: the latency of each call, in nanoseconds
+    """
+    timer = time.perf_counter_ns
+    latencies = []
+    for item in items:
+        start = timer()
+        func(item)
+        latencies.append(timer() - start)
+    return latencies
+
+
+def summarize(latencies):
+    """Get the throughput and latency percentiles of a stage"""
+    ordered = sorted(latencies)
+    total = sum(ordered) or 1
+    return {
+        'ops_per_sec': round(len(ordered) * 1e9 / total, 1),
+        'p50_us': round(ordered[len(ordered) // 2] / 1000, 2),
+        'p99_us': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] / 1000, 2),
+    }
+
+
+def route(item):
+    pipeline, alert, hits = item
+    try:
+        pipeline.route(alert, hits)
+    except NoRouteFoundError:
+        pass
+
+
+def bench_pipeline(rules, snoozes, corpus, stages):
+    """Run each stage of the pipeline over the corpus
+
+    :returns: a mapping of stages to their latencies
+    """
+    results = {}
+    pipelines = {service: rules.get_pipeline(service) for service, _ in corpus}
+    if 'from_service' in stages:
+        results['from_service'] = measure(
+            lambda item: Alert.from_service(item[0], item[1], pipelines[item[0]].transform), corpus)
+
+    # Later stages get alerts in the state the previous stages leave them in
+    alerts = [(pipelines[service], Alert.from_service(service, payload, pipelines[service].transform))
+              for service, payload in corpus]
+    if 'classify' in stages:
+        results['classify'] = measure(lambda item: item[0].classify(item[1], item[0].scan(item[1])), alerts)
+    scanned = [(pipeline, pipeline.classify(alert, pipeline.scan(alert)), pipeline.scan(alert))
+               for pipeline, alert in alerts]
+    if 'excluded' in stages:
+        results['excluded'] = measure(lambda item: item[0].excluded(item[1], item[2]), scanned)
+    if 'filtered' in stages:
+        filters = [snoozes.is_snoozed]
+        results['filtered'] = measure(lambda item: any(rule(item[1]) for rule in filters), scanned)
+    if 'enrich' in stages:
+        results['enrich'] = measure(lambda item: item[0].enrich(item[1], item[2]), scanned)
+    if 'route' in stages:
+        results['route'] = measure(route, scanned)
+    return results
+
+
+def bench_incoming(rules, snoozes, corpus):
+    """Run the corpus through the `incoming` handler, with deliveries dropped
+    instead of sent to Slack
+
+    :returns: the latency of each request
+    """
+    from klaxer import api # pylint: disable=import-outside-toplevel
+    api.RULES.current = rules
+    api.DEDUP = Deduplicator() if config.DEDUP_WINDOW else None
+    api.CURRENT_FILTERS = [snoozes.is_snoozed]
+    delivery, api.DELIVERY = api.DELIVERY, DeliveryQueue(lambda alert: None, maxsize=len(corpus))
+    response = SimpleNamespace(status=None)
+    # Unroutable alerts are logged with their traceback, which would dominate the timings
+    logging.disable(logging.ERROR)
+    try:
+        return measure(lambda item: api.incoming(item[0], 'benchmark', response, body=item[1]), corpus)
+    finally:
+        logging.disable(logging.NOTSET)
+        api.DELIVERY.stop()
+        api.DELIVERY = delivery
+
+
+def run(args):
+    """Run the benchmarks
+
+    :returns: a mapping of "stage@keywords" to the summary of each benchmark
+    """
+    results = {}
+    for keywords in args.keywords:
+        rng = random.Random(args.seed)
+        services = [f'service{index}' for index in range(args.services)]
+        vocabulary, cfg = generate_rules(services, keywords, rng)
+        with open(CONFIG_PATH, 'w') as ymlfile:
+            yaml.safe_dump(cfg, ymlfile)
+        rules = Rules(CONFIG_PATH)
+        snoozes = generate_snoozes(vocabulary, rng)
+        corpus = generate_corpus(vocabulary, args.alerts, args.duplicates, rng) * args.rounds
+
+        latencies = bench_pipeline(rules, snoozes, corpus, args.stages)
+        if 'incoming' in args.stages:
+            latencies['incoming'] = bench_incoming(rules, snoozes, corpus)
+        for stage in STAGES:
+            if stage in latencies:
+                results[f'{stage}@{keywords}'] = summarize(latencies[stage])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Find the benchmarks that regressed from the baseline
+
+    A benchmark regresses when its throughput drops, or its median latency
+    grows, by more than `threshold` (a fraction).
+
+    :returns: a mapping of benchmark names to a description of the regression
+    """
+    regressions = {}
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        problems = []
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            problems.append(f'throughput {result["ops_per_sec"]:.0f}/s vs {base["ops_per_sec"]:.0f}/s')
+        if result['p50_us'] > base['p50_us'] * (1 + threshold):
+            problems.append(f'p50 {result["p50_us"]:.2f}us vs {base["p50_us"]:.2f}us')
+        if problems:
+            regressions[name] = ', '.join(problems)
+    return regressions
+
+
+def report(results, baseline, regressions):
+    """Print a table of the results"""
+    sys.stdout.write(f'{"benchmark":<24} {"ops/s":>12} {"p50 (us)":>10} {"p99 (us)":>10} '
+                     f'{"vs baseline":>12}\n')
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = f'{result["ops_per_sec"] / base["ops_per_sec"] - 1:+.1%}' if base else '-'
+        flag = '  REGRESSION' if name in regressions else ''
+        sys.stdout.write(f'{name:<24} {result["ops_per_sec"]:>12.0f} {result["p50_us"]:>10.2f} '
+                         f'{result["p99_us"]:>10.2f} {change:>12}{flag}\n')
+    for name, problem in regressions.items():
+        sys.stdout.write(f'Regression in {name}: {problem}\n')
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as basefile:
+            baseline = json.load(basefile)['results']
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.json:
+        json.dump({'results': results, 'regressions': regressions}, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        report(results, baseline, regressions)
+
+    if args.save:
+        with open(args.baseline, 'w') as basefile:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'args': {key: value for key, value in vars(args).items() if key not in ('save', 'json')},
+                'results': results,
+            }, basefile, indent=2)
+        sys.stdout.write(f'Saved the baseline to {args.baseline}\n')
+    sys.exit(1 if regressions else 0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the alert pipeline')
+    parser.add_argument('--keywords', nargs='+', default=[10, 1000, 10000], type=int,
+                        help='Numbers of rule keywords per service to benchmark with')
+    parser.add_argument('--services', default=20, type=int, help='Number of services')
+    parser.add_argument('--alerts', default=2000, type=int, help='Number of alerts in the corpus')
+    parser.add_argument('--duplicates', default=0.2, type=float,
+                        help='Share of repeated alerts in the corpus')
+    parser.add_argument('--rounds', default=3, type=int, help='Number of times the corpus is run')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='Stages to benchmark')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the generated rules and corpus')
+    parser.add_argument('--baseline', default='benchmark-baseline.json', help='Baseline file to compare with')
+    parser.add_argument('--threshold', default=0.2, type=float,
+                        help='Slowdown (as a fraction) flagged as a regression')
+    parser.add_argument('--save', default=False, action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--json', default=False, action='store_true', help='Print the results as JSON')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main()
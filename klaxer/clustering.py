@@ -0,0 +1,166 @@
+"""Clustering of alert messages into templates
+
+Messages from the same check usually differ only in their variable parts
+(numbers, hostnames, URLs...). Those are masked, and the masked messages are
+clustered into templates in the manner of Drain (He et al., "Drain: An
+Online Log Parsing Approach with Fixed Depth Tree"), so that alerts can be
+told apart by their template rather than their exact text.
+"""
+
+import itertools
+import re
+import threading
+from collections import OrderedDict
+
+from klaxer import config
+
+# The variable parts of a message, masked as <NAME>. Earlier patterns take
+# precedence, e.g. the numbers in a URL are masked along with the URL.
+MASKS = (
+    # Slack's URL markup (<http://url|url>) and bare URLs
+    ('URL', r'<(?:https?|mailto):[^>|]*(?:\|[^>]*)?>|https?://[^\s<>|]+'),
+    ('UUID', r'\b[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}\b'),
+    ('IP', r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'),
+    ('HOST', r'\b(?:[A-Za-z0-9](?:[A-Za-z0-9-]*[A-Za-z0-9])?\.)+[A-Za-z]{2,63}\b'),
+    ('HEX', r'\b(?:0x[0-9a-fA-F]+|[0-9a-fA-F]{16,})\b'),
+    ('NUM', r'[-+]?\d+(?:\.\d+)?'),
+)
+MASK_PATTERN = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in MASKS))
+MASK_TOKENS = {name: f'<{name}>' for name, _ in MASKS}
+
+# A position of a template where the messages of the cluster differ
+WILDCARD = '<*>'
+
+
+def mask(text):
+    """Mask the variable parts of a text in a single pass
+
+    :param text: The text to mask
+    :returns: str - The text with each variable part replaced by its kind,
+        e.g. "<NUM>% bytes usage" for "85.12% bytes usage"
+    """
+    return MASK_PATTERN.sub(lambda match: MASK_TOKENS[match.lastgroup], text)
+
+
+class Template:
+    """A cluster of similar messages"""
+    __slots__ = ('id', 'key', 'tokens', 'count')
+
+    def __init__(self, template_id, key, tokens):
+        self.id = template_id
+        self.key = key
+        self.tokens = tokens
+        self.count = 1
+
+    @property
+    def text(self):
+        return ' '.join(self.tokens)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'service': self.key[0],
+            'template': self.text,
+            'count': self.count,
+        }
+
+
+class TemplateMiner:
+    """Learns the message templates of each service as messages come in.
+
+    Masked messages are split into tokens and grouped by service, length and
+    their first `depth` tokens. Within a group, a message joins the most
+    similar template if at least `similarity` of its tokens match it, and
+    the positions where they differ become wildcards. Otherwise it starts a
+    new template.
+
+    Up to `size` templates are kept, and the least recently matched one is
+    forgotten to make room for a new one.
+    """
+
+    def __init__(self, similarity=config.TEMPLATE_SIMILARITY, depth=config.TEMPLATE_DEPTH,
+                 size=config.TEMPLATE_MAX_TEMPLATES):
+        self.similarity = similarity
+        self.depth = depth
+        self.size = size
+        self._groups = {}
+        self._templates = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _key(self, service, tokens):
+        # Masked tokens vary between messages, so they must not split groups
+        prefix = tuple(WILDCARD if '<' in token else token for token in tokens[:self.depth])
+        return (service.lower(), len(tokens), prefix)
+
+    @staticmethod
+    def _score(template, tokens):
+        """The share of the message's tokens matching the template"""
+        if not tokens:
+            return 1.0
+        matches = sum(1 for expected, token in zip(template.tokens, tokens) if expected == token)
+        return matches / len(tokens)
+
+    def match(self, service, text, learn=True):
+        """Find the template of a message
+
+        :param service: The name of the service that sent the message
+        :param text: The message
+        :param learn: Whether to update the templates with the message. If
+            not, a message matching no template is not added either.
+        :returns: Template - The template of the message, or None if it
+            matches none and `learn` is not set
+        """
+        tokens = mask(text).split()
+        key = self._key(service, tokens)
+        with self._lock:
+            best, best_score = None, -1
+            for template in self._groups.get(key, ()):
+                score = self._score(template, tokens)
+                if score > best_score:
+                    best, best_score = template, score
+
+            if best is not None and best_score >= self.similarity:
+                if learn:
+                    best.tokens = [expected if expected == token else WILDCARD
+                                   for expected, token in zip(best.tokens, tokens)]
+                    best.count += 1
+                    self._templates.move_to_end(best.id)
+                return best
+
+            if not learn:
+                return None
+            template = Template(next(self._ids), key, tokens)
+            self._groups.setdefault(key, []).append(template)
+            self._templates[template.id] = template
+            if len(self._templates) > self.size:
+                self._forget(self._templates.popitem(last=False)[1])
+            return template
+
+    def _forget(self, template):
+        """Drop a template from its group. Must be called with the lock held."""
+        group = self._groups[template.key]
+        group.remove(template)
+        if not group:
+            del self._groups[template.key]
+
+    def get(self, template_id):
+        """Get a template by its ID
+
+        :returns: Template - The template, or None if it is unknown
+        """
+        return self._templates.get(template_id)
+
+    def list(self, service=None):
+        """Get the known templates, or only those of a service
+
+        :returns: list - The templates, least recently matched first
+        """
+        with self._lock:
+            templates = list(self._templates.values())
+        if service is None:
+            return templates
+        return [template for template in templates if template.key[0] == service.lower()]
+
+
+TEMPLATES = TemplateMiner()
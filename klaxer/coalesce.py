@@ -0,0 +1,159 @@
+"""Coalescing of alert bursts into digests"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from klaxer import config
+from klaxer.models import Digest, Severity
+
+
+class Coalescer:
+    """Buffers alerts per target channel and releases them in batches.
+
+    A channel's buffer is flushed `window` seconds after its first alert
+    arrives, as soon as it holds `max_batch` alerts, or, if `flush_critical`
+    is set, as soon as a CRITICAL alert arrives. A buffer holding a single
+    alert is released as that alert; larger ones are released as a `Digest`.
+    However many alerts come in, a channel gets at most one message per
+    window unless its batches fill up.
+    """
+
+    def __init__(self, window=config.COALESCE_WINDOW, max_batch=config.COALESCE_MAX_BATCH,
+                 flush_critical=config.COALESCE_FLUSH_CRITICAL):
+        self.window = window
+        self.max_batch = max_batch
+        self.flush_critical = flush_critical
+        self._emit = None
+        self._buffers = {}
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._releasing = set()
+        self._overdue = set()
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def start(self, emit):
+        """Start flushing buffers.
+
+        :param emit: the callable receiving each released alert or `Digest`.
+            It returns whether it took the batch; a batch it could not take
+            (e.g. because the delivery queue is full) is kept and released
+            again with the channel's next flush.
+        """
+        with self._cond:
+            if self._thread:
+                return
+            self._emit = emit
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, daemon=True, name='klaxer-coalesce')
+            self._thread.start()
+
+    def close(self):
+        """Flush every buffer and stop"""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._closed = True
+            batches = [self._take(target) for target in list(self._buffers)]
+            self._cond.notify()
+        for batch in batches:
+            if batch:
+                self._release(*batch)
+        if thread:
+            thread.join()
+
+    def put(self, alert):
+        """Buffer an alert until its channel is flushed.
+
+        :param alert: the routed alert to buffer
+        """
+        batch = None
+        with self._cond:
+            buffer = self._buffers.get(alert.target)
+            if buffer is None:
+                buffer = self._buffers[alert.target] = []
+                self._schedule(alert.target, buffer)
+            buffer.append(alert)
+            if len(buffer) >= self.max_batch or (self.flush_critical and alert.severity == Severity.CRITICAL):
+                batch = self._take(alert.target)
+        if batch:
+            self._release(*batch)
+
+    @property
+    def depth(self):
+        """The number of alerts waiting to be flushed"""
+        return sum(len(buffer) for buffer in list(self._buffers.values()))
+
+    def _schedule(self, target, buffer):
+        """Flush a new buffer once its window closes. Must be called with the lock held."""
+        deadline = time.monotonic() + self.window
+        heapq.heappush(self._deadlines, (deadline, next(self._sequence), target, buffer))
+        self._cond.notify()
+
+    def _take(self, target):
+        """Take a channel's buffer to release it. Must be called with the lock held.
+
+        Only one batch per channel is released at a time, so that batches
+        for a channel are released in order. While one is, the channel is
+        marked overdue and flushed again once it is out.
+
+        :returns: a (target, alerts) batch, or None if there is nothing to release now
+        """
+        if target in self._releasing:
+            self._overdue.add(target)
+            return None
+        alerts = self._buffers.pop(target, None)
+        if not alerts:
+            return None
+        self._releasing.add(target)
+        self._overdue.discard(target)
+        return target, alerts
+
+    def _release(self, target, alerts):
+        """Emit a batch. Must be called without the lock held, as emitting
+        may wait for room in the delivery queue."""
+        while True:
+            emitted = self._emit(alerts[0] if len(alerts) == 1 else Digest(target, alerts))
+            with self._cond:
+                self._releasing.discard(target)
+                buffer = self._buffers.get(target)
+                if not emitted:
+                    # Keep the batch, ahead of anything buffered since, for the next flush
+                    if buffer is None:
+                        self._buffers[target] = alerts
+                        self._schedule(target, alerts)
+                    else:
+                        buffer[:0] = alerts
+                    logging.warning('Delivery queue full, holding %d alerts for %s', len(alerts), target)
+                    return
+                if not buffer or not (target in self._overdue or len(buffer) >= self.max_batch or
+                                      (self.flush_critical and any(alert.severity == Severity.CRITICAL
+                                                                   for alert in buffer))):
+                    self._overdue.discard(target)
+                    return
+                target, alerts = self._take(target)
+
+    def _run(self):
+        """Flush buffers as their windows close, until closed"""
+        while True:
+            with self._cond:
+                batch = None
+                while batch is None and not self._closed:
+                    if not self._deadlines:
+                        self._cond.wait()
+                        continue
+                    deadline, _, target, buffer = self._deadlines[0]
+                    wait = deadline - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    heapq.heappop(self._deadlines)
+                    # Skip buffers that were already flushed early
+                    if self._buffers.get(target) is buffer:
+                        batch = self._take(target)
+                if batch is None:
+                    return
+            self._release(*batch)
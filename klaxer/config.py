@@ -21,12 +21,130 @@ ROUTES = [
     ('apitests', lambda x: x.service == 'sensu'),
 ]
 
+# The service definitions. The file is watched every RULES_RELOAD_INTERVAL
+# seconds and reloaded when it changes. Set the interval to 0 to disable this.
+RULES_PATH = os.environ.get('KLAXER_CONFIG', 'config/klaxer.yml')
+RULES_RELOAD_INTERVAL = 5
+
 SLACK_TOKEN = os.environ.get('KLAXER_TOKEN')
+
+# Where Slack API calls are sent, e.g. a fake Slack (see klaxer.fakeslack). The
+# method name is appended to it, so it is normalized to end in a single slash.
+SLACK_API_URL = os.environ.get('KLAXER_SLACK_API_URL', 'https://slack.com/api/').rstrip('/') + '/'
 SLACK_SIMULATOR_CHANNEL='#klaxer-test'
 
 # Every 5 minutes
 WINDOW = 60 * 5
 
+# Slack API rate limits, as (calls per second, burst). Method limits follow
+# Slack's rate limit tiers. The channel limit applies to every message posted,
+# updated or deleted in a channel.
+SLACK_METHOD_LIMITS = {
+    'channels.list': (20 / 60, 5),
+    'channels.history': (50 / 60, 10),
+    'chat.update': (50 / 60, 10),
+    'chat.delete': (50 / 60, 10),
+}
+SLACK_CHANNEL_LIMIT = (1, 4)
+
+# Throttled or failed Slack API calls are retried up to SLACK_RETRY_ATTEMPTS
+# times in total, backing off exponentially from SLACK_RETRY_BACKOFF seconds
+# (or as long as Slack asks), but waiting no longer than SLACK_RETRY_MAX_DELAY
+# seconds overall
+SLACK_RETRY_ATTEMPTS = 5
+SLACK_RETRY_BACKOFF = 1
+SLACK_RETRY_MAX_DELAY = 60
+
+# How long (in seconds) the Slack channel listing is cached, and how long a
+# channel name that could not be found is remembered as missing
+CHANNEL_CACHE_TTL = 60 * 10
+CHANNEL_MISS_TTL = 60
+
+# How long (in seconds) the record of the last alert posted to a channel is
+# trusted before the channel history is consulted again
+LAST_MESSAGE_TTL = 60 * 5
+
+# How duplicate alerts are rolled up: 'update' edits the last message in place
+# while it is still the latest in the channel, 'repost' posts a new message and
+# deletes the old one
+ROLLUP_MODE = 'update'
+
+# Whether an alert also rolls up into the last message of its channel when
+# both have the same title, message template and severity, rather than only
+# when their text is identical. Off by default, as the rolled up message only
+# shows the text of the latest alert, e.g. the readings of the latest host
+ROLLUP_BY_TEMPLATE = False
+
+# How long (in seconds) a message is assumed to still be the latest in its
+# channel before that is checked against the channel history
+ROLLUP_TRUST_WINDOW = 30
+
+# Outbound delivery: the number of worker threads sending alerts to Slack, how
+# many alerts each worker may hold, and how long (in seconds) an incoming
+# request waits for room in a full queue before being rejected
+DELIVERY_WORKERS = 4
+DELIVERY_QUEUE_SIZE = 1000
+DELIVERY_QUEUE_TIMEOUT = 1
+
+# A delivery that fails for any reason other than a missing channel is retried
+# by its worker up to DELIVERY_RETRY_ATTEMPTS times in total, backing off
+# exponentially from DELIVERY_RETRY_BACKOFF seconds up to
+# DELIVERY_RETRY_MAX_DELAY seconds between tries. Alerts that still fail stay
+# spooled and are replayed on the next startup.
+DELIVERY_RETRY_ATTEMPTS = 3
+DELIVERY_RETRY_BACKOFF = 1
+DELIVERY_RETRY_MAX_DELAY = 30
+
+# Alerts bound for the same channel within COALESCE_WINDOW seconds are
+# delivered together as one digest message of up to COALESCE_MAX_BATCH alerts.
+# A CRITICAL alert flushes its channel immediately if COALESCE_FLUSH_CRITICAL is
+# set. Set the window to 0 to deliver every alert on its own.
+COALESCE_WINDOW = 2
+COALESCE_MAX_BATCH = 50
+COALESCE_FLUSH_CRITICAL = True
+
+# Alert messages are clustered into templates per service, with numbers,
+# hostnames, URLs and IDs masked. A message joins a template when at least
+# TEMPLATE_SIMILARITY of its words match it. Messages are only compared to
+# templates with the same first TEMPLATE_DEPTH words. Up to
+# TEMPLATE_MAX_TEMPLATES templates are kept, least recently seen forgotten
+# first.
+TEMPLATE_SIMILARITY = 0.5
+TEMPLATE_DEPTH = 2
+TEMPLATE_MAX_TEMPLATES = 5000
+
+# Repeats of an alert within DEDUP_WINDOW seconds of its first delivery are
+# absorbed before they reach Slack. Alerts are told apart by the values of
+# DEDUP_FIELDS. Replace 'message' with 'template', the message template of the
+# alert, to also absorb alerts whose messages only differ in their readings.
+# With DEDUP_MODE 'suppress' repeats are dropped; with 'aggregate' the last
+# repeat is delivered when the window closes, counting them all. Up to
+# DEDUP_MAX_ENTRIES alerts are remembered, least recently seen evicted first.
+# The window is 0 by default, which delivers every alert; set it to e.g. 60 to
+# turn deduplication on.
+DEDUP_FIELDS = ('service', 'severity', 'title', 'message', 'target')
+DEDUP_WINDOW = 0
+DEDUP_MODE = 'aggregate'
+DEDUP_MAX_ENTRIES = 10000
+
+# Upper bounds (in seconds) of the buckets of the latency histograms exposed
+# at /metrics
+METRICS_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# The sampling profiler samples the stacks of the request path every
+# PROFILER_INTERVAL seconds, for PROFILER_MAX_DURATION seconds at most
+PROFILER_INTERVAL = 0.005
+PROFILER_MAX_DURATION = 300
+
+# Accepted alerts are spooled to disk until they are delivered, and replayed
+# on startup. Set the path to None to disable the spool. Once the spool grows
+# past its cap (in bytes), new alerts are rejected. Acknowledged alerts are
+# compacted away every SPOOL_COMPACT_INTERVAL seconds.
+SPOOL_PATH = 'klaxer.spool'
+SPOOL_MAX_BYTES = 256 * 1024 * 1024
+SPOOL_COMPACT_INTERVAL = 30
+
 # Database: Accepts postgresql or sqlite, default is sqlite
 DB_CONNECTION = 'sqlite'
 #DB_CONNECTION = 'postgresql'
@@ -36,6 +154,27 @@ DB_CONNECTION = 'sqlite'
 #POSTGRE_PASS = ''
 #POSTGRE_HOST = '127.0.0.1'
 
+# PostgreSQL connection pool: connections kept open, extra connections allowed
+# under load, and how long (in seconds) a connection is reused
+DB_POOL_SIZE = 10
+DB_POOL_OVERFLOW = 20
+DB_POOL_RECYCLE = 60 * 30
+
+# How long (in seconds) SQLite waits for another writer before giving up
+SQLITE_BUSY_TIMEOUT = 15
+
+
+# Snoozes with a TTL are expired by a timing wheel of SNOOZE_SLOTS slots,
+# SNOOZE_TICK seconds apart
+SNOOZE_TICK = 1
+SNOOZE_SLOTS = 3600
+
+# Verified API keys are cached for API_KEY_CACHE_TTL seconds, up to
+# API_KEY_CACHE_SIZE keys. The calls they make are counted in memory and
+# written to the database every CALL_FLUSH_INTERVAL seconds.
+API_KEY_CACHE_SIZE = 1024
+API_KEY_CACHE_TTL = 60
+CALL_FLUSH_INTERVAL = 10
 
 # Messages
 MSG_WELCOME = 'Welcome to Klaxer! Let staff know if you have any issues.'
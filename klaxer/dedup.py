@@ -0,0 +1,200 @@
+"""Deduplication of repeated alerts before delivery"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from klaxer import config
+from klaxer.models import fingerprint
+
+
+class Seen:
+    """The occurrences of an alert fingerprint"""
+    __slots__ = ('first_seen', 'last_seen', 'count', 'window_start', 'absorbed', 'latest')
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.count = 1
+        self.window_start = now
+        self.absorbed = 0
+        # The last repeat absorbed in the current window
+        self.latest = None
+
+    def to_dict(self):
+        return {
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'count': self.count,
+        }
+
+
+class Deduplicator:
+    """Absorbs repeats of an alert within a time window.
+
+    The first alert with a given fingerprint opens a window of `window`
+    seconds, and every repeat arriving within it is absorbed. With the
+    'suppress' mode absorbed repeats are simply dropped; with the 'aggregate'
+    mode the last repeat is released when the window closes, carrying the
+    number of repeats it stands for in its `count`. Until `start` is called,
+    they are counted on the first alert delivered after the window instead.
+
+    Up to `size` fingerprints are remembered, and the least recently seen
+    one is evicted to make room for a new one.
+    """
+
+    def __init__(self, fields=config.DEDUP_FIELDS, window=config.DEDUP_WINDOW, mode=config.DEDUP_MODE,
+                 size=config.DEDUP_MAX_ENTRIES):
+        if mode not in ('suppress', 'aggregate'):
+            raise ValueError(f'Unknown dedup mode {mode}')
+        self.fields = fields
+        self.window = window
+        self.mode = mode
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._emit = None
+        self._deadlines = []
+        self._sequence = itertools.count()
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def start(self, emit):
+        """Start releasing aggregated repeats as their windows close. Does
+        nothing in the 'suppress' mode.
+
+        :param emit: the callable receiving the last repeat of each window,
+            with the number of repeats absorbed in its `count`
+        """
+        with self._cond:
+            if self._thread or self.mode != 'aggregate':
+                return
+            self._emit = emit
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, daemon=True, name='klaxer-dedup')
+            self._thread.start()
+
+    def close(self):
+        """Release the repeats of every open window and stop"""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._closed = True
+            releases = [self._take(entry) for entry in self._entries.values()] if thread else []
+            self._deadlines = []
+            self._cond.notify()
+        for alert in releases:
+            if alert:
+                self._emit(alert)
+        if thread:
+            thread.join()
+
+    def _fingerprint(self, alert):
+        # Alerts cache their fingerprint over the default fields
+        if self.fields == config.DEDUP_FIELDS:
+            return alert.fingerprint
+        return fingerprint(alert, self.fields)
+
+    def check(self, alert):
+        """Record an occurrence of an alert.
+
+        :param alert: the alert to record
+        :returns: whether the alert repeats one seen within the window, and
+            should not be delivered
+        """
+        key = self._fingerprint(alert)
+        now = time.monotonic()
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                entry = self._entries[key] = Seen(now)
+                self._schedule(entry)
+                if len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+                return False
+
+            self._entries.move_to_end(key)
+            entry.last_seen = now
+            entry.count += 1
+            if now - entry.window_start < self.window:
+                self.hits += 1
+                entry.absorbed += 1
+                entry.latest = alert
+                return True
+
+            # The window is over, but its repeats have not been released yet:
+            # count them on this alert and open a new window
+            self.misses += 1
+            if self.mode == 'aggregate' and entry.absorbed:
+                alert.count = entry.absorbed + 1
+            entry.window_start = now
+            entry.absorbed = 0
+            entry.latest = None
+            self._schedule(entry)
+            return False
+
+    def _schedule(self, entry):
+        """Release the repeats of a new window once it closes. Must be called with the lock held."""
+        if self._thread:
+            heapq.heappush(self._deadlines, (entry.window_start + self.window, next(self._sequence), entry,
+                                             entry.window_start))
+            self._cond.notify()
+
+    def _take(self, entry):
+        """Take the repeats absorbed in an entry's window. Must be called with the lock held.
+
+        :returns: the last repeat, counting all of them, or None if none were absorbed
+        """
+        alert, entry.latest = entry.latest, None
+        if alert is not None:
+            alert.count = entry.absorbed
+            entry.absorbed = 0
+        return alert
+
+    def _run(self):
+        """Release the repeats of windows as they close, until closed"""
+        while True:
+            with self._cond:
+                alert = None
+                while alert is None and not self._closed:
+                    if not self._deadlines:
+                        self._cond.wait()
+                        continue
+                    deadline, _, entry, window_start = self._deadlines[0]
+                    wait = deadline - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    heapq.heappop(self._deadlines)
+                    # Skip windows whose repeats were already counted on a later alert
+                    if entry.window_start == window_start:
+                        alert = self._take(entry)
+                if alert is None:
+                    return
+            self._emit(alert)
+
+    def get(self, alert):
+        """Get the occurrences of an alert's fingerprint.
+
+        :returns: the `Seen` record of the fingerprint, or None if it is not remembered
+        """
+        return self._entries.get(self._fingerprint(alert))
+
+    def stats(self):
+        """Get the counters of the deduplicator.
+
+        :returns: a dict of hits (absorbed repeats), misses (delivered alerts),
+            evictions and the number of remembered fingerprints
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+        }
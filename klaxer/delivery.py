@@ -0,0 +1,214 @@
+"""Asynchronous delivery of processed alerts"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from klaxer import config
+from klaxer.errors import ChannelNotFoundError, DeliveryQueueFullError
+from klaxer.metrics import METRICS, count_alert
+from klaxer.models import Digest
+from klaxer.profiler import PROFILER
+
+# Sentinel telling a worker to exit
+_STOP = object()
+
+
+class DeliveryQueue:
+    """Hands alerts off to a pool of worker threads that send them.
+
+    Each worker drains its own queue, and every alert for a given target is
+    placed on the same worker's queue, so alerts to a channel are delivered
+    in the order they were accepted.
+
+    When a spool is given, alerts are written to it before they are queued
+    and acknowledged once they have been handled, so that anything still in
+    flight when the process dies can be replayed.
+
+    When a coalescer is given, spooled alerts are buffered by it and the
+    workers receive its batches, either single alerts or `Digest`s.
+    """
+
+    def __init__(self, send, spool=None, coalescer=None, workers=config.DELIVERY_WORKERS,
+                 maxsize=config.DELIVERY_QUEUE_SIZE, timeout=config.DELIVERY_QUEUE_TIMEOUT,
+                 attempts=config.DELIVERY_RETRY_ATTEMPTS, backoff=config.DELIVERY_RETRY_BACKOFF,
+                 max_delay=config.DELIVERY_RETRY_MAX_DELAY):
+        """Initialize the queue. Workers are started on first use.
+
+        :param send: the callable delivering a single alert or `Digest`
+        :param spool: (optional) the `Spool` recording accepted alerts
+        :param coalescer: (optional) the `Coalescer` batching alerts per channel
+        :param workers: the number of worker threads
+        :param maxsize: the number of alerts each worker may hold
+        :param timeout: how long `put` waits for room in a full queue
+        :param attempts: how many times a failing delivery is tried
+        :param backoff: the delay before the first retry, doubled for each one after
+        :param max_delay: the longest delay between two tries
+        """
+        self.send = send
+        self.spool = spool
+        self.coalescer = coalescer
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self._queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads, if they are not already running"""
+        with self._lock:
+            if self._threads:
+                return
+            if self.spool:
+                self.spool.open()
+            for index, work in enumerate(self._queues):
+                thread = threading.Thread(target=self._work, args=(work,), daemon=True,
+                                          name=f'klaxer-delivery-{index}')
+                thread.start()
+                self._threads.append(thread)
+            if self.coalescer:
+                self.coalescer.start(self._hand_off)
+            atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        """Flush the coalescer and let the workers drain their queues, then
+        stop them.
+
+        :param timeout: (optional) how long to wait for each worker
+        """
+        if self.coalescer:
+            self.coalescer.close()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for work in self._queues[:len(threads)]:
+            work.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def put(self, alert):
+        """Queue an alert for delivery.
+
+        :param alert: the routed alert to deliver
+        :returns: the ID of the queued alert
+        :raises DeliveryQueueFullError: if the alert's queue stays full for
+            longer than the timeout, or with a coalescer, if it is full
+        :raises SpoolFullError: if the spool has reached its size cap
+        :raises SpoolUnavailableError: if the spool could not be written
+        """
+        if not self._threads:
+            self.start()
+        work = self._queues[hash(alert.target) % len(self._queues)]
+        if self.coalescer and work.full():
+            # Buffering never blocks, so push back on the client here rather
+            # than letting the coalescer hold an ever growing backlog
+            raise DeliveryQueueFullError()
+        if self.spool:
+            self.spool.append(alert)
+        if self.coalescer:
+            self.coalescer.put(alert)
+            return alert.id
+        try:
+            work.put(alert, timeout=self.timeout)
+        except queue.Full:
+            # The client is told to retry, so don't replay it as well
+            if self.spool:
+                self.spool.ack(alert.id)
+            raise DeliveryQueueFullError()
+        return alert.id
+
+    def replay(self):
+        """Queue the spooled alerts that were never acknowledged.
+
+        Replayed alerts wait for room in the queue rather than being rejected.
+
+        :returns: the number of replayed alerts
+        """
+        if not self.spool:
+            return 0
+        self.start()
+        alerts = self.spool.pending()
+        for alert in alerts:
+            self._enqueue(alert)
+        if alerts:
+            logging.info('Replayed %d undelivered alerts from the spool', len(alerts))
+        return len(alerts)
+
+    @property
+    def depth(self):
+        """The number of alerts or digests waiting to be delivered"""
+        depth = sum(work.qsize() for work in self._queues)
+        if self.coalescer:
+            depth += self.coalescer.depth
+        return depth
+
+    def _enqueue(self, item):
+        """Queue an alert or `Digest` that is already spooled, waiting for room if needed"""
+        self._queues[hash(item.target) % len(self._queues)].put(item)
+
+    def _hand_off(self, item):
+        """Queue a batch released by the coalescer, waiting at most the timeout for room
+
+        :returns: whether the batch was queued
+        """
+        try:
+            self._queues[hash(item.target) % len(self._queues)].put(item, timeout=self.timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def _ack(self, item):
+        if self.spool:
+            for alert in item.alerts if isinstance(item, Digest) else [item]:
+                self.spool.ack(alert.id)
+
+    def _send(self, item, service):
+        """Send an alert or `Digest`, retrying with backoff if it fails.
+
+        Retries hold up the worker, so that alerts to a channel stay in order
+        and a failing Slack pushes back on incoming requests through the
+        queue filling up.
+
+        :param service: the service to time the send against
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                with METRICS.timer('klaxer_stage_seconds', (service, 'send')):
+                    return self.send(item)
+            except Exception: # pylint: disable=broad-except
+                if attempt >= self.attempts:
+                    raise
+                delay = min(self.backoff * 2 ** (attempt - 1), self.max_delay)
+                logging.warning('Failed to deliver %s, retrying in %.1fs', item.id, delay, exc_info=True)
+                time.sleep(delay)
+
+    def _work(self, work):
+        """Deliver alerts and digests from a queue until told to stop"""
+        while True:
+            alert = work.get()
+            alerts = []
+            outcome = 'failed'
+            try:
+                if alert is _STOP:
+                    return
+                alerts = alert.alerts if isinstance(alert, Digest) else [alert]
+                # A digest is timed as a single send, against the service of its first alert
+                PROFILER.enter(request=False)
+                self._send(alert, alerts[0].service)
+                self._ack(alert)
+                outcome = 'delivered'
+            except ChannelNotFoundError:
+                # Retrying will not help, so don't replay it
+                logging.exception('Failed to deliver alert %s', alert.id)
+                self._ack(alert)
+            except Exception: # pylint: disable=broad-except
+                # Left in the spool, so it will be replayed on the next startup
+                logging.exception('Failed to deliver alert %s', alert.id)
+            finally:
+                PROFILER.leave()
+                for delivered in alerts:
+                    count_alert(delivered, outcome)
+                work.task_done()
@@ -6,14 +6,30 @@ class AuthorizationError(BaseException):
 class NoRouteFoundError(BaseException):
     message = "No alert route found"
 
+class MalformedAlertError(BaseException):
+    message = "Malformed alert"
+
 class ChannelNotFoundError(BaseException):
-    message = "Could not authorize user"
+    def __init__(self, channel):
+        self.message = f"Channel {channel} is not an available channel"
 
 class ServiceNotDefinedError(BaseException):
     def __init__(self, message):
         self.message = f"No rules defined for service: {message}"
 
+class TransformerNotDefinedError(BaseException):
+    def __init__(self, service):
+        self.message = f"No transformer defined for service: {service}"
+
 class ConfigurationError(BaseException):
     def __init__(self, msg):
         self.message = msg
 
+class DeliveryQueueFullError(BaseException):
+    message = "Alert delivery queue is full"
+
+class SpoolFullError(BaseException):
+    message = "Alert spool is full"
+
+class SpoolUnavailableError(BaseException):
+    message = "Alert spool could not be written"
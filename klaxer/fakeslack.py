@@ -0,0 +1,313 @@
+"""A fake Slack API for testing and benchmarking delivery without a network
+
+Point Klaxer at it by setting `SLACK_API_URL` (or the KLAXER_SLACK_API_URL
+environment variable) to its URL, e.g. in-process:
+
+    with FakeSlack(channels=['alerts'], latency=0.05) as slack:
+        config.SLACK_API_URL = slack.url
+        ...
+        print(slack.calls)
+
+or standalone: python -m klaxer.fakeslack --port 8099
+"""
+
+import argparse
+import itertools
+import json
+import math
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from klaxer import config
+
+Call = namedtuple('Call', ['method', 'params', 'status', 'error', 'time'])
+
+
+class SlackError(Exception):
+    """A call Slack answers with ok: false"""
+
+
+class FakeSlack:
+    """An in-process fake of the Slack Web API methods Klaxer uses:
+    channels.list, channels.history, chat.postMessage, chat.update,
+    chat.delete, as well as api.test and auth.test.
+
+    Every call is recorded in `calls`. Faults can be injected:
+
+    - `latency`: seconds (or a (min, max) range) every call takes
+    - `limits`: per-method (rate, burst) limits. Calls beyond them are
+      answered with HTTP 429 and a Retry-After header, as Slack does.
+    - `error_rate`: the share of calls failing with HTTP 500
+    - `fail()`: fail the next calls to a method with a given status or error
+    """
+
+    def __init__(self, channels=('general',), latency=0, limits=None, error_rate=0, host='127.0.0.1', port=0,
+                 seed=None):
+        self.latency = latency
+        self.limits = limits or {}
+        self.error_rate = error_rate
+        self.calls = []
+        self.channels = {}
+        self._address = (host, port)
+        self._server = None
+        self._thread = None
+        self._rng = random.Random(seed)
+        self._clock = itertools.count(1)
+        self._failures = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        for name in channels:
+            self.add_channel(name)
+
+    @property
+    def url(self):
+        """The base URL of the API, to use as `SLACK_API_URL`"""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api/'
+
+    def start(self):
+        """Start serving in a background thread
+
+        :returns: the base URL of the API
+        """
+        if not self._server:
+            self._server = ThreadingHTTPServer(self._address, _handler(self))
+            self._server.daemon_threads = True
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name='fake-slack')
+            self._thread.start()
+        return self.url
+
+    def stop(self):
+        """Stop serving"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_channel(self, name):
+        """Create a channel
+
+        :returns: the ID of the channel
+        """
+        with self._lock:
+            channel_id = f'C{len(self.channels) + 1:08d}'
+            self.channels[channel_id] = {'id': channel_id, 'name': name, 'messages': []}
+        return channel_id
+
+    def messages(self, name):
+        """Get the messages of a channel, oldest first"""
+        for channel in self.channels.values():
+            if channel['name'] == name:
+                return list(channel['messages'])
+        raise KeyError(name)
+
+    def fail(self, method, status=500, error=None, count=1):
+        """Fail the next calls to a method.
+
+        :param method: the API method, e.g. 'chat.update'
+        :param status: the HTTP status to answer with
+        :param error: (optional) answer with HTTP 200 and this Slack error
+            (e.g. 'message_not_found') instead
+        :param count: how many calls to fail
+        """
+        with self._lock:
+            self._failures.setdefault(method, []).extend([(status, error)] * count)
+
+    def count(self, method=None):
+        """Count the recorded calls, or only those to a method"""
+        return sum(1 for call in self.calls if method is None or call.method == method)
+
+    def reset(self):
+        """Forget the recorded calls and pending failures"""
+        with self._lock:
+            self.calls = []
+            self._failures = {}
+
+    def _throttle(self, method):
+        """Take a token from the method's bucket
+
+        :returns: how long (in seconds) to retry after, or 0 if the call may proceed
+        """
+        if method not in self.limits:
+            return 0
+        rate, burst = self.limits[method]
+        now = time.monotonic()
+        tokens, stamp = self._buckets.get(method, (burst, now))
+        tokens = min(burst, tokens + (now - stamp) * rate)
+        if tokens < 1:
+            self._buckets[method] = (tokens, now)
+            return (1 - tokens) / rate
+        self._buckets[method] = (tokens - 1, now)
+        return 0
+
+    def handle(self, method, params):
+        """Answer a call
+
+        :returns: the HTTP status, headers and JSON body of the response
+        """
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = self._rng.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+        with self._lock:
+            status, headers, body, error = 200, {}, None, None
+            failures = self._failures.get(method)
+            retry_after = self._throttle(method)
+            if failures:
+                status, error = failures.pop(0)
+                if error:
+                    status, body = 200, {'ok': False, 'error': error}
+            elif retry_after:
+                status, headers = 429, {'Retry-After': str(math.ceil(retry_after))}
+            elif self.error_rate and self._rng.random() < self.error_rate:
+                status = 500
+            else:
+                try:
+                    body = dict(self._dispatch(method, params), ok=True)
+                except SlackError as slack_error:
+                    error = str(slack_error)
+                    body = {'ok': False, 'error': error}
+            if status != 200:
+                body = {'ok': False, 'error': error or 'fake_slack_error'}
+            self.calls.append(Call(method, params, status, (body or {}).get('error'), time.time()))
+        return status, headers, body
+
+    def _channel(self, params):
+        channel = self.channels.get(params.get('channel'))
+        if channel is None:
+            raise SlackError('channel_not_found')
+        return channel
+
+    def _message(self, channel, ts):
+        for message in channel['messages']:
+            if message['ts'] == ts:
+                return message
+        raise SlackError('message_not_found')
+
+    def _dispatch(self, method, params):
+        """Apply a call to the fake workspace. Must be called with the lock held."""
+        if method in ('api.test', 'auth.test'):
+            return {}
+
+        if method == 'channels.list':
+            return {'channels': [{'id': channel['id'], 'name': channel['name'], 'is_archived': False}
+                                 for channel in self.channels.values()]}
+
+        if method == 'channels.history':
+            channel = self._channel(params)
+            oldest = float(params.get('oldest') or 0)
+            latest = float(params.get('latest') or math.inf)
+            messages = [message for message in reversed(channel['messages'])
+                        if oldest < float(message['ts']) < latest]
+            count = int(params.get('count') or 100)
+            return {'messages': messages[:count], 'has_more': len(messages) > count}
+
+        if method == 'chat.postMessage':
+            channel = self._channel(params)
+            message = {
+                'type': 'message',
+                'ts': f'{int(time.time())}.{next(self._clock):06d}',
+                'text': params.get('text', ''),
+                'username': params.get('username'),
+                'icons': {'emoji': params.get('icon_emoji'), 'image_64': params.get('icon_url')},
+                'attachments': json.loads(params.get('attachments') or '[]'),
+            }
+            channel['messages'].append(message)
+            return {'channel': channel['id'], 'ts': message['ts'], 'message': message}
+
+        if method == 'chat.update':
+            channel = self._channel(params)
+            message = self._message(channel, params.get('ts'))
+            message['text'] = params.get('text', message['text'])
+            if 'attachments' in params:
+                message['attachments'] = json.loads(params['attachments'] or '[]')
+            message['edited'] = {'ts': f'{time.time():.6f}'}
+            return {'channel': channel['id'], 'ts': message['ts'], 'text': message['text'],
+                    'message': message}
+
+        if method == 'chat.delete':
+            channel = self._channel(params)
+            channel['messages'].remove(self._message(channel, params.get('ts')))
+            return {'channel': channel['id'], 'ts': params.get('ts')}
+
+        raise SlackError('unknown_method')
+
+
+def _handler(slack):
+    """Get a request handler class serving a `FakeSlack`"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Send each response in one write, and don't hold it back waiting for acks
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def _serve(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                params.update(parse_qsl(self.rfile.read(length).decode('utf-8')))
+            params.pop('token', None)
+            method = url.path.rstrip('/').rsplit('/', 1)[-1]
+            status, headers, body = slack.handle(method, params)
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = _serve
+        do_POST = _serve
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    return Handler
+
+
+def main():
+    args = parse_args()
+    slack = FakeSlack(channels=args.channels, latency=args.latency, error_rate=args.error_rate,
+                      limits=config.SLACK_METHOD_LIMITS if args.throttle else None, host=args.host,
+                      port=args.port)
+    url = slack.start()
+    sys.stdout.write(f'Fake Slack API listening at {url}\n')
+    try:
+        while True:
+            time.sleep(60)
+            sys.stdout.write(f'{slack.count()} calls so far\n')
+    except KeyboardInterrupt:
+        slack.stop()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve a fake Slack API')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', default=8099, type=int, help='Port to listen on')
+    parser.add_argument('--channels', nargs='+', default=['general', 'klaxer-test'],
+                        help='Channels to create')
+    parser.add_argument('--latency', default=0, type=float, help='Seconds every call takes')
+    parser.add_argument('--error-rate', default=0, type=float, help='Share of calls failing with HTTP 500')
+    parser.add_argument('--throttle', default=False, action='store_true',
+                        help='Answer calls beyond SLACK_METHOD_LIMITS with HTTP 429')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main()
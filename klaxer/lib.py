@@ -1,9 +1,10 @@
 """Core methods"""
 
+import json
 from datetime import datetime
 
-from klaxer.errors import AuthorizationError, NoRouteFoundError
-from klaxer.models import Severity
+from klaxer.errors import AuthorizationError
+from klaxer.models import Digest
 from klaxer.sinks import Slack
 
 
@@ -11,60 +12,80 @@ def validate(service_name, token):
     #TODO: Implement. Raise AuthorizationError if invalid, otherwise just pass through
     pass
 
-def classify(alert, rules):
-    """Determine the severity of an alert
+def read_lines(stream, chunk_size=64 * 1024):
+    """Split a stream into lines without reading all of it into memory
 
-    :param alert: The alert to test
-    :param rules: An array of classification rules to test against
-    :returns: Alert - The Alert object with severity added
-    """
-    sev = [rule(alert) for rule in rules]
-
-    # Pick the highest priority classification from the classifications
-    sev.sort(key=lambda x: x.value)
-    alert.severity = sev.pop()
-
-    return alert
+    The stream is read in fixed-size chunks rather than by line, since
+    request streams don't reliably support readline.
 
-def filtered(alert, rules):
-    """Determine if an alert meets an exclusion rule
-
-    :param alert: The alert to test
-    :param rules: An array of exclusion rules to test against
-    :returns: Boolean - True if the alert should be dropped
+    :param stream: A binary file-like object
+    :param chunk_size: How many bytes to read at a time
+    :returns: A generator of lines. Blank lines are skipped.
     """
-    return any(rule(alert) for rule in rules)
-
-def enrich(alert, rules):
-    """Determine if an alert meets an enrichment rule
-
-    :param alert: The alert to test
-    :param rules: An array of enrichment rules to test against
-    :returns: Alert - The enriched Alert object
-    """
-    for enrichment in rules:
-        updates = enrichment(alert)
-        if not updates:
+    # The chunks of a line longer than a chunk are joined once the line ends,
+    # rather than one at a time, which would copy it over and over
+    pending = []
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        if b'\n' not in chunk:
+            pending.append(chunk)
             continue
-        for name, value in updates.items():
-            alert[name] = value
+        lines = chunk.split(b'\n')
+        lines[0] = b''.join(pending + lines[:1])
+        pending = [lines.pop()]
+        for line in lines:
+            if line.strip():
+                yield line
+    rest = b''.join(pending)
+    if rest.strip():
+        yield rest
+
+def read_ndjson(stream):
+    """Decode newline-delimited JSON one record at a time
+
+    :param stream: A binary file-like object
+    :returns: A generator of decoded records
+    """
+    for line in read_lines(stream):
+        yield json.loads(line)
 
-    return alert
+def _json_default(value):
+    """Encode the values json can't, such as the timestamps of alerts, the way hug's JSON output does"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
 
-def route(alert, rules):
-    """Determine if an alert meets a routing rule
+class NDJSONStream:
+    """A file-like object encoding records as newline-delimited JSON as it is read
 
-    :param alert: The alert to test
-    :param rules: An array of routing rules to test against
-    :returns: Alert - The routed Alert object
+    Records are only pulled from the iterable when the reader asks for more
+    bytes, so a slow reader holds back the producer.
     """
-    for route in rules:
-        target = route(alert)
-        if target:
-            alert.target = target
-            return alert
-    raise NoRouteFoundError()
+
+    def __init__(self, records):
+        self._records = iter(records)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        """Read up to `size` bytes, or everything if `size` is negative"""
+        while size < 0 or len(self._buffer) < size:
+            record = next(self._records, None)
+            if record is None:
+                break
+            self._buffer += json.dumps(record, default=_json_default).encode('utf-8') + b'\n'
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        """Stop pulling records"""
+        close = getattr(self._records, 'close', None)
+        if close:
+            close()
 
 def send(alert):
     slack = Slack(alert.target)
-    slack.send_alert(alert)
+    if isinstance(alert, Digest):
+        slack.send_digest(alert)
+    else:
+        slack.send_alert(alert)
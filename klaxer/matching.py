@@ -0,0 +1,309 @@
+"""Multi-pattern matchers used to evaluate rules in a single pass"""
+
+import re
+
+try:
+    from re import _compiler as sre_compile, _parser as sre_parse
+except ImportError: # Python < 3.11
+    import sre_compile
+    import sre_parse
+
+# Inline flags at the start of a pattern apply to the whole of it, so such a
+# pattern cannot be embedded in a larger one
+GLOBAL_FLAGS_PATTERN = re.compile(r'\(\?[aiLmsux]+\)')
+
+# Repeats and groups that never backtrack, added in Python 3.11
+_POSSESSIVE_REPEAT = getattr(sre_parse, 'POSSESSIVE_REPEAT', None)
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+class KeywordMatcher:
+    """An Aho-Corasick automaton over a fixed set of keywords.
+
+    A single scan over a piece of text yields every keyword that occurs in it
+    as a substring, no matter how many keywords were compiled in.
+    """
+
+    def __init__(self, keywords):
+        """Compile the automaton.
+
+        :param keywords: An iterable of keywords to search for
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+        self._always = set()
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._link()
+
+    def _add(self, keyword):
+        """Add a keyword to the trie"""
+        if not keyword:
+            # An empty keyword is a substring of everything
+            self._always.add(keyword)
+            return
+        node = 0
+        for char in keyword:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(set())
+            node = nxt
+        self._out[node].add(keyword)
+
+    def _link(self):
+        """Compute failure links breadth-first and merge outputs along them"""
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._out[child] |= self._out[self._fail[child]]
+        self._out = [frozenset(out) for out in self._out]
+
+    def search(self, text):
+        """Find every keyword occurring in the text.
+
+        :param text: The text to scan
+        :returns: frozenset - The keywords found in the text
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set(self._always)
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                found |= out[node]
+
+        return frozenset(found)
+
+
+class PatternMatcher:
+    """Finds which of a set of regular expressions match a piece of text.
+
+    The patterns are compiled into one alternation, so a text that none of
+    them match is rejected by a single scan. When the alternation does match, each pattern is searched on
+    its own, so that its match (and the groups its rules expand) is exactly
+    the one re.search would find, whichever other patterns share the
+    alternation.
+
+    Patterns that cannot be embedded in the alternation (those with named
+    groups, backreferences or global inline flags) are searched on their own.
+    """
+
+    def __init__(self, patterns):
+        """Compile the alternation.
+
+        :param patterns: An iterable of compiled regular expressions
+        """
+        self.patterns = list(dict.fromkeys(patterns))
+        self._combinable = []
+        self._separate = []
+        for pattern in self.patterns:
+            if combinable(pattern):
+                self._combinable.append(pattern)
+            else:
+                self._separate.append(pattern)
+        alternatives = [f'(?:{pattern.pattern})' for pattern in self._combinable]
+        flags = self.patterns[0].flags if self.patterns else 0
+        self._combined = re.compile('|'.join(alternatives), flags) if alternatives else None
+
+    def search(self, text):
+        """Find every pattern matching the text.
+
+        :param text: The text to scan
+        :returns: dict - The matching patterns, mapped to their first match
+        """
+        found = {}
+        if self._combined is not None and self._combined.search(text) is not None:
+            for pattern in self._combinable:
+                match = pattern.search(text)
+                if match is not None:
+                    found[pattern] = match
+        for pattern in self._separate:
+            match = pattern.search(text)
+            if match is not None:
+                found[pattern] = match
+        return found
+
+
+def combinable(pattern):
+    """Determine whether a compiled pattern can be embedded in an alternation
+    of other patterns without changing what it matches"""
+    if pattern.groupindex or GLOBAL_FLAGS_PATTERN.match(pattern.pattern):
+        return False
+    return not _has_backreferences(sre_parse.parse(pattern.pattern, pattern.flags))
+
+
+def _has_backreferences(parsed):
+    for op, av in _walk(parsed):
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            return True
+    return False
+
+
+def _children(op, av):
+    """Get the subpatterns of a parsed node"""
+    if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, _POSSESSIVE_REPEAT):
+        return [av[2]]
+    if op is sre_parse.SUBPATTERN:
+        return [av[-1]]
+    if op is sre_parse.BRANCH:
+        return av[1]
+    if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [av[1]]
+    if op is sre_parse.GROUPREF_EXISTS:
+        return [branch for branch in av[1:] if branch is not None]
+    if op is _ATOMIC_GROUP:
+        return [av]
+    return []
+
+
+def _walk(parsed):
+    """Iterate over every node of a parsed pattern"""
+    for op, av in parsed:
+        yield op, av
+        for child in _children(op, av):
+            yield from _walk(child)
+
+
+def check_backtracking(pattern):
+    """Reject a pattern with the usual shapes of catastrophic backtracking.
+
+    A variable-length repeat nested in one that repeats more than once, as in
+    (a+)+, (a|b?)*, (\\w+\\s?)* or (a+){2,30}, can match a long text in
+    exponentially (or polynomially) many ways, all of which are tried before
+    a match fails. Atomic groups and possessive repeats do not help when the
+    nesting is inside them, so they are checked like any other group.
+
+    The inner repeat is allowed when it is followed by a literal that it
+    cannot start with, as in (\\d+\\.)+, since then there is only one way
+    to split the text between its iterations.
+
+    Alternatives that can start with the same character, or match nothing,
+    are rejected in a repeat too, as in (a|a)*, (a|ab)* or (\\w|\\d)+, since
+    each iteration can then be matched by either of them. Alternatives of
+    single characters are parsed as a set, so sets with overlapping members,
+    like [\\w\\d], are rejected in a repeat as well.
+
+    This is a heuristic over the parsed pattern, not a proof that matching
+    runs in linear time: it catches the common shapes, not every one.
+
+    :param pattern: The source of a regular expression
+    :raises ValueError: if the pattern nests such repeats, or repeats such
+        alternatives
+    """
+    def check(parsed, repeated):
+        nodes = list(parsed)
+        for index, (op, av) in enumerate(nodes):
+            if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, _POSSESSIVE_REPEAT):
+                low, high, item = av
+                possessive = op is _POSSESSIVE_REPEAT
+                if repeated and low != high and not possessive and not _delimited(item, nodes[index + 1:]):
+                    raise ValueError(f'{pattern!r} nests a variable repeat in a repeated one, which can '
+                                     'backtrack catastrophically')
+                check(item, repeated or (high > 1 and not possessive))
+                continue
+            if repeated and op is sre_parse.BRANCH and _overlapping(av[1]):
+                raise ValueError(f'{pattern!r} repeats alternatives that can start alike, which can '
+                                 'backtrack catastrophically')
+            if repeated and op is sre_parse.IN and _overlapping_set(av):
+                raise ValueError(f'{pattern!r} repeats a set or alternatives with overlapping members, which '
+                                 'can backtrack catastrophically')
+            for child in _children(op, av):
+                check(child, repeated)
+
+    check(sre_parse.parse(pattern), False)
+
+
+def _delimited(item, following):
+    """Determine whether the iterations of a repeat end where a mandatory
+    literal follows, because the repeated item cannot start with it"""
+    if not following or following[0][0] is not sre_parse.LITERAL:
+        return False
+    return not _can_start(item, chr(following[0][1]))
+
+
+def _overlapping(branches):
+    """Determine whether several alternatives may match a text starting with
+    the same character. Errs towards yes."""
+    if any(_nullable(branch) for branch in branches):
+        return True
+    probes = _probes(av for branch in branches for op, av in _walk(branch) if op is sre_parse.LITERAL)
+    seen = set()
+    for branch in branches:
+        starts = {char for char in probes if _can_start(branch, char)}
+        if starts & seen:
+            return True
+        seen |= starts
+    return False
+
+
+def _overlapping_set(items):
+    """Determine whether several members of a set (IN node) match the same
+    character"""
+    if any(op is sre_parse.NEGATE for op, av in items):
+        return False
+    codes = [av for op, av in items if op is sre_parse.LITERAL]
+    codes += [code for op, av in items if op is sre_parse.RANGE for code in av]
+    probes = _probes(codes)
+    seen = set()
+    for item in items:
+        matcher = sre_compile.compile(sre_parse.SubPattern(sre_parse.State(), [(sre_parse.IN, [item])]))
+        chars = {char for char in probes if matcher.fullmatch(char)}
+        if chars & seen:
+            return True
+        seen |= chars
+    return False
+
+
+def _probes(codes):
+    """Get the characters to try alternatives with: ASCII, and those given by
+    code point"""
+    return {chr(code) for code in range(128)} | {chr(code) for code in codes}
+
+
+def _can_start(parsed, char):
+    """Determine whether a parsed pattern may match a text starting with a
+    character, in any case. Errs towards yes."""
+    for op, av in parsed:
+        if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY):
+            matcher = sre_compile.compile(sre_parse.SubPattern(sre_parse.State(), [(op, av)]))
+            return any(matcher.fullmatch(case) for case in {char, char.lower(), char.upper()})
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            continue
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, _POSSESSIVE_REPEAT):
+            branches, required = [av[2]], av[0] > 0
+        elif op in (sre_parse.SUBPATTERN, _ATOMIC_GROUP, sre_parse.BRANCH):
+            branches, required = _children(op, av), True
+        else:
+            return True
+        if any(_can_start(branch, char) for branch in branches):
+            return True
+        if required and not any(_nullable(branch) for branch in branches):
+            return False
+    return False
+
+
+def _nullable(parsed):
+    """Determine whether a parsed pattern may match an empty text. Errs towards yes."""
+    for op, av in parsed:
+        if op in (sre_parse.LITERAL, sre_parse.NOT_LITERAL, sre_parse.IN, sre_parse.ANY):
+            return False
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, _POSSESSIVE_REPEAT):
+            if av[0] > 0 and not _nullable(av[2]):
+                return False
+        elif op in (sre_parse.SUBPATTERN, _ATOMIC_GROUP, sre_parse.BRANCH):
+            if not any(_nullable(branch) for branch in _children(op, av)):
+                return False
+    return True
@@ -0,0 +1,304 @@
+"""Metrics of the alert pipeline, exposed in the Prometheus text format
+
+Counters and histograms are recorded into shards owned by the thread doing
+the recording, so the hot path never takes a lock: a sample costs a dict
+lookup and an addition. The shards are only merged when the metrics are
+collected. Gauges, and counters kept elsewhere (e.g. by the deduplicator),
+are read from callbacks at collection time.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+
+from klaxer import config
+
+Metric = namedtuple('Metric', ['name', 'kind', 'help', 'labels', 'callback'])
+
+
+class Registry:
+    """A registry of counters, gauges and histograms.
+
+    Metrics are declared once with the names of their labels, then recorded
+    with a tuple of label values in the same order:
+
+        METRICS.counter('klaxer_alerts_total', 'Alerts by outcome', ('service', 'outcome'))
+        METRICS.inc('klaxer_alerts_total', ('sensu', 'delivered'))
+    """
+
+    def __init__(self, buckets=config.METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._metrics = {}
+        self._shards = []
+        # The samples of threads that have exited, folded together
+        self._retired = ({}, {})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _declare(self, name, kind, help_text, labels, callback):
+        self._metrics[name] = Metric(name, kind, help_text, tuple(labels), callback)
+
+    def counter(self, name, help_text, labels=(), callback=None):
+        """Declare a counter.
+
+        :param name: the name of the counter
+        :param help_text: what the counter counts
+        :param labels: the names of its labels
+        :param callback: (optional) a function returning the value of the
+            counter, or a mapping of label values to values, when it is
+            counted elsewhere rather than with `inc`
+        """
+        self._declare(name, 'counter', help_text, labels, callback)
+
+    def gauge(self, name, help_text, callback, labels=()):
+        """Declare a gauge, read from a callback when metrics are collected.
+
+        :param callback: a function returning the value of the gauge, or a
+            mapping of label values to values
+        """
+        self._declare(name, 'gauge', help_text, labels, callback)
+
+    def histogram(self, name, help_text, labels=()):
+        """Declare a histogram, bucketed by the registry's buckets"""
+        self._declare(name, 'histogram', help_text, labels, None)
+
+    def _shard(self):
+        """Get the current thread's counters and histograms"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        """Add to a counter
+
+        :param labels: the values of its labels
+        """
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """Record a sample of a histogram
+
+        :param value: the sample, in seconds for latencies
+        :param labels: the values of its labels
+        """
+        self.observe_many(name, ((labels, value),))
+
+    def observe_many(self, name, samples):
+        """Record several samples of a histogram at once
+
+        :param samples: (labels, value) pairs
+        """
+        histograms = self._shard()[1]
+        buckets = self.buckets
+        for labels, value in samples:
+            key = (name, labels)
+            entry = histograms.get(key)
+            if entry is None:
+                # A count per bucket, a count for +Inf, and the sum of the samples
+                entry = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            entry[bisect_left(buckets, value)] += 1
+            entry[-1] += value
+
+    def timer(self, name, labels=()):
+        """Get a context manager recording how long its block takes into a histogram"""
+        return _Timer(self, name, labels)
+
+    def _retire(self):
+        """Fold the shards of exited threads into `_retired`. Must be called with the lock held."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self._retired, shard)
+        self._shards = alive
+
+    def samples(self):
+        """Merge the samples recorded by every thread
+
+        Shards are copied while their threads keep recording, so a histogram
+        sample recorded during collection may be missing from its sum.
+
+        :returns: a pair of mappings of (name, labels) to counter values and
+            to histogram entries
+        """
+        with self._lock:
+            self._retire()
+            shards = [shard for _, shard in self._shards]
+            merged = ({}, {})
+            _merge(merged, self._retired)
+        for shard in shards:
+            _merge(merged, shard)
+        return merged
+
+    def collect(self):
+        """Collect every metric
+
+        :returns: a list of (`Metric`, samples) pairs, where samples maps label
+            values to the value of a counter or gauge, or to the entry of a
+            histogram
+        """
+        counters, histograms = self.samples()
+        recorded = {}
+        for source in (counters, histograms):
+            for (name, labels), value in source.items():
+                recorded.setdefault(name, {})[labels] = value
+
+        collected = []
+        for metric in self._metrics.values():
+            if metric.callback is None:
+                samples = recorded.get(metric.name, {})
+            else:
+                value = metric.callback()
+                samples = value if isinstance(value, dict) else {(): value}
+            collected.append((metric, samples))
+        return collected
+
+    def expose(self):
+        """Render every metric in the Prometheus text exposition format
+
+        :returns: str
+        """
+        lines = []
+        bounds = [_format_value(bound) for bound in self.buckets] + ['+Inf']
+        for metric, samples in self.collect():
+            lines.append(f'# HELP {metric.name} {_escape(metric.help, help_text=True)}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for values, value in sorted(samples.items()):
+                labels = list(zip(metric.labels, values))
+                if metric.kind != 'histogram':
+                    lines.append(f'{metric.name}{_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(bounds, value):
+                    cumulative += count
+                    lines.append(f'{metric.name}_bucket{_labels(labels + [("le", bound)])} {cumulative}')
+                lines.append(f'{metric.name}_sum{_labels(labels)} {_format_value(value[-1])}')
+                lines.append(f'{metric.name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forget every recorded sample"""
+        with self._lock:
+            for _, (counters, histograms) in self._shards:
+                counters.clear()
+                histograms.clear()
+            self._retired = ({}, {})
+
+
+class _Timer:
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+class Trace:
+    """The timings of one alert through the stages of its service's pipeline.
+
+    Each call to `lap` records the time since the previous one against a
+    stage, so that stages are timed with one clock reading each.
+    """
+    __slots__ = ('service', 'timings', 'outcome', 'rules', '_last')
+
+    def __init__(self, service, explain=False):
+        """Start timing an alert
+
+        :param service: The name of the alert's service
+        :param explain: Whether to also collect the rules the alert matches,
+            e.g. for a debug response
+        """
+        self.service = service
+        self.timings = []
+        # Why the pipeline dropped the alert, if it did
+        self.outcome = None
+        self.rules = [] if explain else None
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        """Record the time spent in a stage that just ended"""
+        now = time.perf_counter()
+        self.timings.append((stage, now - self._last))
+        self._last = now
+
+    def to_dict(self):
+        """Get the outcome, the stage timings (in microseconds) and the matched rules"""
+        return {
+            'outcome': self.outcome,
+            'timings_us': {stage: round(seconds * 1e6, 1) for stage, seconds in self.timings},
+            'total_us': round(sum(seconds for _, seconds in self.timings) * 1e6, 1),
+            'rules': self.rules,
+        }
+
+    def record(self, registry):
+        """Record the stage timings into the stage latency histogram"""
+        service = self.service
+        registry.observe_many('klaxer_stage_seconds',
+                              (((service, stage), seconds) for stage, seconds in self.timings))
+
+
+def count_alert(alert, outcome, registry=None):
+    """Count an alert against its service, severity and route
+
+    :param outcome: what became of the alert, e.g. 'excluded' or 'delivered'
+    """
+    severity = alert.severity.name if alert.severity is not None else 'NONE'
+    (registry or METRICS).inc('klaxer_alerts_total', (alert.service, severity, alert.target or '', outcome))
+
+
+def _merge(target, shard):
+    """Add the samples of a shard into another"""
+    counters, histograms = target
+    for key, value in dict(shard[0]).items():
+        counters[key] = counters.get(key, 0) + value
+    for key, entry in dict(shard[1]).items():
+        merged = histograms.get(key)
+        if merged is None:
+            histograms[key] = list(entry)
+        else:
+            histograms[key] = [total + value for total, value in zip(merged, entry)]
+
+
+def _escape(value, help_text=False):
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    return value if help_text else value.replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+METRICS = Registry()
+
+METRICS.counter('klaxer_alerts_total', 'Alerts by service, severity, route and outcome',
+                ('service', 'severity', 'route', 'outcome'))
+METRICS.histogram('klaxer_stage_seconds', 'Time spent in each stage of handling an alert',
+                  ('service', 'stage'))
+METRICS.counter('klaxer_slack_calls_total', 'Slack API calls by method and result', ('method', 'result'))
+METRICS.histogram('klaxer_slack_call_seconds', 'Latency of Slack API calls by method', ('method',))
+METRICS.histogram('klaxer_slack_wait_seconds', 'Time Slack API calls waited on rate limits', ('method',))
+METRICS.counter('klaxer_cache_requests_total', 'Cache lookups by cache and result', ('cache', 'result'))
@@ -1,6 +1,12 @@
 """Models for DTO and other ops."""
 import datetime
+import hashlib
+import json
+import sys
 from enum import IntEnum
+from uuid import uuid4
+
+from klaxer.errors import MalformedAlertError, TransformerNotDefinedError
 
 TRANSFORMERS = {}
 
@@ -12,20 +18,74 @@ def transformer(name):
         return func
     return decorator
 
+# The fields of an alert, in the order `Alert.to_bytes` stores them
+FIELDS = ('id', 'count', 'service', 'message', 'severity', 'template', 'target', 'timestamp', 'title',
+          'username', 'icon_emoji', 'icon_url')
+
+# The fields that never take part in the fingerprint of an alert
+UNFINGERPRINTED_FIELDS = frozenset(('id', 'count', 'timestamp', '_fingerprint'))
+
+# The fields holding the same few values across most alerts. Equal values are
+# shared between alerts rather than held by each of them. Fields whose values
+# come from the alert's content (title, message, target) are left out, as
+# interned strings are never freed and those could grow without bound.
+SHARED_FIELDS = frozenset(('service', 'username', 'icon_emoji', 'icon_url'))
+
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def fingerprint(alert, fields=None):
+    """Compute a stable fingerprint of an alert from some of its fields.
+
+    :param alert: the alert to fingerprint
+    :param fields: (optional) the names of the fields identifying the alert.
+        Defaults to `DEDUP_FIELDS`.
+    :returns: the fingerprint, as a hex string
+    """
+    if fields is None:
+        # The config depends on this module, so it can't be imported up front
+        from klaxer import config
+        fields = config.DEDUP_FIELDS
+    digest = hashlib.blake2b(digest_size=16)
+    for field in fields:
+        value = alert[field]
+        if isinstance(value, Severity):
+            value = value.name
+        digest.update(b'' if value is None else str(value).encode('utf-8'))
+        # Separate the fields, so that ('ab', 'c') and ('a', 'bc') differ
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+
+def _shared(value):
+    """Get the shared copy of a string"""
+    return sys.intern(value) if type(value) is str else value # pylint: disable=unidiomatic-typecheck
+
+
 class Alert:
-    """An alert. Duh."""
+    """An alert. Duh.
+
+    Alerts pile up in queues, dedup tables and the spool, so they are slotted
+    rather than carrying a dict each, and share the strings that repeat from
+    one alert to the next. The fingerprint of an alert is computed
+    on first use and cached until one of the fields it covers changes.
+    """
+    __slots__ = FIELDS + ('_fingerprint',)
 
     def __init__(self, service, *, title, message, timestamp, target, username, icon_emoji, icon_url):
+        self._fingerprint = None
+        self.id = uuid4().hex
         self.count = 0
-        self.service = service
+        self.service = _shared(service)
         self.message = message
         self.timestamp = timestamp
         self.severity = None
+        self.template = None
         self.target = target
         self.title = title
-        self.username = username
-        self.icon_emoji = icon_emoji
-        self.icon_url = icon_url
+        self.username = _shared(username)
+        self.icon_emoji = _shared(icon_emoji)
+        self.icon_url = _shared(icon_url)
 
     def __getitem__(self, item):
         return getattr(self, item)
@@ -33,16 +93,31 @@ class Alert:
     def __setitem__(self, item, value):
         return setattr(self, item, value)
 
+    def __setattr__(self, name, value):
+        if name not in UNFINGERPRINTED_FIELDS:
+            object.__setattr__(self, '_fingerprint', None)
+        object.__setattr__(self, name, value)
+
+    @property
+    def fingerprint(self):
+        """The fingerprint of the alert over `DEDUP_FIELDS`, which can't include
+        its ID, count or timestamp"""
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self)
+        return self._fingerprint
+
     def __hash__(self):
-        # Ignore timestamp since this is used to snooze
-        return hash((self.severity, self.service, self.title, self.message))
+        # Repeats of an alert hash alike: the fingerprint leaves out its ID, count and timestamp
+        return hash(self.fingerprint)
 
     def to_dict(self):
         return {
+            'id': self.id,
             'count': self.count,
             'service': self.service,
             'message': self.message,
             'severity': str(self.severity),
+            'template': self.template,
             'target': self.target,
             'timestamp': self.timestamp,
             'title': self.title,
@@ -51,10 +126,100 @@ class Alert:
             'icon_url': self.icon_url
         }
 
+    def to_json(self):
+        """Serialize the alert losslessly, as a JSON object"""
+        return json.dumps(dict(zip(FIELDS, self._values())))
+
+    def to_bytes(self):
+        """Serialize the alert losslessly and compactly, e.g. for the delivery spool
+
+        Fields are stored by position rather than by name, in the order of
+        `FIELDS`.
+        """
+        return _encode(self._values()).encode('utf-8')
+
+    def _values(self):
+        """The fields of the alert as JSON values, in the order of `FIELDS`"""
+        return [
+            self.id,
+            self.count,
+            self.service,
+            self.message,
+            None if self.severity is None else int(self.severity),
+            self.template,
+            self.target,
+            self.timestamp.isoformat() if self.timestamp else None,
+            self.title,
+            self.username,
+            self.icon_emoji,
+            self.icon_url,
+        ]
+
     @classmethod
-    def from_service(cls, service_name, data):
-        """Get an instance of the class with normalized service data"""
-        return cls(service_name, **TRANSFORMERS[service_name](data))
+    def from_json(cls, payload):
+        """Get an instance of the class from the output of `to_json` or `to_bytes`"""
+        data = json.loads(payload)
+        if isinstance(data, dict):
+            data = [data.get(field) for field in FIELDS]
+        alert = cls.__new__(cls)
+        setter = object.__setattr__
+        for field, value in zip(FIELDS, data):
+            setter(alert, field, _shared(value) if field in SHARED_FIELDS else value)
+        setter(alert, '_fingerprint', None)
+        if alert.severity is not None:
+            setter(alert, 'severity', Severity(alert.severity))
+        if alert.timestamp:
+            setter(alert, 'timestamp', datetime.datetime.fromisoformat(alert.timestamp))
+        return alert
+
+    from_bytes = from_json
+
+    @classmethod
+    def from_service(cls, service_name, data, transform=None):
+        """Get an instance of the class with normalized service data
+
+        :param transform: (optional) the transformer for the service's data.
+            Defaults to the one registered for the service.
+        :raises MalformedAlertError: if the data is not a JSON object, or
+            lacks what the transformer looks up in it
+        :raises TransformerNotDefinedError: if the service has no transformer
+        """
+        if transform is None:
+            transform = TRANSFORMERS.get(service_name)
+            if transform is None:
+                raise TransformerNotDefinedError(service_name)
+        if not isinstance(data, dict):
+            raise MalformedAlertError()
+        try:
+            fields = transform(data)
+        except (KeyError, IndexError, TypeError) as error:
+            raise MalformedAlertError() from error
+        return cls(service_name, **fields)
+
+
+class Digest:
+    """A batch of alerts for the same target, delivered as a single message."""
+
+    def __init__(self, target, alerts):
+        self.id = uuid4().hex
+        self.target = target
+        self.alerts = alerts
+
+    def groups(self):
+        """Group the alerts by severity and title, most severe first.
+
+        :returns: a list of (severity, title, alerts) tuples
+        """
+        groups = {}
+        for alert in self.alerts:
+            groups.setdefault((alert.severity, alert.title), []).append(alert)
+        return [(severity, title, alerts) for (severity, title), alerts in
+                sorted(groups.items(), key=lambda group: -int(group[0][0] or 0))]
+
+    @property
+    def severity(self):
+        """The highest severity in the batch"""
+        return max(alert.severity for alert in self.alerts)
 
 
 class NaiveContainer:
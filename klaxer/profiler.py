@@ -0,0 +1,180 @@
+"""An opt-in sampling profiler of the request path
+
+While it runs, a background thread samples the stacks of the threads that
+are serving a request or delivering an alert every `interval` seconds, and
+counts them as collapsed stacks: one line per distinct stack, its frames
+from the outermost in, separated by semicolons, followed by how many times
+it was sampled. That is the input format of flamegraph.pl and speedscope.
+"""
+
+import math
+import sys
+import threading
+import time
+from collections import Counter
+
+from klaxer import config
+
+
+class SamplingProfiler:
+    """Samples the stacks of the threads that enter it, for a limited time
+    or number of requests.
+
+    Threads mark the work to profile with `enter` and `leave`. Both return
+    straight away while the profiler is stopped, so they can stay on the
+    request path.
+    """
+
+    def __init__(self, interval=config.PROFILER_INTERVAL, max_duration=config.PROFILER_MAX_DURATION):
+        self.interval = interval
+        self.max_duration = max_duration
+        self.running = False
+        self.samples = 0
+        self.requests = 0
+        self.started = None
+        self.stopped = None
+        self._stacks = Counter()
+        self._active = {}
+        self._deadline = None
+        self._limit = None
+        self._max_requests = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, duration=None, requests=None, interval=None):
+        """Start profiling, discarding the stacks of the previous run
+
+        :param duration: (optional) stop after this many seconds. Capped at
+            `max_duration`, which also applies without one.
+        :param requests: (optional) stop after this many requests
+        :param interval: (optional) seconds between samples, instead of the
+            default interval
+        :returns: the status of the profiler
+        """
+        with self._lock:
+            if self.running:
+                raise ValueError('The profiler is already running')
+            duration = min(duration or self.max_duration, self.max_duration)
+            self._stacks = Counter()
+            self.samples = 0
+            self.requests = 0
+            self.started = time.time()
+            self.stopped = None
+            self._deadline = time.monotonic() + duration
+            self._limit = time.monotonic() + self.max_duration
+            self._max_requests = requests
+            self.running = True
+            self._thread = threading.Thread(target=self._run, args=(interval or self.interval,), daemon=True,
+                                            name='klaxer-profiler')
+            self._thread.start()
+        return self.status()
+
+    def stop(self):
+        """Stop profiling, keeping the stacks sampled so far
+
+        :returns: the status of the profiler
+        """
+        self.running = False
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        return self.status()
+
+    def enter(self, request=True):
+        """Mark the current thread as doing work to profile
+
+        :param request: whether the work counts as a request towards the
+            profiler's request limit
+        """
+        if not self.running:
+            return
+        if request:
+            with self._lock:
+                if self._max_requests and self.requests >= self._max_requests:
+                    return
+                self.requests += 1
+                if self.requests == self._max_requests:
+                    # Stop once this last request, and any still in flight, are sampled to their end
+                    self._deadline = time.monotonic()
+        self._active[threading.get_ident()] = True
+
+    def leave(self):
+        """Mark the current thread as done with the work to profile"""
+        if self._active:
+            self._active.pop(threading.get_ident(), None)
+
+    def _run(self, interval):
+        own = threading.get_ident()
+        while self.running:
+            now = time.monotonic()
+            if now >= self._limit or (now >= self._deadline and not (self._max_requests and self._active)):
+                break
+            frames = sys._current_frames() # pylint: disable=protected-access
+            with self._lock:
+                for ident in list(self._active):
+                    frame = frames.get(ident)
+                    if frame is not None and ident != own:
+                        self._stacks[collapse(frame)] += 1
+                        self.samples += 1
+            time.sleep(interval)
+        self.running = False
+        self.stopped = time.time()
+        self._active.clear()
+
+    def collapsed(self):
+        """Get the sampled stacks in the collapsed format
+
+        :returns: str - One "frame;frame;frame count" line per distinct stack
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def status(self):
+        """Get the state of the profiler
+
+        :returns: a dict of whether it is running, when it started and
+            stopped, and the numbers of requests and samples profiled
+        """
+        return {
+            'running': self.running,
+            'started': self.started,
+            'stopped': self.stopped,
+            'requests': self.requests,
+            'samples': self.samples,
+            'stacks': len(self._stacks),
+        }
+
+
+def collapse(frame):
+    """Render a stack as a line of the collapsed format, outermost frame first
+
+    :param frame: the innermost frame of the stack
+    :returns: str - e.g. "klaxer.api:incoming;klaxer.api:accept;klaxer.rules:Pipeline.process"
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{frame.f_globals.get("__name__", "?")}:{getattr(code, "co_qualname", code.co_name)}')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names).replace(' ', '_')
+
+
+def parse_option(name, value, kind=float):
+    """Get an option of the profiler, as given to the profiler API, which must be a positive number
+
+    :param name: the name of the option, for the error message
+    :param kind: the type of the option, e.g. int for a number of requests
+    """
+    if value is None:
+        return None
+    try:
+        number = kind(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f'Invalid {name} {value!r}: expected a number')
+    if not math.isfinite(number) or number <= 0:
+        raise ValueError(f'Invalid {name} {value!r}: expected a positive number')
+    return number
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,155 @@
+"""Rate limiting for outbound Slack API calls"""
+
+import logging
+import threading
+import time
+
+import requests
+
+from klaxer import config
+from klaxer.metrics import METRICS
+
+# Methods that post to a channel, and so count against its message rate
+CHANNEL_METHODS = frozenset(['chat.postMessage', 'chat.update', 'chat.delete'])
+
+# Methods that post a new message. A server or connection error does not tell
+# whether the message went out, so these are not retried on one, lest the
+# message be posted twice.
+POSTING_METHODS = frozenset(['chat.postMessage'])
+
+
+class TokenBucket:
+    """A thread-safe token bucket.
+
+    Tokens accrue at `rate` per second, up to `burst`. Callers may take a
+    token before it has accrued, in which case they are told how long to
+    wait, so concurrent callers queue up fairly instead of polling.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def reserve(self):
+        """Take a token.
+
+        :returns: how long (in seconds) to wait before the token may be used
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """Drain the bucket so that no token is available for a while.
+
+        :param seconds: how long to hold off callers
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class SlackScheduler:
+    """Releases Slack API calls at the highest rate Slack allows.
+
+    Every call takes a token from the bucket of its method and, for methods
+    that post to a channel, from the bucket of that channel. Throttled calls
+    (HTTP 429) pause the buckets involved for as long as Slack's Retry-After
+    header asks and are retried. Server and connection errors are retried
+    with exponential backoff, except for calls posting a new message, which
+    may have gone through. Each call gets at most `attempts` tries and
+    `max_delay` seconds of waiting on retries before its error is raised.
+    """
+
+    def __init__(self, method_limits=config.SLACK_METHOD_LIMITS, channel_limit=config.SLACK_CHANNEL_LIMIT,
+                 attempts=config.SLACK_RETRY_ATTEMPTS, backoff=config.SLACK_RETRY_BACKOFF,
+                 max_delay=config.SLACK_RETRY_MAX_DELAY):
+        self.method_limits = method_limits
+        self.channel_limit = channel_limit
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, limit):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(*limit))
+        return bucket
+
+    def buckets(self, method, channel=None):
+        """Get the buckets a call is subject to.
+
+        :param method: the Slack API method (e.g. 'chat.postMessage')
+        :param channel: (optional) the ID of the channel the call posts to
+        :returns: a list of `TokenBucket`s
+        """
+        buckets = []
+        if method in self.method_limits:
+            buckets.append(self._bucket(method, self.method_limits[method]))
+        if channel and method in CHANNEL_METHODS:
+            buckets.append(self._bucket(('channel', channel), self.channel_limit))
+        return buckets
+
+    def call(self, method, func, **kwargs):
+        """Make a Slack API call once the rate limits allow it, retrying on
+        throttling and transient failures.
+
+        :param method: the Slack API method (e.g. 'chat.postMessage')
+        :param func: the Slacker function making the call
+        :param kwargs: the arguments of the call
+        :returns: the response of the call
+        """
+        buckets = self.buckets(method, kwargs.get('channel'))
+        budget = self.max_delay
+        for attempt in range(1, self.attempts + 1):
+            wait = max([bucket.reserve() for bucket in buckets], default=0)
+            if wait:
+                METRICS.observe('klaxer_slack_wait_seconds', wait, (method,))
+                time.sleep(wait)
+            try:
+                with METRICS.timer('klaxer_slack_call_seconds', (method,)):
+                    response = func(**kwargs)
+                METRICS.inc('klaxer_slack_calls_total', (method, 'ok'))
+                return response
+            except requests.HTTPError as error:
+                status = error.response.status_code if error.response is not None else None
+                METRICS.inc('klaxer_slack_calls_total', (method, str(status)))
+                if status == requests.codes.too_many_requests:
+                    delay = float(error.response.headers.get('Retry-After', self.backoff))
+                elif status and status >= 500 and method not in POSTING_METHODS:
+                    delay = self.backoff * 2 ** (attempt - 1)
+                else:
+                    raise
+                if attempt == self.attempts or delay > budget:
+                    raise
+                if status == requests.codes.too_many_requests and buckets:
+                    # Hold off every call sharing these limits, not just this one
+                    for bucket in buckets:
+                        bucket.pause(delay)
+                else:
+                    time.sleep(delay)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                METRICS.inc('klaxer_slack_calls_total', (method, type(error).__name__))
+                delay = self.backoff * 2 ** (attempt - 1)
+                if attempt == self.attempts or delay > budget or method in POSTING_METHODS:
+                    raise
+                time.sleep(delay)
+            except Exception:
+                # e.g. Slack answering with ok: false
+                METRICS.inc('klaxer_slack_calls_total', (method, 'error'))
+                raise
+            budget -= delay
+            logging.warning('Retrying %s in %.1fs (attempt %d of %d)', method, delay, attempt + 1,
+                            self.attempts)
@@ -1,220 +1,571 @@
+import logging
+import os
+import re
+import threading
+import time
+
 import yaml
-from klaxer.models import Severity
-from klaxer.errors import ServiceNotDefinedError, ConfigurationError
+from klaxer import config
+from klaxer.matching import KeywordMatcher, PatternMatcher, check_backtracking
+from klaxer.models import Severity, TRANSFORMERS
+from klaxer.transform import compile_transformer
+from klaxer.errors import NoRouteFoundError, ServiceNotDefinedError, ConfigurationError
+
+SOURCES = ('message', 'title')
+
+
+class Pipeline:
+    """The compiled rule sets of a single service.
+
+    Every keyword used by the rules of a source is compiled into one matcher,
+    so the lowercased source text is scanned once and each rule category
+    reads its answer from the resulting set of keywords. Likewise, every
+    regex rule of a source is compiled into one PatternMatcher.
+
+    Rules refer to what they match by key: a keyword, or the compiled
+    pattern of a regex rule. A source's hits contain the keys found in it,
+    and map the patterns found to their match.
+    """
+
+    def __init__(self, service, matchers, classifications, exclusions, enrichments, routes, transform=None,
+                 patterns=None):
+        """Initialize the pipeline.
+
+        :param service: The name of the service
+        :param matchers: A mapping of sources to their KeywordMatcher
+        :param classifications: A list of (source, levels) pairs, where levels
+            maps keys to the highest severity they denote
+        :param exclusions: A list of (source, keys) pairs
+        :param enrichments: An ordered list of (source, key, template)
+            triples. A key of None always applies.
+        :param routes: An ordered list of (source, key, target) triples. A
+            key of None always applies.
+        :param transform: (optional) The transformer turning the service's
+            payloads into the arguments of an Alert
+        :param patterns: (optional) A mapping of sources to the
+            PatternMatcher of their regex rules
+        """
+        self.service = service
+        self._matchers = matchers
+        self._classifications = classifications
+        self._exclusions = exclusions
+        self._enrichments = enrichments
+        self._routes = routes
+        self.transform = transform
+        self._patterns = patterns or {}
+
+    def search(self, source, text):
+        """Find the keys of the rules of a source present in a text
+
+        :param source: The source the text belongs to
+        :param text: The text to scan
+        :returns: frozenset - The keywords found in the text or, if regex
+            rules match, a dict of the keywords found (mapped to None) and the
+            patterns found (mapped to their match)
+        """
+        hits = self._matchers[source].search(text.lower())
+        patterns = self._patterns.get(source)
+        if patterns is not None:
+            found = patterns.search(text)
+            if found:
+                found.update(dict.fromkeys(hits))
+                return found
+        return hits
+
+    def scan(self, alert):
+        """Find the keywords and patterns present in each source of an alert
+
+        :param alert: The alert to scan
+        :returns: dict - A mapping of sources to the keys they contain
+        """
+        return {source: self.search(source, getattr(alert, source)) for source in self._matchers}
+
+    def classify(self, alert, hits, matched=None):
+        """Determine the severity of an alert
+
+        :param alert: The alert to classify
+        :param hits: The keywords present in each source of the alert
+        :param matched: (optional) A list the matching rules are appended to
+        :returns: Alert - The Alert object with severity added
+        """
+        severity = Severity.UNKNOWN
+        for source, levels in self._classifications:
+            for hit in hits[source]:
+                if hit in levels:
+                    if matched is not None:
+                        matched.append({'rule': 'classify', 'source': source, 'keyword': describe(hit),
+                                        'severity': levels[hit].name})
+                    if levels[hit] > severity:
+                        severity = levels[hit]
+        alert.severity = severity
+        return alert
+
+    def excluded(self, alert, hits, matched=None):
+        """Determine if an alert meets an exclusion rule
+
+        :param alert: The alert to test
+        :param hits: The keywords present in each source of the alert
+        :param matched: (optional) A list the matching rules are appended to
+        :returns: Boolean - True if the alert should be dropped
+        """
+        if matched is not None:
+            matched.extend({'rule': 'exclude', 'source': source, 'keyword': describe(key)}
+                           for source, keys in self._exclusions for key in keys.intersection(hits[source]))
+        return any(not keys.isdisjoint(hits[source]) for source, keys in self._exclusions)
+
+    def enrich(self, alert, hits, matched=None):
+        """Apply the enrichment rules matching an alert, in order
+
+        Enrichment rewrites the source text, so the keywords of a rewritten
+        source are rescanned for the rules that follow.
+
+        :param alert: The alert to enrich
+        :param hits: The keywords present in each source of the alert. Updated
+            in place as sources are rewritten.
+        :param matched: (optional) A list the applied rules are appended to
+        :returns: Alert - The enriched Alert object
+        """
+        for source, key, template in self._enrichments:
+            if key is None or key in hits[source]:
+                if matched is not None:
+                    matched.append({'rule': 'enrich', 'source': source, 'keyword': describe(key),
+                                    'template': template})
+                alert[source] = expand(template, alert[source], hits[source], key)
+                hits[source] = self.search(source, alert[source])
+        return alert
+
+    def route(self, alert, hits, matched=None):
+        """Determine where an alert goes
+
+        :param alert: The alert to route
+        :param hits: The keywords present in each source of the alert
+        :param matched: (optional) A list the matching route is appended to
+        :returns: Alert - The routed Alert object
+        """
+        for source, key, target in self._routes:
+            if key is None or key in hits[source]:
+                if isinstance(key, re.Pattern):
+                    target = expand(target, alert[source], hits[source], key)
+                if matched is not None:
+                    matched.append({'rule': 'route', 'source': source, 'keyword': describe(key),
+                                    'target': target})
+                alert.target = target
+                return alert
+        raise NoRouteFoundError()
+
+    def process(self, alert, filters=(), trace=None, templates=None):
+        """Run an alert through the service's rules
+
+        Exclusion does not depend on severity or on the message template, so
+        it is checked first to drop excluded alerts as early as possible,
+        without them teaching the templates anything.
+
+        :param alert: The alert to process
+        :param filters: User-defined filters (e.g. snoozes). The alert is
+            dropped if any of them returns True.
+        :param templates: (optional) A `klaxer.clustering.TemplateMiner`
+            setting the message template of the alert, which filters may
+            key on
+        :param trace: (optional) A `klaxer.metrics.Trace` timing each stage,
+            told why the alert was dropped and, if it collects them, which
+            rules matched
+        :returns: Alert - The classified, enriched and routed Alert object, or
+            None if the alert was dropped
+        """
+        lap = trace.lap if trace else _untraced
+        matched = trace.rules if trace else None
+        hits = self.scan(alert)
+        lap('scan')
+        # Filter based on rules (e.g. junk an alert if a string is in the body or if it came from a CI bot).
+        excluded = self.excluded(alert, hits, matched)
+        lap('exclude')
+        if excluded:
+            if trace:
+                trace.outcome = 'excluded'
+            return None
+        if templates is not None:
+            alert.template = templates.match(self.service, alert.message).id
+            lap('template')
+        self.classify(alert, hits, matched)
+        lap('classify')
+        # Filtered based on user interactions (e.g. bail if we've snoozed the notification type).
+        snoozed = any(rule(alert) for rule in filters)
+        lap('snooze')
+        if snoozed:
+            if trace:
+                trace.outcome = 'snoozed'
+            return None
+        self.enrich(alert, hits, matched)
+        lap('enrich')
+        alert = self.route(alert, hits, matched)
+        lap('route')
+        return alert
+
+
+def _untraced(stage):
+    pass
+
+
+def expand(template, text, hits, key):
+    """Fill in an enrichment template or a route target
+
+    The text is the first positional field ({} or {0}). The groups captured
+    by a regex rule follow it ({1}, {2}, ...), and its named groups are
+    keyword fields ({team}). Groups that did not participate are empty.
+
+    :param template: The template to fill in
+    :param text: The source text the rule matched
+    :param hits: The keys present in the source
+    :param key: The keyword or pattern of the rule, or None
+    :returns: str
+    """
+    if not isinstance(key, re.Pattern):
+        return template.format(text)
+    match = hits[key]
+    return template.format(text, *match.groups(''), **match.groupdict(''))
+
+
+def describe(key):
+    """Describe the key of a rule for debug output: a keyword, or a pattern as /pattern/"""
+    return f'/{key.pattern}/' if isinstance(key, re.Pattern) else key
 
 
 class Rules:
-    def __init__(self):
-        self._classification_rules = {}
-        self._exclusion_rules = {}
-        self._enrichment_rules = {}
-        self._routing_rules = {}
+    def __init__(self, path=config.RULES_PATH):
+        self._pipelines = {}
         self._config = None
 
         try:
-            # TODO: Absolute path? Where should this live?
-            with open('config/klaxer.yml', 'r') as ymlfile:
-                self._config = yaml.load(ymlfile)
+            with open(path, 'r') as ymlfile:
+                self._config = yaml.safe_load(ymlfile)
         except yaml.YAMLError as ye:
             raise ConfigurationError('failed to parse config') from ye
 
+        if not isinstance(self._config, dict):
+            raise ConfigurationError('config must define at least one service')
+
         for section in self._config:
             # Subsequent definitions of the same service will overwrite the
             # previous ones.
             self._build_rules(section)
 
     def _build_rules(self, service):
-        """Build the rules sets for classification, exclusion, enrichment and
-        routing for each service.
+        """Build the pipeline of classification, exclusion, enrichment and
+        routing rules for a service.
 
         :param service: The service for which rule sets will be generated
         :returns: None
         """
+        if not isinstance(service, str) or not isinstance(self._config[service], dict):
+            raise ConfigurationError(f'rules for {service} must map message and title to their rules')
+
         if 'message' not in self._config[service]:
             self._config[service]['message'] = {}
 
         if 'title' not in self._config[service]:
             self._config[service]['title'] = {}
 
-        self._classification_rules[service] = []
-        self._exclusion_rules[service] = []
-        self._enrichment_rules[service] = []
-        self._routing_rules[service] = []
+        for source in SOURCES:
+            self._check_keywords(service, source)
+            for category in ('enrichments', 'routes'):
+                rules = self._config[service][source].get(category)
+                if isinstance(rules, list) and not all(isinstance(rule, dict) and
+                                                       isinstance(rule.get('THEN'), str) and
+                                                       isinstance(rule.get('IF', ''), str) and
+                                                       ('IF' in rule) != ('IF_RE' in rule) for rule in rules):
+                    raise ConfigurationError(f'{category} for {service} must be IF/THEN or IF_RE/THEN pairs')
 
-        self._build_classification_rules(service, 'message')
-        self._build_classification_rules(service, 'title')
+        service = service.lower()
+        classifications, exclusions, enrichments, routes = [], [], [], []
+        matchers, patterns = {}, {}
+
+        for source in SOURCES:
+            matchers[source] = self._build_matcher(service, source)
+            self._build_classification_rules(service, source, classifications)
+            self._build_exclusion_rules(service, source, exclusions)
+            self._build_enrichment_rules(service, source, enrichments)
+            self._build_routing_rules(service, source, routes)
+            pattern_matcher = self._build_pattern_matcher(source, classifications, exclusions, enrichments,
+                                                          routes)
+            if pattern_matcher:
+                patterns[source] = pattern_matcher
+
+        self._pipelines[service] = Pipeline(service, matchers, classifications, exclusions,
+                                            enrichments, routes, self._build_transformer(service), patterns)
+
+    def _check_keywords(self, service, source):
+        """Check that the classification and exclusion rules of a service
+        source are lists of keywords or patterns
+
+        :param service: The service the rules belong to
+        :param source: The source field from the Alert object that will be used
+        :raises ConfigurationError: if they are not
+        """
+        cfg = self._config[service][source]
+        if not isinstance(cfg, dict):
+            raise ConfigurationError(f'{source} rules for {service} must be a mapping')
+        classification = cfg.get('classification', {})
+        if not isinstance(classification, dict):
+            raise ConfigurationError(f'classification for {service} must map severities to keywords')
+        lists = [(f'{level} classification', keywords) for level, keywords in classification.items()]
+        lists += [(category, cfg[category]) for category in ('exclude', 'exclude_re') if category in cfg]
+        for name, keywords in lists:
+            if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+                raise ConfigurationError(f'{name} for {service} must be a list of strings')
+
+    def _build_transformer(self, service):
+        """Build the transformer for a service: the one declared in its
+        `transform` section, or else the hand-written one registered for it
+
+        :param service: The service for which the transformer will be generated
+        :returns: function, or None if the service has no transformer
+        """
+        cfg = self._config[service]
 
-        self._build_exclusion_rules(service, 'message')
-        self._build_exclusion_rules(service, 'title')
+        if 'transform' not in cfg:
+            return TRANSFORMERS.get(service)
 
-        self._build_enrichment_rules(service, 'message')
-        self._build_enrichment_rules(service, 'title')
+        return compile_transformer(service, cfg['transform'])
 
-        self._build_routing_rules(service, 'message')
-        self._build_routing_rules(service, 'title')
+    def _build_matcher(self, service, source):
+        """Compile every keyword used by the rules of a service source into a
+        single matcher, so that the source text is only scanned once
 
-        # Ensure that required rule sets are defined
-        if not self._classification_rules:
-            raise ConfigurationError(f'classification rules not defined for {service}')
+        :param service: The service for which the matcher will be generated
+        :param source: The source field from the Alert object that will be used
+        :returns: KeywordMatcher
+        """
+        cfg = self._config[service][source]
+        keywords = set()
+
+        classification = cfg.get('classification', {})
+        for severity in (Severity.OK, Severity.WARNING, Severity.CRITICAL):
+            keywords.update(classification.get(severity.name, []))
+        keywords.update(cfg.get('exclude', []))
+        for rules in (cfg.get('enrichments'), cfg.get('routes')):
+            if isinstance(rules, list):
+                keywords.update(rule['IF'].lower() for rule in rules if 'IF' in rule)
 
-        if not self._routing_rules:
-            raise ConfigurationError(f'routes not defined for {service}')
+        return KeywordMatcher(keywords)
 
-    def _classify(self, alert, source, cfg):
-        """Return the classification level for an alert given the defined config
+    def _build_pattern_matcher(self, source, classifications, exclusions, enrichments, routes):
+        """Compile every regex rule of a service source into a single matcher
 
-        :param alert: The alert object to be classified
         :param source: The source field from the Alert object that will be used
-        :param cfg: The service configuration for the type of Alert being classified
-        :returns: IntEnum - Severity object
-        """
-        if any(crit in getattr(alert, source).lower() for crit in
-               cfg['classification'].get('CRITICAL', [])):
-            return Severity.CRITICAL
-        elif any(warn in getattr(alert, source).lower() for warn in
-                 cfg['classification'].get('WARNING', [])):
-            return Severity.WARNING
-        elif any(ok in getattr(alert, source).lower() for ok in
-                 cfg['classification'].get('OK', [])):
-            return Severity.OK
-
-        return Severity.UNKNOWN
-
-    def _build_classification_rules(self, service, source):
+        :param classifications: The classification rules of the service
+        :param exclusions: The exclusion rules of the service
+        :param enrichments: The enrichment rules of the service
+        :param routes: The routing rules of the service
+        :returns: PatternMatcher, or None if the source has no regex rules
+        """
+        keys = []
+        for rule_source, levels in classifications:
+            if rule_source == source:
+                keys.extend(levels)
+        for rule_source, excluded in exclusions:
+            if rule_source == source:
+                keys.extend(excluded)
+        for rule_source, key, _ in enrichments + routes:
+            if rule_source == source:
+                keys.append(key)
+
+        patterns = [key for key in keys if isinstance(key, re.Pattern)]
+        return PatternMatcher(patterns) if patterns else None
+
+    def _compile_pattern(self, service, pattern):
+        """Compile the pattern of a regex rule
+
+        Patterns are case-insensitive, like keywords.
+
+        :param service: The service the rule belongs to
+        :param pattern: The source of the regular expression
+        :returns: re.Pattern
+        :raises ConfigurationError: if the pattern is invalid, or at risk of
+            catastrophic backtracking
+        """
+        if not isinstance(pattern, str):
+            raise ConfigurationError(f'regex rules for {service} must be strings, not {pattern!r}')
+        try:
+            check_backtracking(pattern)
+            return re.compile(pattern, re.IGNORECASE)
+        except re.error as error:
+            raise ConfigurationError(f'invalid regex rule {pattern!r} for {service}: {error}') from error
+        except ValueError as error:
+            raise ConfigurationError(f'rejected regex rule for {service}: {error}') from error
+
+    def _rule_key(self, service, rule, template):
+        """Get the key of an IF or IF_RE rule, checking that its template only
+        refers to the groups its pattern captures
+
+        :param service: The service the rule belongs to
+        :param rule: The IF/THEN or IF_RE/THEN rule
+        :param template: The enrichment template or route target of the rule
+        :returns: the lowercased keyword or the compiled pattern of the rule
+        """
+        if 'IF' in rule:
+            return rule['IF'].lower()
+        key = self._compile_pattern(service, rule['IF_RE'])
+        try:
+            template.format('', *[''] * key.groups, **dict.fromkeys(key.groupindex, ''))
+        except (IndexError, KeyError, ValueError) as error:
+            raise ConfigurationError(f'{template!r} does not fit the groups of {key.pattern!r} '
+                                     f'for {service}: {error}') from error
+        return key
+
+    def _build_classification_rules(self, service, source, rules):
         """Build the classification rule set for a service
 
         :param service: The service for which rule sets will be generated
         :param source: The source field from the Alert object that will be used
+        :param rules: The list of rules to extend
         :returns: None
         """
-        service = service.lower()
         cfg = self._config[service][source]
 
-        # Default to returning UNKNOWN severity
+        # Default to UNKNOWN severity
         if 'classification' not in cfg:
-            self._classification_rules[service].append(lambda x: Severity.UNKNOWN)
             return
 
-        self._classification_rules[service].append(lambda x, src=source, cfg=cfg:
-                                                   self._classify(x, src, cfg))
+        # Walk from the lowest to the highest priority so that a keyword listed
+        # under several levels resolves to the highest one
+        levels = {}
+        for severity in (Severity.OK, Severity.WARNING, Severity.CRITICAL):
+            for keyword in cfg['classification'].get(severity.name, []):
+                levels[keyword] = severity
+            for pattern in cfg['classification'].get(f'{severity.name}_RE', []):
+                levels[self._compile_pattern(service, pattern)] = severity
 
-    def _build_exclusion_rules(self, service, source):
+        rules.append((source, levels))
+
+    def _build_exclusion_rules(self, service, source, rules):
         """Build the exclusion rule set for a service
 
         :param service: The service for which rule sets will be generated
+        :param source: The source field from the Alert object that will be used
+        :param rules: The list of rules to extend
         :returns: None
         """
-        service = service.lower()
         cfg = self._config[service][source]
 
-        if 'exclude' not in cfg:
+        if 'exclude' not in cfg and 'exclude_re' not in cfg:
             return
 
-        self._exclusion_rules[service].append(
-            lambda x, cfg=cfg: any(ignore in getattr(x, source).lower() for ignore in cfg['exclude'])
-        )
+        patterns = [self._compile_pattern(service, pattern) for pattern in cfg.get('exclude_re', [])]
+        rules.append((source, frozenset(cfg.get('exclude', [])) | frozenset(patterns)))
 
-    def _build_enrichment_rules(self, service, source):
+    def _build_enrichment_rules(self, service, source, rules):
         """Build the enrichment rule set for a service
 
         :param service: The service for which rule sets will be generated
+        :param source: The source field from the Alert object that will be used
+        :param rules: The list of rules to extend
         :returns: None
         """
-        service = service.lower()
         cfg = self._config[service][source]
 
         if 'enrichments' not in cfg:
             return
 
         if isinstance(cfg['enrichments'], str):
-            self._enrichment_rules[service].append(
-                lambda x, cfg=cfg: {source: cfg['enrichments'].format(getattr(x, source))}
-            )
+            rules.append((source, None, cfg['enrichments']))
         elif isinstance(cfg['enrichments'], list):
             for e in cfg['enrichments']:
-                self._enrichment_rules[service].append(
-                    lambda x, e=e: {source: e['THEN'].format(getattr(x, source))} if e['IF'].lower() in getattr(x, source).lower() else None
-                )
+                rules.append((source, self._rule_key(service, e, e['THEN']), e['THEN']))
         else:
             raise ConfigurationError(f'Invalid enrichments definition for {service}')
 
-    def _build_routing_rules(self, service, source):
+    def _build_routing_rules(self, service, source, rules):
         """Build the routing rule set for a service
 
         :param service: The service for which rule sets will be generated
+        :param source: The source field from the Alert object that will be used
+        :param rules: The list of rules to extend
         :returns: None
         """
-        service = service.lower()
         cfg = self._config[service][source]
 
         if 'routes' not in cfg:
             return
 
         if isinstance(cfg['routes'], str):
-            self._routing_rules[service].append(
-                lambda x, cfg=cfg: cfg['routes']
-            )
+            rules.append((source, None, cfg['routes']))
         elif isinstance(cfg['routes'], list):
             for r in cfg['routes']:
-                self._routing_rules[service].append(
-                    lambda x, r=r: r['THEN'] if r['IF'].lower() in getattr(x, source).lower() else None
-                )
+                rules.append((source, self._rule_key(service, r, r['THEN']), r['THEN']))
         else:
             raise ConfigurationError(f'invalid routes definition for {service}')
 
-    def get_classification_rules(self, service):
-        """Get the classification rule set for a service. This rule set will be
-        a list of lambda functions which will take in the Alert object to which
-        rules should be applied
+    def get_pipeline(self, service):
+        """Get the compiled rule pipeline for a service.
 
         :param service: The name of the service
-        :returns: None
+        :returns: Pipeline
         """
         try:
-            service = service.lower()
-            return self._classification_rules[service]
+            return self._pipelines[service.lower()]
         except KeyError as ke:
             raise ServiceNotDefinedError(str(ke))
 
-    def get_exclusion_rules(self, service):
-        """Get the exclusion rule set for a service. This rule set will be
-        a list of lambda functions which will take in the Alert object to which
-        rules should be applied
 
-        :param service: The name of the service
-        :returns: None
-        """
+class ReloadingRules:
+    """The current Rules compiled from a config file, rebuilt when the file
+    changes.
+
+    The file is polled every `interval` seconds. A changed file is compiled
+    in the background and swapped in with a single assignment, so requests
+    keep the pipeline they already looked up. If the new config fails to
+    load, the error is logged and the previous rules stay in place.
+    """
+
+    def __init__(self, path=config.RULES_PATH, interval=config.RULES_RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._signature = self._stat()
+        self.current = Rules(path)
+        self._thread = None
+
+    def _stat(self):
         try:
-            service = service.lower()
-            return self._exclusion_rules[service]
-        except KeyError as ke:
-            raise ServiceNotDefinedError(str(ke))
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
 
-    def get_enrichment_rules(self, service):
-        """Get the enrichment rule set for a service. This rule set will be
-        a list of lambda functions which will take in the Alert object to which
-        rules should be applied
+    def get_pipeline(self, service):
+        """Get the compiled rule pipeline for a service from the current rules.
 
         :param service: The name of the service
-        :returns: None
+        :returns: Pipeline
         """
-        try:
-            service = service.lower()
-            return self._enrichment_rules[service]
-        except KeyError as ke:
-            raise ServiceNotDefinedError(str(ke))
+        return self.current.get_pipeline(service)
 
-    def get_routing_rules(self, service):
-        """Get the routing rule set for a service. This rule set will be
-        a list of lambda functions which will take in the Alert object to which
-        rules should be applied
+    def reload(self):
+        """Rebuild the rules if the config file changed since they were built
 
-        :param service: The name of the service
-        :returns: None
+        :returns: Boolean - True if new rules were swapped in
         """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
         try:
-            service = service.lower()
-            return self._routing_rules[service]
-        except KeyError as ke:
-            raise ServiceNotDefinedError(str(ke))
+            rules = Rules(self.path)
+        except (ConfigurationError, OSError, re.error, yaml.YAMLError) as error:
+            logging.error('Rejected config %s, keeping the current rules: %s', self.path,
+                          getattr(error, 'message', error))
+            return False
+        self.current = rules
+        logging.info('Reloaded rules from %s', self.path)
+        return True
+
+    def start(self):
+        """Start watching the config file"""
+        if self._thread or not self.interval:
+            return
+        self._thread = threading.Thread(target=self._watch, daemon=True, name='klaxer-rules')
+        self._thread.start()
 
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.reload()
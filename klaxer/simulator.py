@@ -1,12 +1,16 @@
 """Simulate alerts!
 
 Usage: python -m klaxer.simulator
+       python -m klaxer.simulator --load --duration 60 --concurrency 16 [--rate 500] [--json]
 """
 
 import argparse
 import json
 import random
 import sys
+import threading
+import time
+from collections import Counter
 
 import requests
 
@@ -25,21 +29,176 @@ MESSAGE_TEMPLATE = {
     }]
 }
 
+# Upper bounds (in milliseconds) of the buckets of the load test's latency histogram
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def make_alert(severity, system=SYSTEM, usage=85.12, padding=0):
+    """Build a Sensu payload
+
+    :param padding: how many bytes of check output to append to the message
+    """
+    text = (f'{SERVICE_NAME}/disk-usage: CheckDisk {severity.upper()}: / {usage:.2f}% bytes usage '
+            f'(6 GiB/7 GiB)\n : {system} : sensu-clients,testing,client:{SERVICE_NAME}')
+    if padding:
+        text += '\n' + ('x' * 79 + '\n') * (padding // 80) + 'x' * (padding % 80)
+    return dict(MESSAGE_TEMPLATE, attachments=[{
+        'title': f'{system} - {severity}',
+        'text': text,
+        'color': f'{"red" if severity == "error" else "yellow"}',
+    }])
+
 def send_alert(host, severity, debug):
     sys.stdout.write(f'Sending {severity}... ')
-    MESSAGE_TEMPLATE['attachments'][0] = {
-        'title': f'{SYSTEM} - {severity}',
-        'text': f'{SERVICE_NAME}/disk-usage: CheckDisk {severity.upper()}: / 85.12% bytes usage (6 GiB/7 GiB)\n : {SYSTEM} : sensu-clients,testing,client:{SERVICE_NAME}',
-        'color': f'{"red" if severity == "error" else "yellow"}',
-    }
+    payload = make_alert(severity)
     if debug:
-        response = requests.post(f'http://{host}/alert/sensu/12345?debug=true', json=MESSAGE_TEMPLATE)
+        response = requests.post(f'http://{host}/alert/sensu/12345?debug=true', json=payload)
     else:
-        response = requests.post(f'http://{host}/alert/sensu/12345', json=MESSAGE_TEMPLATE)
+        response = requests.post(f'http://{host}/alert/sensu/12345', json=payload)
     sys.stdout.write(f'{response.text}\n')
 
+class LoadGenerator:
+    """Sends alerts to a Klaxer deployment from a pool of threads.
+
+    Each thread keeps its own HTTP session, so connections are kept alive
+    between requests. Without a rate, every thread sends its next alert as
+    soon as the previous one is answered. With a rate, alerts are sent on a
+    fixed schedule shared out between the threads, and each latency is
+    measured from when its alert was due, so that a server falling behind
+    shows up in the latencies rather than in a slower schedule.
+    """
+
+    def __init__(self, host, services, severities, duplicates, sizes, concurrency, rate=None, seed=None):
+        self.host = host
+        self.services = services
+        self.severities = severities
+        self.duplicates = duplicates
+        self.sizes = sizes
+        self.concurrency = concurrency
+        self.rate = rate
+        self.seed = seed
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def payload(self, rng, previous):
+        """Pick the next alert to send: a repeat of the previous one, or a new one"""
+        if previous and rng.random() < self.duplicates:
+            return previous
+        service = rng.choice(self.services)
+        severity = rng.choice(self.severities)
+        system = f'host{rng.randint(1, 100)}.example.com'
+        return service, make_alert(severity, system=system, usage=rng.uniform(0, 100),
+                                   padding=rng.choice(self.sizes))
+
+    def _work(self, index, start, deadline):
+        rng = random.Random(None if self.seed is None else self.seed + index)
+        session = requests.Session()
+        latencies, statuses, errors = [], Counter(), Counter()
+        previous = None
+        sent = 0
+        while True:
+            due = time.monotonic()
+            if self.rate:
+                due = start + (sent * self.concurrency + index) / self.rate
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if due >= deadline:
+                break
+            sent += 1
+            previous = service, payload = self.payload(rng, previous)
+            try:
+                response = session.post(f'http://{self.host}/alert/{service}/12345', json=payload, timeout=30)
+            except requests.RequestException as error:
+                errors[type(error).__name__] += 1
+                continue
+            latencies.append(time.monotonic() - due)
+            statuses[response.status_code] += 1
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.statuses.update(statuses)
+            self.errors.update(errors)
+
+    def run(self, duration):
+        """Send alerts for `duration` seconds
+
+        :returns: the report of the run
+        """
+        start = time.monotonic()
+        deadline = start + duration
+        threads = [threading.Thread(target=self._work, args=(index, start, deadline), daemon=True)
+                   for index in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.monotonic() - start)
+
+    def report(self, elapsed):
+        """Summarize the throughput, outcomes and latencies of a run"""
+        latencies = sorted(self.latencies)
+        completed = len(latencies)
+
+        def percentile(share):
+            if not latencies:
+                return None
+            return round(latencies[min(completed - 1, int(completed * share))] * 1000, 2)
+
+        histogram, position = {}, 0
+        for bound in HISTOGRAM_BUCKETS:
+            count = 0
+            while position < completed and latencies[position] * 1000 <= bound:
+                count += 1
+                position += 1
+            histogram[f'<={bound}ms'] = count
+        histogram[f'>{HISTOGRAM_BUCKETS[-1]}ms'] = completed - position
+
+        failed = sum(count for status, count in self.statuses.items() if status >= 400)
+        return {
+            'duration': round(elapsed, 2),
+            'concurrency': self.concurrency,
+            'target_rate': self.rate,
+            'requests': completed + sum(self.errors.values()),
+            'throughput': round(completed / elapsed, 1) if elapsed else 0,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'errors': failed + sum(self.errors.values()),
+            'connection_errors': dict(self.errors),
+            'latency_ms': {
+                'p50': percentile(0.5),
+                'p90': percentile(0.9),
+                'p99': percentile(0.99),
+                'max': round(latencies[-1] * 1000, 2) if latencies else None,
+            },
+            'histogram': histogram,
+        }
+
+def print_report(report):
+    latency = report['latency_ms']
+    sys.stdout.write(f'{report["requests"]} requests in {report["duration"]}s '
+                     f'({report["throughput"]}/s, {report["concurrency"]} threads'
+                     f'{", target " + str(report["target_rate"]) + "/s" if report["target_rate"] else ""})\n')
+    sys.stdout.write(f'Statuses: {report["statuses"]}, errors: {report["errors"]}'
+                     f'{" " + str(report["connection_errors"]) if report["connection_errors"] else ""}\n')
+    sys.stdout.write(f'Latency (ms): p50 {latency["p50"]}, p90 {latency["p90"]}, p99 {latency["p99"]}, '
+                     f'max {latency["max"]}\n')
+    peak = max(report['histogram'].values()) or 1
+    for bucket, count in report['histogram'].items():
+        sys.stdout.write(f'{bucket:>9} {count:>8} {"#" * round(40 * count / peak)}\n')
+
 def main():
     args = parse_args()
+    if args.load:
+        severities = SEVERITIES if args.severity == 'both' else [args.severity]
+        generator = LoadGenerator(args.host, args.services, severities, args.duplicates, args.sizes,
+                                  args.concurrency, args.rate, args.seed)
+        report = generator.run(args.duration)
+        if args.json:
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            print_report(report)
+        return
     for _ in range(args.n):
         severity = random.choice(SEVERITIES) if args.severity == 'both' else args.severity
         send_alert(args.host, severity, args.debug)
@@ -50,6 +209,19 @@ def parse_args():
     parser.add_argument('-s', dest='severity', default='both', choices=['both'] + SEVERITIES, help='Severity of messages to send')
     parser.add_argument('--host', default='localhost:8000', help='Host to send messages to')
     parser.add_argument('-d', dest='debug', default=False, action='store_true', help='Debug mode')
+    load = parser.add_argument_group('load testing')
+    load.add_argument('--load', default=False, action='store_true', help='Load test the host instead')
+    load.add_argument('--duration', default=30, type=float, help='How long (in seconds) to send alerts for')
+    load.add_argument('--concurrency', default=8, type=int, help='Number of threads sending alerts')
+    load.add_argument('--rate', default=None, type=float,
+                      help='Alerts to send per second, in total. Defaults to as many as the host answers')
+    load.add_argument('--services', nargs='+', default=['sensu'], help='Services to send alerts as')
+    load.add_argument('--duplicates', default=0.2, type=float,
+                      help='Share of alerts repeating the previous one')
+    load.add_argument('--sizes', nargs='+', default=[0, 0, 0, 1024, 8192], type=int,
+                      help='Sizes (in bytes) of extra check output, picked from at random')
+    load.add_argument('--seed', default=None, type=int, help='Seed of the random alerts')
+    load.add_argument('--json', default=False, action='store_true', help='Print the report as JSON')
     return parser.parse_args()
 
 if __name__ == "__main__":
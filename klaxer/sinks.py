@@ -2,26 +2,230 @@
 
 import re
 import json
+import time
 import logging
+import threading
 import urllib.request
 from collections import namedtuple
 from datetime import datetime
 
-from slacker import Slacker
+import requests
+from slacker import Error as SlackError, Slacker
 
 from klaxer import config, errors
+from klaxer.metrics import METRICS
 from klaxer.models import Severity, Message
+from klaxer.ratelimit import SlackScheduler
 
 Channel = namedtuple('Channel', ['id', 'name'])
 User = namedtuple('User', ['id', 'name', 'handle'])
+LastMessage = namedtuple('LastMessage', ['ts', 'text', 'count', 'updated', 'verified', 'key'],
+                         defaults=(None,))
 
 # Regex pattern for text ending with dup indicators (e.g. "(x2)")
 debounce_pattern = r'\(x(?P<count>\d+)\)$'
 debounce_regex = re.compile(debounce_pattern)
 
+# The base URL of the Slack API, as built into Slacker
+SLACK_API_URL = 'https://slack.com/api/'
+
 # Regex pattern for Slack's URL markup: <http://url|url>
 URL_PATTERN = re.compile(r'\<https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)\|(?P<url>.*?)\>')
 
+
+class ChannelDirectory:
+    """A cache of the Slack channels of a workspace, keyed by name.
+
+    The full listing is refreshed once it is older than `ttl` seconds, or
+    immediately when an unknown channel is requested. Names that are still
+    unknown after a refresh are remembered for `miss_ttl` seconds so that a
+    misrouted alert storm does not turn into a storm of channel listings.
+    """
+
+    def __init__(self, ttl=config.CHANNEL_CACHE_TTL, miss_ttl=config.CHANNEL_MISS_TTL):
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._channels = {}
+        self._misses = {}
+        self._expires = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self, fetch, generation):
+        """Replace the cached listing, unless another thread already has
+
+        :param fetch: A callable returning a mapping of names to `Channel`s
+        :param generation: The generation the caller saw before deciding to refresh
+        """
+        with self._lock:
+            if self._generation != generation:
+                return
+            self._channels = fetch()
+            self._expires = time.monotonic() + self.ttl
+            self._generation += 1
+
+    def get(self, name, fetch):
+        """Look up a channel by name.
+
+        :param name: the name of the channel
+        :param fetch: A callable returning a mapping of names to `Channel`s,
+            used when the cache must be refreshed
+        :returns: the matching channel
+        :rtype: `Channel`
+        :raises ChannelNotFoundError: if no such channel exists
+
+        """
+        now = time.monotonic()
+        expired = now >= self._expires
+        if expired:
+            self._refresh(fetch, self._generation)
+
+        channel = self._channels.get(name)
+        if channel:
+            METRICS.inc('klaxer_cache_requests_total', ('channels', 'hit'))
+            return channel
+
+        if self._misses.get(name, 0) > now:
+            METRICS.inc('klaxer_cache_requests_total', ('channels', 'known_missing'))
+            raise errors.ChannelNotFoundError(name)
+
+        # The channel may have been created since the last listing, unless that was just now
+        METRICS.inc('klaxer_cache_requests_total', ('channels', 'miss'))
+        if not expired:
+            self._refresh(fetch, self._generation)
+            channel = self._channels.get(name)
+        if channel:
+            self._misses.pop(name, None)
+            return channel
+
+        self._misses[name] = now + self.miss_ttl
+        raise errors.ChannelNotFoundError(name)
+
+    def all(self, fetch):
+        """Get every known channel, refreshing the listing if it has expired.
+
+        :param fetch: A callable returning a mapping of names to `Channel`s
+        :returns: a mapping of channel names to `Channel`s
+        :rtype: `dict`
+
+        """
+        if time.monotonic() >= self._expires:
+            self._refresh(fetch, self._generation)
+        return self._channels
+
+
+# The channel caches of each workspace, by token and `SLACK_API_URL`
+CHANNELS = {}
+
+
+def get_channel_directory(token):
+    """Get the channel cache for a token, creating it on first use.
+
+    Channels differ from one workspace to the next, and between Slack and a
+    fake Slack, so each token and `SLACK_API_URL` gets a cache of its own.
+    """
+    key = (token, config.SLACK_API_URL)
+    directory = CHANNELS.get(key)
+    if directory is None:
+        directory = CHANNELS.setdefault(key, ChannelDirectory())
+    return directory
+
+SCHEDULER = SlackScheduler()
+
+
+class MessageLog:
+    """A process-wide record of the last alert posted to each channel.
+
+    Each record holds the message timestamp, its text without the `(xN)`
+    dup indicator, the dup count, when the message was last known to be the
+    latest in the channel and the rollup key of its alert, so that rollups can be decided without asking
+    Slack for the channel history. Records older than `ttl` seconds are
+    treated as stale. Alerts for the same channel are serialized through
+    a per-channel lock so that concurrent duplicates roll up correctly.
+    """
+
+    def __init__(self, ttl=config.LAST_MESSAGE_TTL):
+        self.ttl = ttl
+        self._records = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, channel_id):
+        """Get the lock serializing posts to a channel"""
+        lock = self._locks.get(channel_id)
+        if lock is None:
+            with self._lock:
+                lock = self._locks.setdefault(channel_id, threading.Lock())
+        return lock
+
+    def get(self, channel_id):
+        """Get the last message posted to a channel.
+
+        :param channel_id: the ID of the channel
+        :returns: the last message, or None if it is unknown or stale
+        :rtype: `LastMessage`
+
+        """
+        record = self._records.get(channel_id)
+        if record and time.monotonic() - record.updated < self.ttl:
+            return record
+        return None
+
+    def set(self, channel_id, ts, text, count, verified=None, key=None):
+        """Record the last message posted to a channel.
+
+        :param channel_id: the ID of the channel
+        :param ts: the Slack timestamp of the message
+        :param text: the text of the message, without a dup indicator
+        :param count: the number of duplicates rolled up into the message
+        :param verified: (optional) when the message was last known to be the
+            latest in the channel. Defaults to now.
+        :param key: (optional) the `rollup_key` of the alert posted
+        :returns: the new record
+        :rtype: `LastMessage`
+
+        """
+        now = time.monotonic()
+        record = LastMessage(ts, text, count, now, now if verified is None else verified, key)
+        self._records[channel_id] = record
+        return record
+
+    def forget(self, channel_id):
+        """Drop the record for a channel"""
+        self._records.pop(channel_id, None)
+
+
+LAST_MESSAGES = MessageLog()
+
+class SlackSession(requests.Session):
+    """An HTTP session sending Slack API calls to `base_url` rather than to
+    slack.com, e.g. to a fake Slack."""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip('/') + '/'
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(SLACK_API_URL):
+            url = self.base_url + url[len(SLACK_API_URL):]
+        return super().request(method, url, *args, **kwargs)
+
+
+_CLIENTS = {}
+
+def get_client(token):
+    """Get the shared Slack client for a token, creating it on first use.
+
+    Clients share a keep-alive HTTP session rather than opening a new
+    connection for every API call, and send their calls to `SLACK_API_URL`.
+    """
+    key = (token, config.SLACK_API_URL)
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = _CLIENTS.setdefault(key, Slacker(token, session=SlackSession(config.SLACK_API_URL)))
+    return client
+
+
 class Destination:
     """Base for defining Slack destinations to send `Message`s to."""
     def __init__(self, token=config.SLACK_TOKEN):
@@ -32,7 +236,7 @@ class Destination:
 
         """
         self.token = token
-        self.host = 'https://slack.com/api/'
+        self.host = config.SLACK_API_URL
         self._alive = None
 
     def ping(self):
@@ -71,36 +275,34 @@ class Slack(Destination):
     """Use Slack as the destination."""
     def __init__(self, channel, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._channels = None
-        self.slack = Slacker(self.token)
-        self.channel = self.channels[channel]
+        self.slack = get_client(self.token)
+        self.directory = get_channel_directory(self.token)
+        self.channel = self.directory.get(channel, self.get_channels)
 
     @property
     def channels(self):
-        if not self._channels:
-            self._channels = self.get_channels()
-        return self._channels
+        return self.directory.all(self.get_channels)
 
     def ping(self):
-        check = self.slack.auth.test()
+        check = SCHEDULER.call('auth.test', self.slack.auth.test)
         return check.successful
 
     def set_channel(self, channel_name):
-        if channel_name not in self.channels:
-            message = f'Channel {channel_name} is not an available channel'
-            raise errors.ChannelNotFoundError(message)
-        self.current_channel = self.channels.get(channel_name)
+        self.current_channel = self.directory.get(channel_name, self.get_channels)
 
     def get_channels(self):
-        channels = self.slack.channels.list(exclude_archived=True).body.get('channels')
+        channels = SCHEDULER.call('channels.list', self.slack.channels.list,
+                                  exclude_archived=True).body.get('channels')
         return {channel['name']: Channel(channel['id'], channel['name']) for channel in channels}
 
     def get_last_message(self):
-        last_message = self.slack.channels.history(channel=self.channel.id, count=1).body.get('messages')[0]
+        last_message = SCHEDULER.call('channels.history', self.slack.channels.history,
+                                     channel=self.channel.id, count=1).body.get('messages')[0]
         return Message(**last_message)
 
     def delete_message(self, message):
-        response = self.slack.chat.delete(ts=message.ts, channel=self.channel.id)
+        response = SCHEDULER.call('chat.delete', self.slack.chat.delete,
+                                  ts=message.ts, channel=self.channel.id)
         return response.successful
 
     def post_message(self, message):
@@ -109,31 +311,150 @@ class Slack(Destination):
         if message in last_message.text:
             debounced = True
             message = debounce(last_message.text)
-        response = self.slack.chat.post_message(channel=self.channel.id, text=message).body.get('message')
+        response = SCHEDULER.call('chat.postMessage', self.slack.chat.post_message,
+                                  channel=self.channel.id, text=message).body.get('message')
         if debounced:
             self.delete_message(last_message)
         return Message(**response)
 
+    def get_last_alert(self):
+        """Get the last alert posted to the channel.
+
+        The local record is used when it is fresh. Otherwise it is rebuilt
+        from the channel history.
+
+        :returns: the last alert, or None if the channel has no alert
+        :rtype: `LastMessage`
+
+        """
+        record = LAST_MESSAGES.get(self.channel.id)
+        if record:
+            return record
+        messages = SCHEDULER.call('channels.history', self.slack.channels.history,
+                                  channel=self.channel.id, count=1).body.get('messages')
+        last_message = Message(**messages[0]) if messages else None
+        if not last_message or not last_message.attachments:
+            LAST_MESSAGES.forget(self.channel.id)
+            return None
+        text, count = split_dup_count(unslack_text(last_message.attachments[0]['text']))
+        return LAST_MESSAGES.set(self.channel.id, last_message.ts, text, count)
+
+    def is_latest(self, record):
+        """Check whether a recorded message is still the latest in the channel.
+
+        Records verified within the last `ROLLUP_TRUST_WINDOW` seconds are
+        trusted. Older ones are checked against the channel history and
+        marked verified again when they still hold.
+
+        :param record: the recorded message
+        :rtype: bool
+
+        """
+        if time.monotonic() - record.verified < config.ROLLUP_TRUST_WINDOW:
+            return True
+        newer = SCHEDULER.call('channels.history', self.slack.channels.history,
+                               channel=self.channel.id, oldest=record.ts, count=1).body.get('messages')
+        if newer:
+            return False
+        LAST_MESSAGES.set(self.channel.id, record.ts, record.text, record.count, key=record.key)
+        return True
+
+    def update_message(self, ts, alert, text=None):
+        """Edit a posted alert in place.
+
+        :param ts: the Slack timestamp of the message to edit
+        :param alert: the alert to replace it with
+        :param text: (optional) the text to show instead of the alert's message
+        :returns: the edited message
+        :rtype: `Message`
+
+        """
+        response = SCHEDULER.call('chat.update', self.slack.chat.update,
+                                  channel=self.channel.id, ts=ts, text='',
+                                  attachments=self._attachments(alert, text)).body
+        return Message(**response.get('message', {'ts': response.get('ts')}))
+
+    def _attachments(self, alert, text=None):
+        return [{
+            'title': alert.title,
+            'text': alert.message if text is None else text,
+            'color': severity_to_color(alert.severity),
+            'ts': int(alert.timestamp.timestamp()),
+        }]
+
     def send_alert(self, alert):
-        last_message = self.get_last_message()
-        debounced = False
-        attachment = last_message.attachments[0] if last_message.attachments else None
-        if attachment and alert.message in unslack_text(attachment['text']): #TODO: Test more than just the message
-            debounced = True
-            alert.message = debounce(attachment['text'])
-        response = self.slack.chat.post_message(
+        with LAST_MESSAGES.lock(self.channel.id):
+            return self._send_alert(alert)
+
+    def _send_alert(self, alert):
+        last_alert = self.get_last_alert()
+        # The alert is left as it was queued, so that a failed delivery can be retried with it
+        text = alert.message
+        # An alert may already stand for several repeats absorbed before delivery
+        count = max(alert.count, 1)
+        key = rollup_key(alert)
+        rollup = last_alert and (last_alert.text == text or (key is not None and last_alert.key == key))
+        if rollup:
+            count += last_alert.count
+        shown = f'{text} (x{count})' if count > 1 else text
+        if rollup:
+            # Roll up in place while the message is still the latest in the
+            # channel. Otherwise repost it at the bottom and delete the old one.
+            if config.ROLLUP_MODE == 'update' and self.is_latest(last_alert):
+                try:
+                    message = self.update_message(last_alert.ts, alert, shown)
+                except SlackError:
+                    logging.warning('Failed to update message %s, reposting', last_alert.ts)
+                else:
+                    record = LAST_MESSAGES.get(self.channel.id) or last_alert
+                    LAST_MESSAGES.set(self.channel.id, last_alert.ts, text, count, record.verified, key)
+                    return message
+        response = SCHEDULER.call(
+            'chat.postMessage', self.slack.chat.post_message,
             channel=self.channel.id,
             username=alert.username,
             icon_emoji=alert.icon_emoji,
             icon_url=alert.icon_url,
-            attachments=[{
-                'title': alert.title,
-                'text': alert.message,
-                'color': severity_to_color(alert.severity)
-            }]).body.get('message')
-        if debounced:
-            self.delete_message(last_message)
-        return Message(**response)
+            attachments=self._attachments(alert, shown)).body.get('message')
+        message = Message(**response)
+        if rollup:
+            self.delete_message(Message(ts=last_alert.ts))
+        LAST_MESSAGES.set(self.channel.id, message.ts, text, count, key=key)
+        return message
+
+    def send_digest(self, digest):
+        """Post a batch of alerts as a single message.
+
+        :param digest: the `Digest` to post
+        :returns: the posted message
+        :rtype: `Message`
+
+        """
+        lines = []
+        for severity, title, alerts in digest.groups():
+            total = sum(max(alert.count, 1) for alert in alerts)
+            count = f' (x{total})' if total > 1 else ''
+            lines.append(f'*{severity.name}* {title}{count}: {alerts[-1].message}')
+        text = '\n'.join(lines)
+        first = digest.alerts[0]
+        with LAST_MESSAGES.lock(self.channel.id):
+            response = SCHEDULER.call(
+                'chat.postMessage', self.slack.chat.post_message,
+                channel=self.channel.id,
+                username=first.username,
+                icon_emoji=first.icon_emoji,
+                icon_url=first.icon_url,
+                attachments=[{
+                    'title': f'{len(digest.alerts)} alerts',
+                    'text': text,
+                    'color': severity_to_color(digest.severity),
+                    'mrkdwn_in': ['text'],
+                    'ts': int(max(alert.timestamp for alert in digest.alerts).timestamp()),
+                }]).body.get('message')
+            message = Message(**response)
+            # The digest is now the latest message, so later alerts must not roll up into an older one
+            LAST_MESSAGES.set(self.channel.id, message.ts, text, 1)
+        return message
 
 def severity_to_color(severity):
     """Map severity levels to colors"""
@@ -151,11 +472,28 @@ def severity_to_color(severity):
 
 def unslack_text(text):
     """Slack applies formatting to inline URLs. This undoes it"""
-    has_url = URL_PATTERN.search(text)
-    if has_url:
-        # Searching only returns one match. Recursively unslack the message.
-        return unslack_text(text.replace(has_url.group(0), has_url.group('url')))
-    return text
+    return URL_PATTERN.sub(r'\g<url>', text)
+
+def rollup_key(alert):
+    """Get the key under which near-identical alerts roll up into one message
+
+    :returns: the service, title, template and severity of the alert, or None
+        if alerts only roll up when their text is identical
+    """
+    if not config.ROLLUP_BY_TEMPLATE or alert.template is None:
+        return None
+    return (alert.service.lower(), alert.title, alert.template, alert.severity)
+
+def split_dup_count(text):
+    """Split a dup indicator (e.g. "(x2)") off the end of a text
+
+    :returns: the text without the indicator, and the dup count
+    """
+    is_dup = debounce_regex.search(text)
+
+    if is_dup:
+        return text[:is_dup.start()].rstrip(' '), int(is_dup.group('count'))
+    return text, 1
 
 def debounce(text):
     """Check for signs of a dup indicator, and increment the counter if present"""
@@ -0,0 +1,203 @@
+"""Snoozing and muting of alerts"""
+
+import itertools
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from klaxer import config
+from klaxer.models import Severity
+
+
+class Snooze:
+    """A snooze on the alerts of a service matching the given fields. A
+    field of None matches anything."""
+    __slots__ = ('id', 'service', 'severity', 'title', 'message', 'template', 'expires', 'deadline', 'slot',
+                 'rounds')
+
+    def __init__(self, snooze_id, service, severity, title, message, template, ttl):
+        self.id = snooze_id
+        self.service = service
+        self.severity = severity
+        self.title = title
+        self.message = message
+        self.template = template
+        self.expires = datetime.utcnow() + timedelta(seconds=ttl) if ttl else None
+        self.deadline = time.monotonic() + ttl if ttl else None
+        self.slot = None
+        self.rounds = 0
+
+    @property
+    def key(self):
+        return (self.service, self.severity, self.title, self.message, self.template)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'service': self.service,
+            'severity': self.severity.name if self.severity is not None else None,
+            'title': self.title,
+            'message': self.message,
+            'template': self.template,
+            'expires': self.expires.isoformat() if self.expires else None,
+        }
+
+
+class SnoozeStore:
+    """Active snoozes, indexed by the fields they match.
+
+    Checking an alert takes a fixed number of hash lookups, one per
+    combination of its severity, title, message and message template with
+    wildcards, however many snoozes are active. Snoozes with a TTL are
+    expired by a hashed timing wheel of `slots` slots, `tick` seconds apart,
+    so that expiring them never scans the whole store.
+    """
+
+    def __init__(self, tick=config.SNOOZE_TICK, slots=config.SNOOZE_SLOTS):
+        self.tick = tick
+        self._snoozes = {}
+        self._by_id = {}
+        self._wheel = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._ids = itertools.count(1)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, service, severity=None, title=None, message=None, template=None, ttl=None):
+        """Snooze the alerts of a service.
+
+        :param service: the name of the service
+        :param severity: (optional) only snooze alerts of this `Severity`
+        :param title: (optional) only snooze alerts with this title
+        :param message: (optional) only snooze alerts with this message
+        :param template: (optional) only snooze alerts whose message has this
+            template ID, e.g. to snooze a check whatever its readings
+        :param ttl: (optional) how long (in seconds) the snooze lasts.
+            Snoozes without a TTL last until they are removed.
+        :returns: the new snooze, replacing any other snooze with the same fields
+        :rtype: `Snooze`
+
+        """
+        snooze = Snooze(next(self._ids), service.lower(), severity, title, message, template, ttl)
+        with self._lock:
+            previous = self._snoozes.get(snooze.key)
+            if previous:
+                self._remove(previous)
+            self._snoozes[snooze.key] = snooze
+            self._by_id[snooze.id] = snooze
+            if ttl:
+                self._schedule(snooze, ttl)
+        return snooze
+
+    def _schedule(self, snooze, ttl):
+        """Place a snooze on the wheel. Must be called with the lock held."""
+        # The current slot may be about to turn, so add a tick to never expire early
+        ticks = -(-ttl // self.tick) + 1
+        snooze.slot = int(self._cursor + ticks) % len(self._wheel)
+        snooze.rounds = int((ticks - 1) // len(self._wheel))
+        self._wheel[snooze.slot].add(snooze)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._turn, daemon=True, name='klaxer-snooze')
+            self._thread.start()
+
+    def _remove(self, snooze):
+        """Drop a snooze. Must be called with the lock held."""
+        if self._snoozes.get(snooze.key) is snooze:
+            del self._snoozes[snooze.key]
+        self._by_id.pop(snooze.id, None)
+        if snooze.slot is not None:
+            self._wheel[snooze.slot].discard(snooze)
+
+    def remove(self, snooze_id):
+        """Remove a snooze by its ID.
+
+        :returns: whether the snooze existed
+        """
+        with self._lock:
+            snooze = self._by_id.get(snooze_id)
+            if snooze:
+                self._remove(snooze)
+            return snooze is not None
+
+    def clear(self, service=None):
+        """Remove every snooze, or only those of a service."""
+        with self._lock:
+            for snooze in list(self._by_id.values()):
+                if service is None or snooze.service == service.lower():
+                    self._remove(snooze)
+
+    def list(self):
+        """Get the active snoozes.
+
+        :returns: a list of `Snooze`s, oldest first
+        """
+        now = time.monotonic()
+        return [snooze for snooze in list(self._by_id.values())
+                if snooze.deadline is None or snooze.deadline > now]
+
+    def is_snoozed(self, alert):
+        """Determine whether an alert is snoozed.
+
+        :param alert: the alert to check
+        :returns: True if the alert should be dropped
+        """
+        if not self._snoozes:
+            return False
+        service = alert.service.lower()
+        now = time.monotonic()
+        for severity in (alert.severity, None):
+            for title in (alert.title, None):
+                for message in (alert.message, None):
+                    for template in (alert.template, None):
+                        snooze = self._snoozes.get((service, severity, title, message, template))
+                        # Expired snoozes may linger for up to a tick
+                        if snooze and (snooze.deadline is None or snooze.deadline > now):
+                            return True
+        return False
+
+    def _turn(self):
+        """Advance the wheel one slot per tick, expiring the snoozes due there"""
+        while True:
+            time.sleep(self.tick)
+            with self._lock:
+                self._cursor = (self._cursor + 1) % len(self._wheel)
+                for snooze in list(self._wheel[self._cursor]):
+                    if snooze.rounds:
+                        snooze.rounds -= 1
+                    else:
+                        self._remove(snooze)
+
+
+def parse_severity(name):
+    """Get a `Severity` from its name, as given to the snooze API"""
+    if name is None:
+        return None
+    try:
+        return Severity[name.upper()]
+    except (AttributeError, KeyError):
+        raise ValueError(f'Unknown severity {name}')
+
+
+def parse_ttl(value):
+    """Get a snooze TTL (in seconds), as given to the snooze API, which must be a positive number"""
+    if value is None:
+        return None
+    try:
+        ttl = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid ttl {value!r}: expected a number of seconds')
+    if not math.isfinite(ttl) or ttl <= 0:
+        raise ValueError(f'Invalid ttl {value!r}: expected a positive number of seconds')
+    return ttl
+
+
+def parse_template(value):
+    """Get a message template ID, as given to the snooze API, which must be a positive integer"""
+    if value is None:
+        return None
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+        raise ValueError(f'Invalid template {value!r}: expected a template ID')
+    return value
@@ -0,0 +1,186 @@
+"""A durable on-disk spool for accepted alerts"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from klaxer import config
+from klaxer.errors import SpoolFullError, SpoolUnavailableError
+from klaxer.models import Alert
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS alerts (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL
+)
+'''
+
+
+class _Entry:
+    """An alert waiting to be written to the spool"""
+    __slots__ = ('id', 'payload', 'written', 'error')
+
+    def __init__(self, alert):
+        self.id = alert.id
+        self.payload = alert.to_bytes()
+        self.written = threading.Event()
+        self.error = None
+
+
+class Spool:
+    """An append-only log of accepted alerts, stored in SQLite in WAL mode.
+
+    A single writer thread owns the database. Alerts appended while it is
+    committing are written together in its next transaction, so concurrent
+    requests share one fsync instead of paying for one each. `append` only
+    returns once the alert is on disk. Acknowledgements are batched the same
+    way, and acknowledged alerts are compacted away periodically.
+    """
+
+    def __init__(self, path=config.SPOOL_PATH, max_bytes=config.SPOOL_MAX_BYTES,
+                 compact_interval=config.SPOOL_COMPACT_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compact_interval = compact_interval
+        self.size = 0
+        self._appends = []
+        self._acks = []
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        # Must be set before the first table is created to take effect
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = FULL')
+        return conn
+
+    def open(self):
+        """Create the spool if needed and start the writer thread"""
+        with self._cond:
+            if self._thread:
+                return
+            conn = self._connect()
+            conn.execute(SCHEMA)
+            self._measure(conn)
+            conn.close()
+            self._closed = False
+            self._thread = threading.Thread(target=self._write, daemon=True, name='klaxer-spool')
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """Write out everything pending and stop the writer thread"""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._closed = True
+            self._cond.notify()
+        if thread:
+            thread.join()
+
+    def append(self, alert):
+        """Durably record an accepted alert.
+
+        :param alert: the alert to record
+        :raises SpoolFullError: if the spool has reached its size cap
+        :raises SpoolUnavailableError: if the spool could not be written
+        """
+        if self.size >= self.max_bytes:
+            raise SpoolFullError()
+        try:
+            if not self._thread:
+                self.open()
+        except sqlite3.Error as error:
+            logging.exception('Failed to open the spool')
+            raise SpoolUnavailableError() from error
+        entry = _Entry(alert)
+        with self._cond:
+            self._appends.append(entry)
+            self._cond.notify()
+        entry.written.wait()
+        if entry.error:
+            raise SpoolUnavailableError() from entry.error
+
+    def ack(self, alert_id):
+        """Mark an alert as delivered, so that it is not replayed.
+
+        :param alert_id: the ID of the delivered alert
+        """
+        with self._cond:
+            self._acks.append((alert_id,))
+            self._cond.notify()
+
+    def pending(self):
+        """Get the alerts that were accepted but never acknowledged, oldest first.
+
+        :returns: a list of `Alert`s
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT payload FROM alerts ORDER BY seq').fetchall()
+        finally:
+            conn.close()
+        return [Alert.from_bytes(payload) for (payload,) in rows]
+
+    def _measure(self, conn):
+        """Update the size of the spool, including its write-ahead log"""
+        page_count, = conn.execute('PRAGMA page_count').fetchone()
+        page_size, = conn.execute('PRAGMA page_size').fetchone()
+        try:
+            wal_size = os.path.getsize(f'{self.path}-wal')
+        except OSError:
+            wal_size = 0
+        self.size = page_count * page_size + wal_size
+
+    def _compact(self, conn):
+        """Return the space of acknowledged alerts to the file system"""
+        conn.execute('PRAGMA incremental_vacuum')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._measure(conn)
+
+    def _write(self):
+        """Commit appends and acknowledgements in batches until closed"""
+        conn = self._connect()
+        compacted = time.monotonic()
+        while True:
+            with self._cond:
+                if not (self._appends or self._acks or self._closed):
+                    self._cond.wait(self.compact_interval)
+                appends, self._appends = self._appends, []
+                acks, self._acks = self._acks, []
+                closed = self._closed
+
+            if appends or acks:
+                self._commit(conn, appends, acks)
+
+            if closed:
+                break
+            if time.monotonic() - compacted >= self.compact_interval:
+                self._compact(conn)
+                compacted = time.monotonic()
+        self._compact(conn)
+        conn.close()
+
+    def _commit(self, conn, appends, acks):
+        """Write a batch in a single transaction and wake up its writers"""
+        try:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT OR IGNORE INTO alerts (id, payload) VALUES (?, ?)',
+                             [(entry.id, entry.payload) for entry in appends])
+            conn.executemany('DELETE FROM alerts WHERE id = ?', acks)
+            conn.execute('COMMIT')
+            self._measure(conn)
+        except sqlite3.Error as error:
+            logging.exception('Failed to write to the spool')
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for entry in appends:
+                entry.error = error
+        for entry in appends:
+            entry.written.set()
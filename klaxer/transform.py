@@ -0,0 +1,173 @@
+"""Transformers declared in the config
+
+A service may declare how its payloads map onto alerts instead of relying
+on a hand-written transformer:
+
+    transform:
+        title: "alerts[0].labels.alertname"
+        message: ["alerts[0].annotations.description", "alerts[0].annotations.summary"]
+        target:
+            path: "receiver"
+            strip: "#"
+            default: "alerts"
+
+Each field is given a path into the payload, a list of paths tried in turn,
+or a mapping with the path(s), a default used when none of them resolves,
+and characters to strip from the ends of the value. Paths are parsed when
+the config is loaded, into accessors stepping through the payload.
+"""
+
+import datetime
+import operator
+import re
+
+from klaxer.errors import ConfigurationError
+
+# The fields a transformer provides. Those that must be declared map to True.
+FIELDS = {
+    'title': True,
+    'message': True,
+    'target': False,
+    'username': False,
+    'icon_emoji': False,
+    'icon_url': False,
+}
+
+# One step of a path: a key (foo) or an array index ([0])
+STEP_PATTERN = re.compile(r'\.?([^.\[\]]+)|\[(-?\d+)\]')
+
+# Raised by an accessor whose path does not resolve
+_MISSING = (KeyError, IndexError, TypeError)
+
+# Marks a field without a default
+_REQUIRED = object()
+
+
+def parse_path(path):
+    """Split a path into the keys and indices it steps through
+
+    :param path: A path such as "attachments[0].title"
+    :returns: list - The keys (as str) and indices (as int) of the path
+    """
+    steps, position = [], 0
+    while position < len(path):
+        match = STEP_PATTERN.match(path, position)
+        if not match or (position == 0 and match.group(0).startswith('.')):
+            raise ConfigurationError(f'invalid transform path {path!r}')
+        key, index = match.groups()
+        steps.append(key if index is None else int(index))
+        position = match.end()
+    if not steps:
+        raise ConfigurationError('transform paths cannot be empty')
+    return steps
+
+
+def compile_path(path):
+    """Compile a path into a function getting its value from a payload
+
+    The function indexes into the payload one step at a time, just as a
+    hand-written transformer would, and raises KeyError, IndexError or
+    TypeError when the path does not resolve.
+
+    :param path: A path such as "attachments[0].title"
+    :returns: function
+    """
+    steps = parse_path(path)
+    if len(steps) == 1:
+        return operator.itemgetter(steps[0])
+
+    def get(data):
+        for step in steps:
+            data = data[step]
+        return data
+    return get
+
+
+def compile_field(name, spec):
+    """Compile the declaration of a field into a function getting its value
+    from a payload
+
+    :param name: The name of the field
+    :param spec: A path, a list of paths, or a mapping with `path` (a path or
+        list of paths), `default` and `strip`
+    :returns: function
+    """
+    default, strip = _REQUIRED, None
+    if isinstance(spec, dict):
+        unknown = set(spec) - {'path', 'default', 'strip'}
+        if unknown:
+            raise ConfigurationError(f'unknown transform options for {name}: {", ".join(sorted(unknown))}')
+        default = spec.get('default', _REQUIRED)
+        strip = spec.get('strip')
+        spec = spec.get('path', [])
+    paths = [spec] if isinstance(spec, str) else spec
+    if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+        raise ConfigurationError(f'invalid transform paths for {name}')
+    if not paths and default is _REQUIRED:
+        raise ConfigurationError(f'transform field {name} needs a path or a default')
+    if strip is not None and not isinstance(strip, str):
+        raise ConfigurationError(f'strip for {name} must be a string of characters')
+
+    if not paths:
+        get = lambda data: default
+    elif len(paths) == 1 and default is _REQUIRED:
+        get = compile_path(paths[0])
+    elif len(paths) == 1 and len(parse_path(paths[0])) == 1:
+        # An optional key of the payload
+        key = parse_path(paths[0])[0]
+        get = lambda data: data.get(key, default)
+    else:
+        get = _fallback([compile_path(path) for path in paths], default)
+
+    if strip is None:
+        return get
+    return lambda data: _strip(get(data), strip)
+
+
+def _fallback(accessors, default):
+    """Get a function returning the value of the first accessor that resolves"""
+    def get(data):
+        for accessor in accessors:
+            try:
+                return accessor(data)
+            except _MISSING:
+                continue
+        if default is _REQUIRED:
+            # Fail as a lookup of the first path would
+            return accessors[0](data)
+        return default
+    return get
+
+
+def _strip(value, chars):
+    return value.strip(chars) if isinstance(value, str) else value
+
+
+def compile_transformer(service, spec):
+    """Compile the `transform` section of a service into a transformer
+
+    The transformer builds the arguments of an Alert with the accessors of
+    the declared fields, leaving the others None.
+
+    :param service: The name of the service
+    :param spec: The mapping of alert fields to their declarations
+    :returns: function - A transformer returning the arguments of an Alert
+        for a payload, like those registered in `models.TRANSFORMERS`
+    """
+    if not isinstance(spec, dict):
+        raise ConfigurationError(f'transform for {service} must map alert fields to paths')
+    unknown = set(spec) - set(FIELDS)
+    if unknown:
+        raise ConfigurationError(f'unknown transform fields for {service}: {", ".join(sorted(unknown))}')
+    missing = [field for field, required in FIELDS.items() if required and field not in spec]
+    if missing:
+        raise ConfigurationError(f'transform for {service} must define {", ".join(missing)}')
+
+    accessors = [(field, compile_field(field, spec[field])) for field in FIELDS if field in spec]
+    undeclared = dict.fromkeys(field for field in FIELDS if field not in spec)
+
+    def transform(data):
+        values = {field: get(data) for field, get in accessors}
+        values.update(undeclared, timestamp=datetime.datetime.now())
+        return values
+    return transform
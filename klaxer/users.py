@@ -1,17 +1,22 @@
 """Methods, classes, and functions for getting your Klaxer registration on."""
 
+import atexit
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from uuid import uuid4
 from datetime import datetime
 
 import hug
-from sqlalchemy import create_engine, ForeignKey, Column, Integer, String, \
-    Boolean, Date, Text
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import create_engine, event, ForeignKey, Column, Integer, String, \
+    Boolean, Date, Text, Index, bindparam
+from sqlalchemy.orm import scoped_session, selectinload, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 from klaxer import config
+from klaxer.metrics import METRICS
 
 if config.DB_CONNECTION == 'sqlite':
     DB_CONNECTION_STRING = 'sqlite:///klaxer.db'
@@ -26,10 +31,36 @@ else:
     print("Please, provide the correct Data Base")
 
 
-engine = create_engine(DB_CONNECTION_STRING)
+if config.DB_CONNECTION == 'sqlite':
+    # The connection is shared by hug's worker threads, which SQLite
+    # serializes itself. Wait on locks held by other writers instead of failing.
+    engine = create_engine(DB_CONNECTION_STRING, connect_args={
+        'check_same_thread': False,
+        'timeout': config.SQLITE_BUSY_TIMEOUT,
+    })
+
+    @event.listens_for(engine, 'connect')
+    def _configure_sqlite(dbapi_connection, connection_record):
+        """Let readers proceed alongside a writer."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        cursor.close()
+else:
+    engine = create_engine(DB_CONNECTION_STRING,
+                           pool_size=config.DB_POOL_SIZE,
+                           max_overflow=config.DB_POOL_OVERFLOW,
+                           pool_recycle=config.DB_POOL_RECYCLE,
+                           pool_pre_ping=True)
+
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+# Each thread gets its own session, which is removed at the end of every request
+session = scoped_session(Session)
+
+# What authenticating a request needs to know about its user. Unlike a
+# `KlaxerUser`, it is bound to no session, so it can be shared between threads.
+Identity = namedtuple('Identity', ['id', 'api_key', 'approved'])
 
 
 class KlaxerUser(Base):
@@ -46,6 +77,11 @@ class KlaxerUser(Base):
     calls = Column(Integer, default=0)
     messages = relationship("KlaxerMessage", backref="user")
 
+    __table_args__ = (
+        Index('ix_user_api_key', 'api_key', unique=True),
+        Index('ix_user_email', 'email', unique=True),
+    )
+
     def __repr__(self):
         return '<KlaxerUser {}>'.format(self.id)
 
@@ -64,7 +100,7 @@ class KlaxerUser(Base):
             'approved': self.approved,
             'signup_date': self.signup_date,
             'api_key': self.api_key,
-            'calls': self.calls,
+            'calls': self.calls + CALLS.pending(self.id),
             'messages': [message.text for message in self.messages]
         }
 
@@ -140,6 +176,7 @@ def approve(user):
             session.delete(message)
     session.add(user)
     session.commit()
+    KEYS.invalidate(user.api_key)
     return user
 
 
@@ -156,6 +193,7 @@ def add_message(user, text, can_dismiss=True):
     message = KlaxerMessage(text=text, user=user, can_dismiss=can_dismiss)
     session.add(message)
     session.commit()
+    KEYS.invalidate(user.api_key)
     return message
 
 
@@ -176,17 +214,168 @@ def is_existing_user(email):
 def bootstrap():
     """Bootstrap the Klaxer user database."""
     Base.metadata.create_all(engine)
+    migrate()
+
+
+def migrate():
+    """Bring an existing Klaxer user database up to date.
+
+    Tables created by `bootstrap` already have every index, but older
+    databases are missing the ones added since.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception: # pylint: disable=broad-except
+                logging.exception('Failed to create index %s, check for duplicate values', index.name)
+
+
+def end_session():
+    """Release the current thread's database session."""
+    session.remove()
+
+
+class KeyCache:
+    """A thread-safe LRU cache of verified API keys and the `Identity` of their users.
+
+    Entries expire `ttl` seconds after they were loaded, and the least
+    recently used entries are evicted past `size` entries.
+    """
+
+    def __init__(self, size=config.API_KEY_CACHE_SIZE, ttl=config.API_KEY_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        """Get the cached user for an API key.
+
+        :param api_key: the API key to look up
+        :returns: the identity of the user, or None if the key is not cached
+        :rtype: `klaxer.users.Identity`
+
+        """
+        with self._lock:
+            entry = self._users.get(api_key)
+            if entry is None:
+                METRICS.inc('klaxer_cache_requests_total', ('api_keys', 'miss'))
+                return None
+            user, expires = entry
+            if time.monotonic() >= expires:
+                del self._users[api_key]
+                METRICS.inc('klaxer_cache_requests_total', ('api_keys', 'expired'))
+                return None
+            self._users.move_to_end(api_key)
+            METRICS.inc('klaxer_cache_requests_total', ('api_keys', 'hit'))
+            return user
+
+    def __len__(self):
+        return len(self._users)
+
+    def put(self, api_key, user):
+        """Cache the `Identity` of the user of a verified API key."""
+        with self._lock:
+            self._users[api_key] = (user, time.monotonic() + self.ttl)
+            self._users.move_to_end(api_key)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, api_key):
+        """Drop an API key from the cache, e.g. because its user changed."""
+        with self._lock:
+            self._users.pop(api_key, None)
+
+
+class CallCounter:
+    """Accumulates API call counts in memory and writes them behind.
+
+    Counts are flushed to the database as one batched UPDATE every
+    `interval` seconds, and once more at shutdown.
+    """
+
+    def __init__(self, interval=config.CALL_FLUSH_INTERVAL):
+        self.interval = interval
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, user_id):
+        """Count a call made by a user."""
+        with self._lock:
+            self._counts[user_id] = self._counts.get(user_id, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='klaxer-calls')
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def pending(self, user_id):
+        """The number of calls by a user not yet written to the database."""
+        return self._counts.get(user_id, 0)
+
+    def flush(self):
+        """Write the accumulated call counts to the database."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        if not counts:
+            return
+        table = KlaxerUser.__table__
+        statement = table.update().where(table.c.id == bindparam('user_id')).values(
+            calls=table.c.calls + bindparam('count'))
+        # A session of its own, as the flush runs outside of any request
+        flush_session = Session()
+        try:
+            flush_session.execute(statement, [{'user_id': user_id, 'count': count}
+                                              for user_id, count in counts.items()])
+            flush_session.commit()
+        except Exception: # pylint: disable=broad-except
+            flush_session.rollback()
+            logging.exception('Failed to write call counts, retrying later')
+            with self._lock:
+                for user_id, count in counts.items():
+                    self._counts[user_id] = self._counts.get(user_id, 0) + count
+        finally:
+            flush_session.close()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+KEYS = KeyCache()
+CALLS = CallCounter()
 
 
 def verify(api_key):
-    """Verify that the API key provided is valid."""
-    user = session.query(KlaxerUser).filter(KlaxerUser.api_key==api_key).first()
-    if user:
-        user.calls += 1
-    session.add(user)
-    session.commit()
+    """Verify that the API key provided is valid.
+
+    :returns: the identity of the key's user, or None if the key is invalid
+    :rtype: `klaxer.users.Identity`
+    """
+    user = KEYS.get(api_key)
+    if user is None:
+        row = session.query(KlaxerUser.id, KlaxerUser.api_key, KlaxerUser.approved) \
+            .filter(KlaxerUser.api_key==api_key).first()
+        if row is None:
+            return None
+        user = Identity(*row)
+        KEYS.put(api_key, user)
+    CALLS.add(user.id)
     return user
 
 
+def get_user(user_id):
+    """Load a user with their messages.
+
+    :param user_id: the ID of the user
+    :returns: the user, or None if there is no such user
+    :rtype: `klaxer.users.KlaxerUser`
+    """
+    return session.query(KlaxerUser).options(selectinload(KlaxerUser.messages)) \
+        .filter(KlaxerUser.id==user_id).first()
+
+
 # This is used as a middleware for hug to do verification
 api_key_authentication = hug.authentication.api_key(verify)
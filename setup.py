@@ -15,8 +15,8 @@ REQUIREMENTS = [
     'psycopg2'
 ]
 
-if sys.version_info <= (3, 6):
-    sys.stderr.write('Python 3.6+ is required.' + os.linesep)
+if sys.version_info < (3, 7):
+    sys.stderr.write('Python 3.7+ is required.' + os.linesep)
     sys.exit(1)
 
 # Get the long description from the relevant file
@@ -37,7 +37,11 @@ setup(name='klaxer',
           'Intended Audience :: System Administrators',
           'License :: OSI Approved :: MIT License',
           'Framework :: Flask',
-          'Programming Language :: Python :: 3.6',
+          'Programming Language :: Python :: 3.7',
+          'Programming Language :: Python :: 3.8',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
+          'Programming Language :: Python :: 3.11',
           'Programming Language :: Python :: 3 :: Only',
           'Topic :: Communications :: Chat',
       ],
@@ -50,6 +54,7 @@ setup(name='klaxer',
       packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
       include_package_data=True,
       zip_safe=True,
+      python_requires='>=3.7',
       install_requires=REQUIREMENTS,
       extras_require={
           'dev': ['pytest', 'coverage', 'pylint', 'pytest-cov'],
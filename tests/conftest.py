@@ -0,0 +1,28 @@
+"""Shared fixtures"""
+
+import os
+import tempfile
+from datetime import datetime
+
+import pytest
+
+# Point the rules at the sample config before anything imports klaxer.config,
+# and keep the database and spool the API creates in the working directory
+# out of the checkout
+os.environ.setdefault('KLAXER_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                                    'config', 'klaxer.sample.yml'))
+os.chdir(tempfile.mkdtemp(prefix='klaxer-tests-'))
+
+from klaxer.models import Alert, Severity  # pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def make_alert():
+    """Build routed alerts"""
+    def make(target='#alerts', severity=Severity.WARNING, title='disk full', message='disk / is 95% full',
+             service='sensu'):
+        alert = Alert(service, title=title, message=message, timestamp=datetime(2026, 1, 1), target=target,
+                      username='klaxer', icon_emoji=':rotating_light:', icon_url=None)
+        alert.severity = severity
+        return alert
+    return make
@@ -0,0 +1,107 @@
+"""Tests of the alert endpoints"""
+
+import json
+from types import SimpleNamespace
+
+import falcon
+import hug
+import pytest
+
+from klaxer import api
+from klaxer.dedup import Deduplicator
+from klaxer.models import Severity
+
+SENSU_ALERT = {'channel': '#alerts', 'username': 'sensu',
+               'attachments': [{'title': 'CheckDisk', 'text': 'CheckDisk failure: 512 bytes left on /'}]}
+
+
+@pytest.fixture(autouse=True)
+def sent(monkeypatch):
+    """Collect the delivered alerts instead of sending them to Slack"""
+    delivered = []
+    monkeypatch.setattr(api.DELIVERY, 'send', delivered.append)
+    return delivered
+
+
+def test_debug_stream():
+    body = '\n'.join(json.dumps(SENSU_ALERT) for _ in range(2)) + '\n'
+    response = hug.test.post(api, '/alerts/sensu/token/stream', body=body, debug=True,
+                             headers={'content-type': 'application/x-ndjson'})
+    results = [json.loads(line) for line in response.data.splitlines()]
+    assert len(results) == 2
+    for result in results:
+        assert result['severity'] == str(Severity.CRITICAL)
+        assert result['timestamp']
+        assert result['trace']['timings_us']
+
+
+@pytest.mark.parametrize('ttl', [-5, 0, 'inf', 'nan', 'soon', [60]])
+def test_snooze_rejects_invalid_ttls(ttl):
+    response = falcon.Response()
+    result = api.snooze(response, {'service': 'sensu', 'ttl': ttl})
+    assert response.status == falcon.HTTP_400
+    assert 'ttl' in result['status']
+    assert api.SNOOZES.list() == []
+
+
+@pytest.mark.parametrize('body', [{'service': 'sensu', 'template': template} for template in
+                                  (0, -1, 1.5, 'DiskFull', [3], {}, True)] +
+                                 [{'service': 'sensu', 'severity': 3}, {'service': 5}, ['sensu']])
+def test_snooze_rejects_invalid_fields(body):
+    response = falcon.Response()
+    api.snooze(response, body)
+    assert response.status == falcon.HTTP_400
+    assert api.SNOOZES.list() == []
+
+
+@pytest.mark.parametrize('template, expected', [(None, None), (3, 3), ('3', 3)])
+def test_snooze_with_template(template, expected):
+    response = falcon.Response()
+    entry = api.snooze(response, {'service': 'sensu', 'template': template})
+    assert entry['template'] == expected
+    assert api.SNOOZES.remove(entry['id'])
+
+
+def test_snooze_with_ttl():
+    response = falcon.Response()
+    entry = api.snooze(response, {'service': 'sensu', 'ttl': 60})
+    assert api.SNOOZES.remove(entry['id'])
+
+
+@pytest.mark.parametrize('body', [{'seconds': -1}, {'seconds': 'inf'}, {'requests': 0}, {'requests': 'nan'},
+                                  {'interval': [0.01]}, {'interval': {}}])
+def test_profiler_rejects_invalid_options(body):
+    response = falcon.Response()
+    result = api.start_profiler(SimpleNamespace(approved=True), response, body)
+    assert response.status == falcon.HTTP_400
+    assert 'Invalid' in result['status']
+    assert not api.PROFILER.running
+
+
+def test_malformed_alerts_only_fail_themselves():
+    response = hug.test.post(api, '/alerts/sensu/token', body=[SENSU_ALERT, {'channel': '#alerts'}, 42])
+    statuses = [result['status'] for result in response.data['results']]
+    assert statuses == ['accepted', 'Malformed alert', 'Malformed alert']
+
+
+def test_malformed_alert_is_a_bad_request():
+    response = hug.test.post(api, '/alert/sensu/token', body={'channel': '#alerts'})
+    assert response.status == falcon.HTTP_400
+
+
+def test_repeats_are_reported_as_deduplicated(monkeypatch):
+    monkeypatch.setattr(api, 'DEDUP', Deduplicator(window=60))
+    try:
+        responses = [hug.test.post(api, '/alert/sensu/token', body=SENSU_ALERT) for _ in range(2)]
+    finally:
+        api.DEDUP.close()
+    assert responses[0].data['status'] == 'accepted'
+    assert responses[1].data == {'status': 'deduplicated'}
+
+
+def test_services_without_a_transformer_are_server_errors(monkeypatch):
+    monkeypatch.setattr(api.RULES, 'get_pipeline', lambda service: SimpleNamespace(transform=None))
+    response = falcon.Response()
+    result = api.incoming('nagios', 'token', response, body=SENSU_ALERT)
+    assert response.status == falcon.HTTP_500
+    assert 'transformer' in result['status']
@@ -0,0 +1,80 @@
+"""Tests of the coalescer's handoff to the delivery queue"""
+
+import threading
+import time
+
+from klaxer.coalesce import Coalescer
+from klaxer.delivery import DeliveryQueue
+from klaxer.models import Digest, Severity
+
+
+def _targets_on_separate_shards(queue):
+    """Find two channels whose alerts go to different workers"""
+    shards = {}
+    for index in range(100):
+        target = f'#channel-{index}'
+        shards.setdefault(hash(target) % len(queue._queues), target)
+        if len(shards) == 2:
+            return list(shards.values())
+    raise AssertionError('No two channels on separate shards')
+
+
+def _blocked_queue(coalescer, timeout=0.5):
+    """A delivery queue of two workers holding one item each, whose sends block until released"""
+    release = threading.Event()
+    sent = []
+
+    def send(item):
+        release.wait()
+        sent.append(item)
+
+    deliveries = DeliveryQueue(send, coalescer=coalescer, workers=2, maxsize=1, timeout=timeout)
+    return deliveries, release, sent
+
+
+def test_full_queue_does_not_block_other_channels(make_alert):
+    coalescer = Coalescer(window=60, max_batch=50)
+    deliveries, release, sent = _blocked_queue(coalescer, timeout=0.5)
+    try:
+        deliveries.start()
+        busy, idle = _targets_on_separate_shards(deliveries)
+        # One item being sent and one waiting fill the busy channel's worker
+        coalescer.put(make_alert(target=busy, severity=Severity.CRITICAL))
+        time.sleep(0.1)
+        coalescer.put(make_alert(target=busy, severity=Severity.CRITICAL))
+
+        held = make_alert(target=busy, severity=Severity.CRITICAL)
+        stuck = threading.Thread(target=coalescer.put, args=(held,))
+        stuck.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        coalescer.put(make_alert(target=idle))
+        assert coalescer.depth >= 1
+        assert time.monotonic() - started < 0.2
+        stuck.join()
+        # The batch that found no room is kept for the next flush
+        assert coalescer._buffers[busy][0].severity == Severity.CRITICAL
+    finally:
+        release.set()
+        deliveries.stop(timeout=5)
+    assert [item.target for item in sent].count(busy) == 3
+
+
+def test_held_batch_is_released_ahead_of_newer_alerts(make_alert):
+    coalescer = Coalescer(window=60, max_batch=50)
+    deliveries, release, sent = _blocked_queue(coalescer, timeout=0.2)
+    try:
+        deliveries.start()
+        target = _targets_on_separate_shards(deliveries)[0]
+        for title in ('first', 'second', 'third'):
+            coalescer.put(make_alert(target=target, title=title, severity=Severity.CRITICAL))
+            time.sleep(0.05)
+        coalescer.put(make_alert(target=target, title='fourth'))
+        release.set()
+    finally:
+        release.set()
+        deliveries.stop(timeout=5)
+    titles = []
+    for item in sent:
+        titles.extend(alert.title for alert in (item.alerts if isinstance(item, Digest) else [item]))
+    assert titles == ['first', 'second', 'third', 'fourth']
@@ -0,0 +1,69 @@
+"""Tests of the deduplication of repeated alerts"""
+
+import threading
+import time
+
+from klaxer.dedup import Deduplicator
+
+
+def test_repeats_are_absorbed_within_the_window(make_alert):
+    dedup = Deduplicator(window=0.2, mode='suppress')
+    assert not dedup.check(make_alert())
+    assert dedup.check(make_alert())
+    assert not dedup.check(make_alert(message='disk / is 96% full'))
+    time.sleep(0.25)
+    assert not dedup.check(make_alert())
+    assert dedup.stats() == {'hits': 1, 'misses': 3, 'evictions': 0, 'entries': 2}
+
+
+def test_aggregated_repeats_are_released_when_the_window_closes(make_alert):
+    released = []
+    done = threading.Event()
+
+    def emit(alert):
+        released.append(alert)
+        done.set()
+
+    dedup = Deduplicator(window=0.05)
+    dedup.start(emit)
+    try:
+        alerts = [make_alert() for _ in range(3)]
+        assert [dedup.check(alert) for alert in alerts] == [False, True, True]
+        assert done.wait(5)
+    finally:
+        dedup.close()
+    assert released == [alerts[2]]
+    assert alerts[2].count == 2
+
+
+def test_unreleased_repeats_are_counted_on_the_next_alert(make_alert):
+    dedup = Deduplicator(window=0.05)
+    for _ in range(3):
+        dedup.check(make_alert())
+    time.sleep(0.1)
+    alert = make_alert()
+    assert not dedup.check(alert)
+    assert alert.count == 3
+
+
+def test_open_windows_are_released_on_close(make_alert):
+    released = []
+    dedup = Deduplicator(window=60)
+    dedup.start(released.append)
+    alerts = [make_alert() for _ in range(2)]
+    for alert in alerts:
+        dedup.check(alert)
+    dedup.close()
+    assert released == [alerts[1]]
+    assert alerts[1].count == 1
+
+
+def test_suppressed_repeats_are_not_released(make_alert):
+    released = []
+    dedup = Deduplicator(window=0.05, mode='suppress')
+    dedup.start(released.append)
+    for _ in range(3):
+        dedup.check(make_alert())
+    time.sleep(0.1)
+    dedup.close()
+    assert released == []
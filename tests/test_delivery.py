@@ -0,0 +1,114 @@
+"""Tests of the delivery queue's failure handling"""
+
+import queue
+import sqlite3
+import threading
+
+import pytest
+
+from klaxer import config, sinks
+from klaxer.delivery import DeliveryQueue
+from klaxer.errors import DeliveryQueueFullError, SpoolUnavailableError
+from klaxer.fakeslack import FakeSlack
+from klaxer.ratelimit import SlackScheduler
+from klaxer.spool import Spool
+
+
+def test_rejected_alert_is_not_replayed(tmp_path, make_alert, monkeypatch):
+    spool = Spool(str(tmp_path / 'klaxer.spool'))
+    deliveries = DeliveryQueue(lambda item: None, spool=spool, workers=1, timeout=0.01)
+    deliveries.start()
+
+    def full(item, timeout=None):
+        raise queue.Full()
+    monkeypatch.setattr(deliveries._queues[0], 'put', full)
+    with pytest.raises(DeliveryQueueFullError):
+        deliveries.put(make_alert())
+    spool.close()
+    assert spool.pending() == []
+
+
+def test_full_queue_waits_for_room(make_alert):
+    started, release = threading.Event(), threading.Event()
+
+    def send(item):
+        started.set()
+        release.wait(5)
+
+    deliveries = DeliveryQueue(send, workers=1, maxsize=1, timeout=5)
+    deliveries.put(make_alert())
+    assert started.wait(5)
+    deliveries.put(make_alert())
+    timer = threading.Timer(0.05, release.set)
+    timer.start()
+    alert = make_alert()
+    assert deliveries.put(alert) == alert.id
+    deliveries.stop(timeout=5)
+
+
+def test_failed_delivery_is_retried(tmp_path, make_alert):
+    sent = []
+    done = threading.Event()
+
+    def send(item):
+        sent.append(item)
+        if len(sent) < 3:
+            raise ConnectionError('Slack is down')
+        done.set()
+
+    spool = Spool(str(tmp_path / 'klaxer.spool'))
+    deliveries = DeliveryQueue(send, spool=spool, workers=1, attempts=3, backoff=0.01)
+    alert = make_alert()
+    deliveries.put(alert)
+    assert done.wait(5)
+    deliveries.stop(timeout=5)
+    spool.close()
+    assert [item.id for item in sent] == [alert.id] * 3
+    assert spool.pending() == []
+
+
+def test_retried_alert_is_sent_unchanged(make_alert, monkeypatch):
+    with FakeSlack(channels=['alerts']) as slack:
+        monkeypatch.setattr(config, 'SLACK_API_URL', slack.url)
+        monkeypatch.setattr(sinks, 'CHANNELS', {})
+        monkeypatch.setattr(sinks, 'LAST_MESSAGES', sinks.MessageLog())
+        monkeypatch.setattr(sinks, 'SCHEDULER', SlackScheduler(method_limits={}, backoff=0.01))
+        sinks.Slack('alerts').send_alert(make_alert(target='alerts'))
+        slack.fail('chat.update', error='message_not_found')
+        slack.fail('chat.postMessage')
+        deliveries = DeliveryQueue(lambda item: sinks.Slack(item.target).send_alert(item),
+                                   workers=1, attempts=3, backoff=0.01)
+        deliveries.start()
+        alert = make_alert(target='alerts')
+        queued = (alert.message, alert.count)
+        deliveries.put(alert)
+        deliveries.stop(timeout=5)
+        messages = slack.messages('alerts')
+    assert [message['attachments'][0]['text'] for message in messages] == ['disk / is 95% full (x2)']
+    assert (alert.message, alert.count) == queued
+
+
+def test_failed_delivery_stays_spooled(tmp_path, make_alert):
+    def send(item):
+        raise ConnectionError('Slack is down')
+
+    spool = Spool(str(tmp_path / 'klaxer.spool'))
+    deliveries = DeliveryQueue(send, spool=spool, workers=1, attempts=2, backoff=0.01)
+    alert = make_alert()
+    deliveries.put(alert)
+    deliveries.stop(timeout=5)
+    spool.close()
+    assert [pending.id for pending in spool.pending()] == [alert.id]
+
+
+def test_unwritable_spool(tmp_path, make_alert):
+    spool = Spool(str(tmp_path / 'klaxer.spool'))
+    deliveries = DeliveryQueue(lambda item: None, spool=spool, workers=1)
+    deliveries.start()
+    conn = sqlite3.connect(spool.path)
+    conn.execute('DROP TABLE alerts')
+    conn.close()
+    with pytest.raises(SpoolUnavailableError):
+        deliveries.put(make_alert())
+    deliveries.stop(timeout=5)
+    spool.close()
@@ -0,0 +1,16 @@
+"""Tests of the request streaming helpers"""
+
+import io
+
+from klaxer.lib import read_lines
+
+
+def test_read_lines_across_chunks():
+    body = b'{"a": 1}\n\n' + b'x' * 50 + b'\n{"b": 2}'
+    assert list(read_lines(io.BytesIO(body), chunk_size=7)) == [b'{"a": 1}', b'x' * 50, b'{"b": 2}']
+
+
+def test_read_lines_of_one_long_line():
+    body = b'y' * 1000
+    assert list(read_lines(io.BytesIO(body), chunk_size=3)) == [body]
+
@@ -0,0 +1,86 @@
+"""Tests of the rule matchers"""
+
+import random
+import re
+
+import pytest
+
+from klaxer.matching import KeywordMatcher, PatternMatcher, check_backtracking
+
+
+def test_keyword_matcher_finds_every_substring():
+    rng = random.Random(1)
+    for _ in range(300):
+        keywords = {''.join(rng.choice('abc') for _ in range(rng.randint(0, 4)))
+                    for _ in range(rng.randint(1, 8))}
+        matcher = KeywordMatcher(keywords)
+        for _ in range(10):
+            text = ''.join(rng.choice('abc ') for _ in range(rng.randint(0, 16)))
+            assert matcher.search(text) == {keyword for keyword in keywords if keyword in text}, \
+                (keywords, text)
+
+
+def random_pattern(rng, depth=0):
+    """Build a small random regular expression over the letters a, b and c"""
+    atoms = ['a', 'b', 'c', '.', '[ab]', r'\b']
+    if depth < 2:
+        atoms += ['group', 'branch']
+    parts = []
+    for _ in range(rng.randint(1, 3)):
+        atom = rng.choice(atoms)
+        if atom == 'group':
+            atom = f'({random_pattern(rng, depth + 1)})'
+        elif atom == 'branch':
+            atom = f'(?:{random_pattern(rng, depth + 1)}|{random_pattern(rng, depth + 1)})'
+        if atom != r'\b':
+            atom += rng.choice(['', '', '?', '*', '+', '{1,2}'])
+        parts.append(atom)
+    return ''.join(parts)
+
+
+def test_pattern_matcher_matches_like_each_pattern():
+    rng = random.Random(1)
+    for _ in range(300):
+        patterns = [re.compile(random_pattern(rng), re.IGNORECASE) for _ in range(rng.randint(1, 5))]
+        matcher = PatternMatcher(patterns)
+        for _ in range(10):
+            text = ''.join(rng.choice('abc ') for _ in range(rng.randint(0, 12)))
+            found = matcher.search(text)
+            for pattern in patterns:
+                expected = pattern.search(text)
+                match = found.get(pattern)
+                if expected is None:
+                    assert match is None
+                else:
+                    assert (match.span(), match.groups()) == (expected.span(), expected.groups()), \
+                        (pattern.pattern, text)
+
+
+@pytest.mark.parametrize('pattern', [
+    r'(a+)+b',
+    r'(a|b?)*c',
+    r'(?>(a+)+b)',
+    r'(a+){2,30}b',
+    r'(a+){3}b',
+    r'(?:x[a-z]+X)+',
+    r'(a|a)*b',
+    r'(?:a|ab)*c',
+    r'(\w|\d)+x',
+])
+def test_runaway_patterns_are_rejected(pattern):
+    with pytest.raises(ValueError):
+        check_backtracking(pattern)
+
+
+@pytest.mark.parametrize('pattern', [
+    r'a+b+',
+    r'(ab)+',
+    r'(\d+\.)+\d+',
+    r'(\d{1,3}\.){3}\d{1,3}',
+    r'(?:[a-z]+\.)+com',
+    r'(foo|bar)+',
+    r'(a|b)*c',
+    r'[0-9a-fA-F]+',
+])
+def test_safe_repeats_are_allowed(pattern):
+    check_backtracking(pattern)
@@ -0,0 +1,23 @@
+"""Tests of the sampling profiler"""
+
+import threading
+
+from klaxer.profiler import SamplingProfiler
+
+
+def test_request_limit_is_exact_across_threads():
+    profiler = SamplingProfiler(interval=0.001, max_duration=5)
+    profiler.start(requests=50)
+
+    def serve():
+        for _ in range(20):
+            profiler.enter()
+            profiler.leave()
+
+    threads = [threading.Thread(target=serve) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    profiler.stop()
+    assert profiler.status()['requests'] == 50
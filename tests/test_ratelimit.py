@@ -0,0 +1,50 @@
+"""Tests of the scheduling of Slack API calls, against a fake Slack"""
+
+import time
+
+import pytest
+import requests
+from slacker import Slacker
+
+from klaxer.fakeslack import FakeSlack
+from klaxer.ratelimit import SlackScheduler
+from klaxer.sinks import SlackSession
+
+
+@pytest.fixture
+def slack():
+    with FakeSlack(channels=['alerts']) as fake:
+        yield fake
+
+
+@pytest.fixture
+def client(slack):
+    return Slacker('token', session=SlackSession(slack.url))
+
+
+def test_throttled_call_without_buckets_waits(slack, client):
+    slack.limits = {'api.test': (1, 1)}
+    scheduler = SlackScheduler(method_limits={}, attempts=3, backoff=0.01, max_delay=5)
+    scheduler.call('api.test', client.api.test)
+    started = time.monotonic()
+    scheduler.call('api.test', client.api.test)
+    assert time.monotonic() - started >= 0.9
+    assert [call.status for call in slack.calls] == [200, 429, 200]
+
+
+def test_server_errors_are_retried(slack, client):
+    slack.fail('channels.history', status=500)
+    scheduler = SlackScheduler(attempts=3, backoff=0.01)
+    channel = next(iter(slack.channels))
+    scheduler.call('channels.history', client.channels.history, channel=channel, count=1)
+    assert slack.count('channels.history') == 2
+
+
+def test_posts_are_not_retried_on_server_errors(slack, client):
+    slack.fail('chat.postMessage', status=500)
+    scheduler = SlackScheduler(attempts=3, backoff=0.01)
+    with pytest.raises(requests.HTTPError):
+        scheduler.call('chat.postMessage', client.chat.post_message, channel=next(iter(slack.channels)),
+                       text='disk full')
+    assert slack.count('chat.postMessage') == 1
+    assert slack.messages('alerts') == []
@@ -0,0 +1,117 @@
+"""Tests of rule compilation"""
+
+import os
+import random
+
+import pytest
+import yaml
+
+from klaxer.clustering import TemplateMiner
+from klaxer.models import Severity
+from klaxer.errors import ConfigurationError
+from klaxer.rules import ReloadingRules, Rules
+
+CONFIG = r'''
+sensu:
+    message:
+        classification:
+            CRITICAL: ["failure"]
+            CRITICAL_RE: ["disk \\d+"]
+        exclude: ["keepalive"]
+        routes: "alerts"
+'''
+
+
+@pytest.fixture
+def rules(tmp_path):
+    path = tmp_path / 'klaxer.yml'
+    path.write_text(CONFIG)
+    return Rules(str(path))
+
+
+def rewrite(path, text):
+    """Rewrite a config file, making sure it looks changed"""
+    stat = os.stat(path)
+    path.write_text(text)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+@pytest.mark.parametrize('config', ['sensu: [', 'sensu: {message: [1]}', 'sensu: {message: {exclude: 5}}',
+                                    'sensu: {message: {routes: [{IF: 5, THEN: alerts}]}}',
+                                    'sensu: {message: {routes: alerts, exclude_re: ["(a+)+"]}}'])
+def test_bad_configs_are_rejected(tmp_path, config):
+    path = tmp_path / 'klaxer.yml'
+    path.write_text(config)
+    with pytest.raises(ConfigurationError):
+        Rules(str(path))
+
+
+def test_bad_reloads_keep_the_current_rules(tmp_path, make_alert):
+    path = tmp_path / 'klaxer.yml'
+    path.write_text(CONFIG)
+    rules = ReloadingRules(str(path), interval=0)
+    current = rules.current
+    for config in ('sensu: [', 'sensu: {message: [1]}',
+                   'sensu: {message: {routes: alerts, exclude_re: ["("]}}'):
+        rewrite(path, config)
+        assert not rules.reload()
+        assert rules.current is current
+    path.unlink()
+    assert not rules.reload()
+    assert rules.current is current
+
+    path.write_text(CONFIG.replace('routes: "alerts"', 'routes: "ops"'))
+    assert rules.reload()
+    assert rules.current is not current
+    assert rules.get_pipeline('sensu').process(make_alert()).target == 'ops'
+
+
+def test_patterns_are_not_keywords(rules):
+    pipeline = rules.get_pipeline('sensu')
+    assert pipeline.search('message', r'failure of disk \d+') == frozenset(['failure'])
+    found = pipeline.search('message', 'failure of disk 42')
+    assert 'failure' in found
+    assert [match.group() for key, match in found.items() if match] == ['disk 42']
+
+
+def test_excluded_alerts_are_not_templated(rules, make_alert):
+    pipeline = rules.get_pipeline('sensu')
+    templates = TemplateMiner()
+    assert pipeline.process(make_alert(message='keepalive failure 42'), templates=templates) is None
+    assert templates.list() == []
+    alert = pipeline.process(make_alert(message='disk 42 failure'), templates=templates)
+    assert alert.template == templates.list()[0].id
+
+
+def test_keyword_rules_match_like_substring_checks(tmp_path, make_alert):
+    rng = random.Random(1)
+
+    def keywords():
+        return [''.join(rng.choice('abcA') for _ in range(rng.randint(1, 3)))
+                for _ in range(rng.randint(0, 3))]
+
+    for index in range(30):
+        config = {source: {'classification': {level: keywords() for level in ('CRITICAL', 'WARNING', 'OK')},
+                           'exclude': keywords()}
+                  for source in ('message', 'title')}
+        config['message']['routes'] = 'alerts'
+        path = tmp_path / f'klaxer-{index}.yml'
+        path.write_text(yaml.safe_dump({'sensu': config}))
+        pipeline = Rules(str(path)).get_pipeline('sensu')
+        for _ in range(20):
+            alert = make_alert(title=''.join(rng.choice('abcAB ') for _ in range(rng.randint(0, 10))),
+                               message=''.join(rng.choice('abcAB ') for _ in range(rng.randint(0, 10))))
+            # The checks the keyword matcher replaced: the first level with a
+            # keyword in the lowercased text, and any exclusion in it
+            severity = Severity.UNKNOWN
+            for source, cfg in config.items():
+                text = getattr(alert, source).lower()
+                for level in (Severity.CRITICAL, Severity.WARNING, Severity.OK):
+                    if any(keyword in text for keyword in cfg['classification'][level.name]):
+                        severity = max(severity, level)
+                        break
+            excluded = any(keyword in getattr(alert, source).lower()
+                           for source, cfg in config.items() for keyword in cfg['exclude'])
+            hits = pipeline.scan(alert)
+            assert pipeline.classify(alert, hits).severity == severity
+            assert pipeline.excluded(alert, hits) == excluded
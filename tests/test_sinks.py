@@ -0,0 +1,96 @@
+"""Tests of delivery to Slack, against a fake Slack"""
+
+import pytest
+
+from klaxer import config, sinks
+from klaxer.errors import ChannelNotFoundError
+from klaxer.fakeslack import FakeSlack
+from klaxer.models import Severity
+from klaxer.ratelimit import SlackScheduler
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    """A fake Slack that the sinks send to, with empty caches"""
+    with FakeSlack(channels=['alerts']) as fake:
+        # Without its trailing slash, as users tend to configure it
+        monkeypatch.setattr(config, 'SLACK_API_URL', fake.url.rstrip('/'))
+        monkeypatch.setattr(sinks, 'CHANNELS', {})
+        monkeypatch.setattr(sinks, 'LAST_MESSAGES', sinks.MessageLog())
+        monkeypatch.setattr(sinks, 'SCHEDULER', SlackScheduler(method_limits={}, backoff=0.01))
+        yield fake
+
+
+def test_repeats_roll_up_in_place(slack, make_alert):
+    for _ in range(3):
+        sinks.Slack('alerts').send_alert(make_alert(target='alerts', severity=Severity.CRITICAL))
+    messages = slack.messages('alerts')
+    assert len(messages) == 1
+    assert messages[0]['attachments'][0]['text'].endswith('(x3)')
+    assert slack.count('chat.postMessage') == 1
+    assert slack.count('chat.update') == 2
+
+
+@pytest.mark.parametrize('by_template, texts', [
+    (False, ['disk / is 91% full on db1', 'disk / is 96% full on web7', 'disk / is 97% full on web7']),
+    (True, ['disk / is 91% full on db1', 'disk / is 97% full on web7 (x2)']),
+])
+def test_alerts_roll_up_by_template_when_enabled(slack, make_alert, monkeypatch, by_template, texts):
+    monkeypatch.setattr(config, 'ROLLUP_BY_TEMPLATE', by_template)
+    for title, message in [('db1 disk full', 'disk / is 91% full on db1'),
+                           ('web7 disk full', 'disk / is 96% full on web7'),
+                           ('web7 disk full', 'disk / is 97% full on web7')]:
+        alert = make_alert(target='alerts', title=title, message=message)
+        alert.template = 1
+        sinks.Slack('alerts').send_alert(alert)
+    assert [message['attachments'][0]['text'] for message in slack.messages('alerts')] == texts
+
+
+def test_failed_update_reposts(slack, make_alert):
+    sinks.Slack('alerts').send_alert(make_alert(target='alerts'))
+    slack.fail('chat.update', error='message_not_found')
+    sinks.Slack('alerts').send_alert(make_alert(target='alerts'))
+    messages = slack.messages('alerts')
+    assert len(messages) == 1
+    assert messages[0]['attachments'][0]['text'].endswith('(x2)')
+    assert slack.count('chat.postMessage') == 2
+    assert slack.count('chat.delete') == 1
+
+
+def test_throttled_posts_are_retried_after_the_delay(slack, make_alert):
+    slack.limits = {'chat.postMessage': (1, 1)}
+    for title in ('disk full', 'load high'):
+        sinks.Slack('alerts').send_alert(make_alert(target='alerts', title=title, message=title))
+    assert [message['attachments'][0]['text'] for message in slack.messages('alerts')] == \
+        ['disk full', 'load high']
+    assert [call.status for call in slack.calls if call.method == 'chat.postMessage'] == [200, 429, 200]
+
+
+def test_channels_are_cached(slack):
+    for _ in range(3):
+        sinks.Slack('alerts')
+    assert slack.count('channels.list') == 1
+
+
+def test_missing_channels_are_remembered(slack):
+    for _ in range(3):
+        with pytest.raises(ChannelNotFoundError):
+            sinks.Slack('ops')
+    # Filling the cache just now already looked for ops
+    assert slack.count('channels.list') == 1
+
+
+def test_new_channels_are_found(slack):
+    sinks.Slack('alerts')
+    slack.add_channel('ops')
+    assert sinks.Slack('ops').channel.name == 'ops'
+    assert slack.count('channels.list') == 2
+
+
+def test_channels_are_cached_per_workspace(slack, monkeypatch):
+    sinks.Slack('alerts', token='one')
+    sinks.Slack('alerts', token='two')
+    assert slack.count('channels.list') == 2
+    with FakeSlack(channels=['ops']) as other:
+        monkeypatch.setattr(config, 'SLACK_API_URL', other.url)
+        assert sinks.Slack('ops', token='one').channel.name == 'ops'
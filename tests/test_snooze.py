@@ -0,0 +1,57 @@
+"""Tests of snoozes and their timing wheel"""
+
+import time
+
+from klaxer.snooze import SnoozeStore
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def scheduled(store):
+    return {snooze.id for slot in store._wheel for snooze in slot}
+
+
+def test_snoozes_expire(make_alert):
+    store = SnoozeStore(tick=0.01, slots=8)
+    snooze = store.add('sensu', ttl=0.05)
+    assert store.is_snoozed(make_alert())
+    assert wait_until(lambda: snooze.id not in scheduled(store))
+    assert not store.is_snoozed(make_alert())
+    assert not store.remove(snooze.id)
+
+
+def test_snoozes_outlast_a_turn_of_the_wheel(make_alert):
+    store = SnoozeStore(tick=0.02, slots=4)
+    snooze = store.add('sensu', ttl=0.3)
+    assert snooze.rounds > 0
+    time.sleep(0.15)
+    assert store.is_snoozed(make_alert())
+    assert snooze.id in scheduled(store)
+    assert wait_until(lambda: snooze.id not in scheduled(store))
+    assert not store.is_snoozed(make_alert())
+
+
+def test_removed_snoozes_leave_the_wheel(make_alert):
+    store = SnoozeStore(tick=0.01, slots=8)
+    snooze = store.add('sensu', ttl=60)
+    assert store.remove(snooze.id)
+    assert scheduled(store) == set()
+    assert not store.is_snoozed(make_alert())
+
+
+def test_replaced_snoozes_leave_the_wheel(make_alert):
+    store = SnoozeStore(tick=0.01, slots=8)
+    first = store.add('sensu', title='disk full', ttl=60)
+    second = store.add('sensu', title='disk full', ttl=120)
+    assert scheduled(store) == {second.id}
+    assert [snooze.id for snooze in store.list()] == [second.id]
+    assert not store.remove(first.id)
+    assert store.is_snoozed(make_alert())
+    assert not store.is_snoozed(make_alert(title='load high'))
@@ -0,0 +1,65 @@
+"""Tests of the transformers declared in the config"""
+
+import pytest
+
+from klaxer.errors import ConfigurationError, MalformedAlertError, TransformerNotDefinedError
+from klaxer.models import Alert
+from klaxer.transform import compile_transformer, parse_path
+
+PAYLOAD = {
+    'receiver': '#ops',
+    'alerts': [
+        {'labels': {'alertname': 'DiskFull'}, 'annotations': {'summary': 'disk / is 95% full'}},
+        {'labels': {'alertname': 'LoadHigh'}, 'annotations': {'description': 'load is 12'}},
+    ],
+}
+
+SPEC = {
+    'title': 'alerts[-1].labels.alertname',
+    'message': ['alerts[0].annotations.description', 'alerts[0].annotations.summary'],
+    'target': {'path': 'receiver', 'strip': '#', 'default': 'alerts'},
+    'username': {'path': 'sender', 'default': 'alertmanager'},
+}
+
+
+def test_paths_are_parsed_into_steps():
+    assert parse_path('alerts[-1].labels.alertname') == ['alerts', -1, 'labels', 'alertname']
+
+
+@pytest.mark.parametrize('path', ['', '.alerts', 'alerts[x]', 'alerts..labels'])
+def test_invalid_paths_are_rejected(path):
+    with pytest.raises(ConfigurationError):
+        compile_transformer('alertmanager', dict(SPEC, title=path))
+
+
+def test_fields_are_looked_up_by_path():
+    fields = compile_transformer('alertmanager', SPEC)(PAYLOAD)
+    assert fields['title'] == 'LoadHigh'
+    assert fields['message'] == 'disk / is 95% full'
+    assert fields['target'] == 'ops'
+    assert fields['username'] == 'alertmanager'
+    assert fields['icon_emoji'] is None
+    assert fields['timestamp']
+
+
+def test_missing_fields_fall_back_to_their_defaults():
+    fields = compile_transformer('alertmanager', SPEC)({'alerts': [{'labels': {'alertname': 'DiskFull'},
+                                                                    'annotations': {'summary': 'full'}}]})
+    assert fields['target'] == 'alerts'
+
+
+@pytest.mark.parametrize('payload', [{}, {'alerts': []}, {'alerts': [{'labels': {}}]},
+                                     {'alerts': 'DiskFull'}])
+def test_missing_required_fields_make_the_alert_malformed(payload):
+    with pytest.raises(MalformedAlertError):
+        Alert.from_service('alertmanager', payload, compile_transformer('alertmanager', SPEC))
+
+
+def test_payloads_must_be_objects():
+    with pytest.raises(MalformedAlertError):
+        Alert.from_service('alertmanager', [PAYLOAD], compile_transformer('alertmanager', SPEC))
+
+
+def test_services_without_a_transformer_are_not_malformed_alerts():
+    with pytest.raises(TransformerNotDefinedError):
+        Alert.from_service('nagios', PAYLOAD)
@@ -0,0 +1,46 @@
+"""Tests of API key verification and call counting"""
+
+import threading
+from uuid import uuid4
+
+import hug
+import pytest
+
+from klaxer import api, users
+
+
+@pytest.fixture
+def user():
+    users.bootstrap()
+    user = users.create_user(name='ops', email=f'{uuid4().hex}@example.com')
+    users.end_session()
+    return user
+
+
+def test_verified_keys_are_cached_as_plain_values(user):
+    identity = users.verify(user.api_key)
+    assert identity == users.Identity(user.id, user.api_key, False)
+    # Another thread, with a session of its own, gets the same cached identity
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(users.verify(user.api_key)))
+    thread.start()
+    thread.join()
+    assert seen == [identity]
+    assert users.verify('not-a-key') is None
+
+
+def test_calls_are_flushed(user):
+    for _ in range(3):
+        users.verify(user.api_key)
+    assert users.CALLS.pending(user.id) == 3
+    users.CALLS.flush()
+    assert users.CALLS.pending(user.id) == 0
+    assert users.get_user(user.id).calls == 3
+    users.end_session()
+
+
+def test_profile(user):
+    response = hug.test.get(api, '/user/me', headers={'X-Api-Key': user.api_key})
+    assert response.data['user_id'] == user.id
+    assert response.data['calls'] == 1
+    assert len(response.data['messages']) == 2